@@ -0,0 +1,314 @@
+"""
+A reproducible benchmark of the whole MEP pipeline and how it scales.
+
+Sweeps the dimension, n_spanning_gap, length_cutoff and number of centres one at a time from a base case,
+on seeded randomly_generated mixtures, recording for every stage its wall time, its peak memory
+and the work done (points, transitions, messages...). Writes results.json and scaling curves to scaling.png,
+and compares against a previous results.json if given one.
+
+Run from the top of the repo with
+    python -m min_energy_path.benchmark --output-dir bench/mep
+    python -m min_energy_path.benchmark --output-dir bench/mep-new --compare bench/mep/results.json
+Use a single BLAS thread, e.g. OMP_NUM_THREADS=1 OPENBLAS_NUM_THREADS=1 MKL_NUM_THREADS=1, for steadier times.
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+from min_energy_path import gaussian_params
+from min_energy_path.gaussian_field import gaussian_field
+from min_energy_path.points_sphere import create_sphere_points
+from min_energy_path.path_helpers import (generate_field_tables, generate_transition_components,
+                                          generate_path_ftree_better)
+from min_energy_path import neb
+from structured_dpp.instrumentation import recording, span
+from structured_dpp.benchmarks import machine_info, compare_to_baseline, format_comparisons, DEFAULT_THRESHOLD
+
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('sphere', 'field_tables', 'transitions', 'ftree', 'forward', 'assign', 'neb')
+
+BASE_CASE = {'dim': 3, 'n_spanning_gap': 5, 'length_cutoff': 3, 'n_centres': 5}
+# Each parameter is swept with the others at the base case
+SWEEPS = {
+    'dim': (2, 3, 4, 5),
+    'n_spanning_gap': (4, 5, 7, 9),
+    'length_cutoff': (2, 3, 4),
+    'n_centres': (2, 5, 10),
+}
+# The parameters of the path that aren't swept, as in mepNd.py
+PATH_PARAMS = {'tuning_dist': 0.01, 'tuning_strength': 1, 'tuning_strength_diff': 2,
+               'n_slices_behind': 1, 'n_slices_ahead': 2}
+
+
+def case_name(params, seed):
+    return ','.join(f'{key}={value}' for key, value in params.items()) + f',seed={seed}'
+
+
+def benchmark_cases(sweeps=None, base_case=None):
+    """
+    :return:
+        List of the params of every case, the base case and the sweep of each parameter, without duplicates
+    """
+    sweeps = SWEEPS if sweeps is None else sweeps
+    base_case = BASE_CASE if base_case is None else base_case
+    cases = [dict(base_case)]
+    for key, values in sweeps.items():
+        for value in values:
+            params = dict(base_case, **{key: value})
+            if params not in cases:
+                cases.append(params)
+    return cases
+
+
+@contextmanager
+def _stage(name, peak_memory=None):
+    """
+    A span of a stage, also putting the stage's peak memory above what was allocated at its start
+    in peak_memory if given, which needs tracemalloc to be tracing
+    """
+    if peak_memory is not None:
+        start_memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    with span(name):
+        yield
+    if peak_memory is not None:
+        peak_memory[name] = tracemalloc.get_traced_memory()[1] - start_memory
+
+
+def run_pipeline(mix_params, n_spanning_gap, length_cutoff, n_neb_iterations=500, peak_memory=None):
+    """
+    Runs every stage of the pipeline once, each in a span of its name in STAGES
+    :param n_neb_iterations:
+        The iterations of NEB, if 0 NEB isn't run
+    :param peak_memory:
+        (Optional) Dictionary to put the peak memory of each stage in, needs tracemalloc to be tracing
+    :return:
+        Dictionary with keys path_max_energy, the max energy along the MEP path, and neb_max_energy after NEB
+    """
+    with _stage('sphere', peak_memory):
+        points_info = create_sphere_points(mix_params['minima_coords'], n_spanning_gap)
+    with _stage('field_tables', peak_memory):
+        field_tables = generate_field_tables(points_info, mix_params, length_cutoff)
+    with _stage('transitions', peak_memory):
+        transition_components = generate_transition_components(
+            points_info, mix_params, length_cutoff, PATH_PARAMS['n_slices_behind'], PATH_PARAMS['n_slices_ahead'],
+            field_tables=field_tables
+        )
+        transition_qualities = transition_components.qualities(
+            PATH_PARAMS['tuning_dist'], PATH_PARAMS['tuning_strength'], PATH_PARAMS['tuning_strength_diff']
+        )
+    with _stage('ftree', peak_memory):
+        ftree = generate_path_ftree_better(
+            points_info, mix_params, length_cutoff, PATH_PARAMS['tuning_dist'], PATH_PARAMS['tuning_strength'],
+            PATH_PARAMS['tuning_strength_diff'], n_spanning_gap, PATH_PARAMS['n_slices_behind'],
+            PATH_PARAMS['n_slices_ahead'], transition_qualities=transition_qualities
+        )
+    with _stage('forward', peak_memory):
+        tail_var = next(iter(ftree.levels[-1]))
+        traversal, run = ftree.run_max_quality_forward(tail_var)
+    with _stage('assign', peak_memory):
+        max_quality, max_assignment = tail_var.calculate_max_message_assignment(run)
+        assignment = ftree.get_max_from_start_assignment(tail_var, max_assignment, traversal, run)
+        path_indexes = [assignment[var] for var in ftree.get_variables()]
+        path = points_info['sphere'][:, path_indexes]
+    energies = {'path_max_energy': float(np.max(gaussian_field(path, mix_params)))}
+    if n_neb_iterations:
+        with _stage('neb', peak_memory):
+            neb_path = neb.neb_mep({'path_indexes': path_indexes, 'path': path}, points_info, mix_params,
+                                   n_spanning_point_gap=2, n_max_iterations=n_neb_iterations)
+        energies['neb_max_energy'] = float(np.max(gaussian_field(neb_path, mix_params)))
+    return energies
+
+
+def run_case(params, seed, repeats=3, n_neb_iterations=500, measure_memory=True):
+    """
+    Benchmark one case on the seeded mixture
+    :param params:
+        Dictionary with keys dim, n_spanning_gap, length_cutoff and n_centres
+    :param repeats:
+        The number of timed runs, the best time of each stage is kept
+    :param measure_memory:
+        Whether to do one more run with tracemalloc tracing for the peak memory of each stage.
+        This is a separate run as tracing slows the code down.
+    :return:
+        Dictionary with keys name, params, seed, stage_times (best seconds of each stage), total_time,
+        peak_memory (bytes of each stage), counters (from the instrumentation of the last run) and
+        the energies from run_pipeline
+    """
+    mix_params = gaussian_params.randomly_generated(params['dim'], params['n_centres'], seed=seed)
+    stage_times = {}
+    for _ in range(repeats):
+        with recording() as recorder:
+            energies = run_pipeline(mix_params, params['n_spanning_gap'], params['length_cutoff'], n_neb_iterations)
+        for stage in STAGES:
+            if stage in recorder.spans:
+                stage_times[stage] = min(stage_times.get(stage, np.inf), recorder.spans[stage][1])
+
+    peak_memory = {}
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            run_pipeline(mix_params, params['n_spanning_gap'], params['length_cutoff'], n_neb_iterations,
+                         peak_memory=peak_memory)
+        finally:
+            tracemalloc.stop()
+
+    result = {'name': case_name(params, seed), 'params': params, 'seed': seed,
+              'stage_times': stage_times, 'total_time': sum(stage_times.values()),
+              'peak_memory': peak_memory, 'counters': dict(recorder.counters)}
+    result.update(energies)
+    logger.info(f"{result['name']}: {result['total_time']:.2f}s, "
+                f"{result['counters'].get('transitions', 0)} transitions")
+    return result
+
+
+def run_benchmark(cases=None, seeds=(0,), repeats=3, n_neb_iterations=500, measure_memory=True):
+    """
+    :param cases:
+        (Optional) List of params, by default benchmark_cases()
+    :param seeds:
+        The seeds of the mixtures every case is run on
+    :return:
+        List of the results of every case and seed, see run_case
+    """
+    cases = benchmark_cases() if cases is None else cases
+    return [run_case(params, seed, repeats, n_neb_iterations, measure_memory) for params in cases for seed in seeds]
+
+
+def save_results(results, path, config=None):
+    with open(path, 'w') as f:
+        json.dump({'machine': machine_info(), 'config': config, 'results': results}, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def _stage_timings(results):
+    """The stage and total times of the results as case/stage => {'best': seconds}, for compare_to_baseline"""
+    timings = {}
+    for result in results:
+        for stage, stage_time in result['stage_times'].items():
+            timings[f"{result['name']}/{stage}"] = {'best': stage_time}
+        timings[f"{result['name']}/total"] = {'best': result['total_time']}
+    return timings
+
+
+def compare_results(results, previous, threshold=DEFAULT_THRESHOLD, min_difference=1e-3):
+    """
+    Compare the stage and total times of results against previous results, see compare_to_baseline.
+    Stages less than min_difference seconds slower don't count as regressions, as the quick stages are noisy.
+    Cases whose work changed (a different number of points, transitions or messages)
+    aren't like for like so are logged.
+    :return:
+        List of (case/stage, previous time, new time, ratio, regressed)
+    """
+    previous_by_name = {result['name']: result for result in previous}
+    for result in results:
+        old = previous_by_name.get(result['name'])
+        if old is None:
+            continue
+        for counter in ('sphere_points', 'transitions', 'messages'):
+            if old['counters'].get(counter) != result['counters'].get(counter):
+                logger.warning(f"{result['name']} changed {counter} from {old['counters'].get(counter)} "
+                               f"to {result['counters'].get(counter)}")
+    return compare_to_baseline(_stage_timings(results), _stage_timings(previous), threshold,
+                               min_difference=min_difference)
+
+
+def plot_scaling(results, path, sweeps=None, base_case=None):
+    """
+    Plot how the stage times, peak memory and number of transitions scale with each swept parameter,
+    each point the mean over the seeds
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    sweeps = SWEEPS if sweeps is None else sweeps
+    base_case = BASE_CASE if base_case is None else base_case
+    fig, axs = plt.subplots(3, len(sweeps), figsize=(4*len(sweeps), 10), squeeze=False, constrained_layout=True)
+    for column, (key, values) in enumerate(sweeps.items()):
+        swept = {value: [result for result in results if result['params'] == dict(base_case, **{key: value})]
+                 for value in values}
+        x = [value for value in values if swept[value]]
+
+        def mean(get):
+            return [np.mean([get(result) for result in swept[value]]) for value in x]
+
+        for stage in STAGES:
+            axs[0, column].plot(x, mean(lambda result: result['stage_times'].get(stage, np.nan)), 'o-', label=stage)
+            axs[1, column].plot(x, mean(lambda result: result['peak_memory'].get(stage, np.nan) / 1e6), 'o-',
+                                label=stage)
+        axs[0, column].plot(x, mean(lambda result: result['total_time']), 'ko--', label='total')
+        axs[2, column].plot(x, mean(lambda result: result['counters'].get('transitions', np.nan)), 'o-')
+        axs[0, column].set_yscale('log')
+        axs[1, column].set_yscale('log')
+        axs[2, column].set_yscale('log')
+        axs[2, column].set_xlabel(key)
+        axs[0, column].set_title(f'Varying {key}')
+    axs[0, 0].set_ylabel('Time (s)')
+    axs[1, 0].set_ylabel('Peak memory (MB)')
+    axs[2, 0].set_ylabel('Transitions')
+    axs[0, -1].legend(fontsize='small')
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the MEP pipeline and how it scales')
+    parser.add_argument('--output-dir', default='mep_benchmark', help='Where results.json and scaling.png go')
+    parser.add_argument('--compare', help='A previous results.json to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='The fraction slower than the previous results that counts as a regression')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0], help='The seeds of the mixtures')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--neb-iterations', type=int, default=500, help='0 to leave out NEB')
+    parser.add_argument('--no-memory', action='store_true', help="Don't measure the peak memory")
+    for key, values in SWEEPS.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=int, nargs='+', default=list(values),
+                            help=f'The values of {key} to sweep, the base case is {BASE_CASE[key]}')
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    for name in ('structured_dpp', 'min_energy_path'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    logger.setLevel(logging.INFO)
+
+    sweeps = {key: tuple(getattr(args, key)) for key in SWEEPS}
+    config = {'base_case': BASE_CASE, 'sweeps': sweeps, 'path_params': PATH_PARAMS, 'seeds': args.seeds,
+              'repeats': args.repeats, 'n_neb_iterations': args.neb_iterations}
+    results = run_benchmark(benchmark_cases(sweeps), args.seeds, args.repeats, args.neb_iterations,
+                            not args.no_memory)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    save_results(results, os.path.join(args.output_dir, 'results.json'), config)
+    if not args.no_plot:
+        try:
+            plot_scaling(results, os.path.join(args.output_dir, 'scaling.png'), sweeps)
+        except ImportError:
+            logger.warning('matplotlib is needed for the scaling plots, skipping them')
+    logger.info(f'Saved the results to {args.output_dir}')
+
+    if args.compare:
+        comparisons = compare_results(results, load_results(args.compare), args.threshold)
+        print(format_comparisons(comparisons))
+        regressions = [name for name, *_, regressed in comparisons if regressed]
+        if regressions:
+            logger.error(f'{len(regressions)} of {len(comparisons)} timings regressed by more than '
+                         f'{args.threshold:.0%}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
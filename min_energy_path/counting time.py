@@ -2,7 +2,7 @@ import numpy as np
 import scipy.linalg as scila
 import matplotlib.pyplot as plt
 
-from min_energy_path.points_sphere import create_sphere_points
+from min_energy_path.points_sphere import create_sphere_points, get_neighbour_adjacency, get_neighbour_window
 
 
 def generate_transition_qualities(points_info,
@@ -14,26 +14,21 @@ def generate_transition_qualities(points_info,
     # First, we work out which variables we need to calculate transitions from
     min_dir_index = max(points_info['root_dir_index']-n_slices_behind, 0)
     max_dir_index = points_info['tail_dir_index']+1+n_slices_ahead
-    to_calculate_from = points_info['spherey_index'][min_dir_index:max_dir_index, ...]
+    dir_index = points_info['dir_index']
+    to_calculate_from = points_info['sphere_index'][(min_dir_index <= dir_index) & (dir_index < max_dir_index)]
+    get_neighbour_adjacency(points_info, length_cutoff)
 
     # Then actually calculate, for each "from" point, the quality to each possible "to" point
     # from is rootwards, to is leafwards
     # transition_qualities[rootwards][leafwards]
     n_total = 0
 
-    for from_pos, fromm in np.ndenumerate(to_calculate_from):
-        if fromm == -1:
-            continue
-        to_slices_behind = min_dir_index + from_pos[0] - n_slices_behind - n_slices_ahead + 1
-        to_slices_ahead = min_dir_index + from_pos[0] + n_slices_behind + n_slices_ahead + 2
-        to_calculate_idx = points_info['spherey_index'][
-            (slice(max(to_slices_behind, min_dir_index), min(to_slices_ahead, max_dir_index)),) +
-            tuple(
-                slice(max(from_dim_pos-length_cutoff, 0), from_dim_pos+1+length_cutoff)
-                for from_dim_pos in from_pos[1:]
-            )
-        ]
-        to_calculate_idx = to_calculate_idx[~np.isin(to_calculate_idx, [-1, fromm])]
+    for fromm in to_calculate_from:
+        to_slices_behind = dir_index[fromm] - n_slices_behind - n_slices_ahead + 1
+        to_slices_ahead = dir_index[fromm] + n_slices_behind + n_slices_ahead + 2
+        to_calculate_idx = get_neighbour_window(fromm, points_info,
+                                                max(to_slices_behind, min_dir_index),
+                                                min(to_slices_ahead, max_dir_index))
         directions = points_info['sphere'][:, to_calculate_idx] - points_info['sphere'][:, [fromm]]
         directions_length = scila.norm(directions, axis=0)
 
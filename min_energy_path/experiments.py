@@ -0,0 +1,258 @@
+"""
+Runs many independent randomised trials of an experiment across a pool of processes.
+
+Every trial gets its own seed from the experiment's seed, so a trial gives the same result whichever process
+runs it and in whatever order, and is written to its own file as soon as it finishes.
+A trial that raises an exception only loses that trial, and running the experiment again only runs the trials
+that don't have a file yet.
+
+Each process should use a single BLAS thread for the experiment to scale with the number of processes,
+e.g. run with OMP_NUM_THREADS=1 OPENBLAS_NUM_THREADS=1 MKL_NUM_THREADS=1.
+"""
+import os
+import json
+import time
+import traceback
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+
+from min_energy_path.gaussian_field import gaussian_field
+from min_energy_path import gaussian_params
+from min_energy_path.points_sphere import create_sphere_points
+from min_energy_path.path_helpers import get_good_path_start_samples, calculate_good_paths, generate_path_ftree_better
+from min_energy_path import neb
+
+
+logger = logging.getLogger(__name__)
+
+
+def trial_seeds(seed, n_trials):
+    """
+    Independent seeds for each trial of an experiment, the same for the same seed
+    :return:
+        List of n_trials integer seeds
+    """
+    return [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(n_trials)]
+
+
+def _to_json(value):
+    """Turns the arrays and numpy numbers in a trial's result into lists and numbers"""
+    if isinstance(value, dict):
+        return {str(key): _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+def _trial_path(output_dir, trial_index):
+    return os.path.join(output_dir, f'trial-{trial_index:05d}.json')
+
+
+def _run_trial(trial_function, trial_index, seed, output_dir, trial_kwargs):
+    """
+    Runs a single trial and writes its record, catching any exception so that it doesn't stop the other trials
+    :return:
+        The trial's record
+    """
+    start_time = time.time()
+    record = {'trial': trial_index, 'seed': seed, 'kwargs': trial_kwargs}
+    try:
+        record['result'] = trial_function(seed, **trial_kwargs)
+        record['status'] = 'ok'
+    except Exception:
+        record['status'] = 'error'
+        record['error'] = traceback.format_exc()
+    record['running_time'] = time.time() - start_time
+    record = _to_json(record)
+    _write_record(output_dir, record)
+    return record
+
+
+def _write_record(output_dir, record):
+    # Write to a temporary file first so a half written file is never loaded
+    path = _trial_path(output_dir, record['trial'])
+    with open(path + '.tmp', 'w') as f:
+        json.dump(record, f)
+    os.replace(path + '.tmp', path)
+
+
+def run_experiment(trial_function, n_trials, output_dir, seed=0, n_workers=None, rerun_errors=False,
+                   **trial_kwargs):
+    """
+    Runs n_trials trials of trial_function across a pool of processes, writing the record of each trial to
+    output_dir/trial-{index}.json as soon as it finishes.
+    Trials that already have a record are not run again, so an experiment that was stopped can be carried on.
+    :param trial_function:
+        The function for a trial, called as trial_function(seed, **trial_kwargs), returning a dictionary of
+        numbers, strings, lists and arrays. Must be defined at the top level of a module so it can be pickled.
+    :param n_trials:
+        The number of trials
+    :param output_dir:
+        The directory the trial records are written to
+    :param seed:
+        The seed of the experiment, that the seed of each trial comes from, see trial_seeds
+    :param n_workers:
+        The number of processes, by default the number of cpus. With 1 the trials are run in this process.
+    :param rerun_errors:
+        Whether trials whose record is an error are run again
+    :param trial_kwargs:
+        The other arguments of trial_function, which must be the same for every trial
+    :return:
+        List of the records of the trials, in order of trial, see load_results
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    seeds = trial_seeds(seed, n_trials)
+    json_kwargs = json.loads(json.dumps(_to_json(trial_kwargs)))  # As they are in the records
+    done = {}
+    for record in load_results(output_dir):
+        if record['trial'] >= n_trials:
+            continue
+        if record['seed'] != seeds[record['trial']] or record['kwargs'] != json_kwargs:
+            raise ValueError(f"{_trial_path(output_dir, record['trial'])} is from an experiment with a different seed "
+                             f"or arguments, use another output_dir or remove the old records")
+        if not (rerun_errors and record['status'] == 'error'):
+            done[record['trial']] = record
+    to_run = [trial_index for trial_index in range(n_trials) if trial_index not in done]
+    logger.info(f'Running {len(to_run)} of {n_trials} trials of {trial_function.__name__}')
+
+    if n_workers == 1:
+        for trial_index in to_run:
+            _log_record(_run_trial(trial_function, trial_index, seeds[trial_index], output_dir, trial_kwargs))
+        return _experiment_results(output_dir, n_trials)
+
+    # A process that dies without an exception (e.g. killed for using too much memory) breaks the whole pool,
+    # so the trials that were running in it are given one more go in a new pool
+    for attempt in range(2):
+        unfinished = []
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(_run_trial, trial_function, trial_index, seeds[trial_index], output_dir,
+                                       trial_kwargs): trial_index for trial_index in to_run}
+            for future in as_completed(futures):
+                try:
+                    _log_record(future.result())
+                except BrokenProcessPool:
+                    unfinished.append(futures[future])
+        if not unfinished:
+            break
+        logger.error(f'The process pool broke with trials {sorted(unfinished)} unfinished')
+        to_run = sorted(unfinished)
+    return _experiment_results(output_dir, n_trials)
+
+
+def _experiment_results(output_dir, n_trials):
+    """The records of trials 0 to n_trials - 1, logging any that are missing"""
+    records = [record for record in load_results(output_dir) if record['trial'] < n_trials]
+    if len(records) < n_trials:
+        missing = sorted(set(range(n_trials)) - {record['trial'] for record in records})
+        logger.error(f'Trials {missing} have no record, run the experiment again to run them')
+    return records
+
+
+def _log_record(record):
+    if record['status'] == 'ok':
+        logger.info(f"Finished trial {record['trial']} in {record['running_time']:.1f}s")
+    else:
+        logger.error(f"Trial {record['trial']} failed:\n{record['error']}")
+
+
+def load_results(output_dir):
+    """
+    The records of the trials that have finished, in order of trial.
+    Each record is a dictionary with keys trial, seed, kwargs, status ('ok' or 'error'), running_time,
+    and result (the return of the trial function) or error (the traceback).
+    Records whose arrays have been moved to a results store also have result_store, see store_records.
+    """
+    if not os.path.isdir(output_dir):
+        return []
+    records = []
+    for name in sorted(os.listdir(output_dir)):
+        if name.startswith('trial-') and name.endswith('.json'):
+            with open(os.path.join(output_dir, name)) as f:
+                records.append(json.load(f))
+    return sorted(records, key=lambda record: record['trial'])
+
+
+def store_records(records, store, output_dir=None):
+    """
+    Add the records of the trials that finished to a results store, one row per trial with columns
+    trial, seed, running_time, each of the trial's kwargs and each key of its result.
+    Trials already in the store are skipped, so it can be called again after more trials have run.
+    :param records:
+        As returned from run_experiment or load_results
+    :param store:
+        A results_store.ResultsStore
+    :param output_dir:
+        (Optional) The directory of the trial records. If given, once the trials are written to the store their
+        record files are rewritten without the arrays of their results (e.g. the energy profiles),
+        which are then only kept in the store, and with result_store set to the store's directory.
+    """
+    stored_trials = set(store.column('trial').tolist()) if 'trial' in store.columns else set()
+    finished = [record for record in records if record['status'] == 'ok']
+    for record in finished:
+        if record['trial'] not in stored_trials:
+            store.append(dict({'trial': record['trial'], 'seed': record['seed'],
+                               'running_time': record['running_time']}, **record['kwargs'], **record['result']))
+    store.flush()
+
+    if output_dir is not None:
+        for record in finished:
+            result = {key: value for key, value in record['result'].items() if np.ndim(value) == 0}
+            if len(result) < len(record['result']):
+                _write_record(output_dir, dict(record, result=result, result_store=store.directory))
+
+
+def mep_trial(seed, dim, n_centres, n_spanning_gap=5, n_best_paths=4, n_max_iterations=2500):
+    """
+    One trial of comparing the MEP paths with NEB from a straight line on a random mixture, as in mep.py:
+    the sphere, factor tree, forward pass, NEB of the best few MEP paths, and NEB of the straight line
+    :param seed:
+        Seed for the random mixture
+    :param dim:
+        The number of dimensions
+    :param n_centres:
+        The number of maxima in the random mixture
+    :param n_spanning_gap:
+        See create_sphere_points
+    :param n_best_paths:
+        The number of the best MEP paths that NEB is done on
+    :param n_max_iterations:
+        The iterations of each NEB
+    :return:
+        Dictionary with keys mrf_ep, the energy profile of the MEP path with the lowest barrier after NEB,
+        neb_ep, the energy profile of the straight line after NEB, and their max energies mrf_max and neb_max
+    """
+    mix_params = gaussian_params.randomly_generated(dim, n_centres, seed=seed)
+    points_info = create_sphere_points(mix_params['minima_coords'], n_spanning_gap)
+    ftree = generate_path_ftree_better(
+        points_info, mix_params,
+        length_cutoff=3,
+        tuning_dist=0.02,
+        tuning_strength=1,
+        tuning_strength_diff=1.5,
+        n_spanning_gap=n_spanning_gap,
+        n_slices_behind=0,
+        n_slices_ahead=0
+    )
+    variables = list(ftree.get_variables())
+    var_middle = variables[(len(variables) // 2)-1]
+    traversal, run = ftree.run_max_quality_forward(var_middle)
+
+    good_paths_start = get_good_path_start_samples(var_middle, run, points_info, n_per_group=4)
+    best_groups = sorted(good_paths_start, key=lambda group: good_paths_start[group][1], reverse=True)[:n_best_paths]
+    best_paths_info = calculate_good_paths({group: good_paths_start[group] for group in best_groups},
+                                           var_middle, traversal, run, ftree, points_info)
+
+    mrf_nebs = neb.neb_mep_batch(best_paths_info, points_info, mix_params,
+                                 n_spanning_point_gap=2, n_max_iterations=n_max_iterations)
+    mrf_eps = [gaussian_field(mrf_neb, mix_params) for mrf_neb in mrf_nebs]
+    mrf_ep = min(mrf_eps, key=np.max)
+
+    old_path = np.linspace(mix_params['minima_coords'][:, 0], mix_params['minima_coords'][:, 1],
+                           mrf_nebs[-1].shape[1], axis=-1)
+    new_path = neb.neb(old_path, mix_params, n_max_iterations=n_max_iterations)
+    neb_ep = gaussian_field(new_path, mix_params)
+    return {'mrf_ep': mrf_ep, 'neb_ep': neb_ep, 'mrf_max': np.max(mrf_ep), 'neb_max': np.max(neb_ep)}
@@ -19,6 +19,8 @@ import numpy as np
 import scipy.linalg as scila
 import functools
 
+from structured_dpp.instrumentation import count
+
 
 def transform_coords(coords, mix_params):
     """
@@ -56,6 +58,7 @@ def _field_strength(coords_transformed, mix_params):
     :return:
         Matrix (n points, m gaussians)
     """
+    count('gaussian_evaluations', coords_transformed.shape[1] * coords_transformed.shape[2])
     return mix_params['magnitude'][np.newaxis, :] * np.exp(
         np.sum(-coords_transformed**2, axis=0) / (2*mix_params['sigma'][np.newaxis, :]**2)
     )
@@ -93,11 +96,255 @@ def _gaussian_grad(coords_transformed, field_strength, mix_params):
     return np.sum(scale[np.newaxis, :, :] * coords_transformed, axis=2)
 
 
-def gaussian_field_for_quality(coords, mix_params, point_distance, length_cutoff, order_2_step=0.2):
+def gaussian_cutoff_radius(mix_params, tolerance=1e-10):
+    """
+    The distance from each gaussian's centre beyond which its strength is below the tolerance
+    :param mix_params:
+        See docstring for gaussian_field.py
+    :return:
+        Vector shape (m gaussians,)
+    """
+    magnitude = np.abs(mix_params['magnitude'])
+    return mix_params['sigma'] * np.sqrt(2*np.log(np.maximum(magnitude / tolerance, 1.)))
+
+
+def _near_field_strength(coords, mix_params, neighbours):
+    """
+    The same as transform_coords and _field_strength, but only for the gaussians near each point
+    :param coords:
+        Column vectors (d dimensions, n points)
+    :param neighbours:
+        Matrix (n points, k) of the gaussians near each point, padded with -1, see GaussianNeighbourLists
+    :return:
+        Each point transformed to the centre of its near gaussians, multiarray (d dimensions, n points, k),
+        the strength of each near gaussian, matrix (n points, k), which is 0 for the padding,
+        and the sigma of each near gaussian, matrix (n points, k)
+    """
+    count('gaussian_evaluations', neighbours.size)
+    padding = neighbours < 0
+    neighbours = np.where(padding, 0, neighbours)
+    coords_transformed = coords[:, :, np.newaxis] - mix_params['centre'][:, neighbours]
+    sigma = mix_params['sigma'][neighbours]
+    magnitude = np.where(padding, 0., mix_params['magnitude'][neighbours])
+    field_strength = magnitude * np.exp(np.sum(-coords_transformed**2, axis=0) / (2*sigma**2))
+    return coords_transformed, field_strength, sigma
+
+
+def _near_gaussian_grad(coords_transformed, field_strength, sigma):
+    """
+    The same as _gaussian_grad, with the outputs of _near_field_strength
+    :return:
+        Matrix shape (d dimensions, n points)
+    """
+    scale = -field_strength / sigma**2
+    return np.sum(scale[np.newaxis, :, :] * coords_transformed, axis=2)
+
+
+class GaussianNeighbourLists:
+    """
+    Verlet lists of the gaussians near each of a set of moving points, so the field at the points only has to be
+    calculated from the gaussians that make a difference to it.
+    Each point's list has the gaussians within their cutoff radius (see gaussian_cutoff_radius) plus a skin of the
+    point's position when the list was made, so the list stays correct until the point has moved further than the
+    skin, and is only made again then.
+    """
+    def __init__(self, mix_params, n_points, skin, tolerance=1e-10):
+        """
+        :param mix_params:
+            See docstring for gaussian_field.py
+        :param n_points:
+            The number of points with a list
+        :param skin:
+            How far past their cutoff radius gaussians are kept in the lists
+        :param tolerance:
+            The strength below which a gaussian is left out, see gaussian_cutoff_radius
+        """
+        self.mix_params = mix_params
+        self.skin = skin
+        self.radius = gaussian_cutoff_radius(mix_params, tolerance) + skin
+        self.positions = np.full((mix_params['centre'].shape[0], n_points), np.nan)
+        self.neighbours = np.full((n_points, 0), -1, dtype=np.int64)
+        self.n_rebuilds = 0
+
+    def update(self, coords, point_indices=None, chunk_size=4096):
+        """
+        The neighbour lists of some of the points at their new coords, making the lists again for the points
+        that have moved further than the skin.
+        :param coords:
+            Column vectors (d dimensions, n points to update)
+        :param point_indices:
+            (Optional) The points that the coords are of, by default all of them
+        :param chunk_size:
+            The number of lists made at once, which limits the memory used
+        :return:
+            Matrix (n points to update, k) of the gaussians near each point, padded with -1
+        """
+        if point_indices is None:
+            point_indices = np.arange(self.positions.shape[1])
+        # Points without a list yet have nan positions, which count as having moved
+        moved = ~(np.sqrt(np.sum((coords - self.positions[:, point_indices])**2, axis=0)) <= self.skin)
+        rebuild = point_indices[moved]
+        rebuild_coords = coords[:, moved]
+        for start in range(0, rebuild.size, chunk_size):
+            distances = scila.norm(transform_coords(rebuild_coords[:, start:start+chunk_size], self.mix_params),
+                                   axis=0)
+            near = distances < self.radius[np.newaxis, :]
+            n_near = np.sum(near, axis=1)
+            if np.max(n_near, initial=0) > self.neighbours.shape[1]:
+                extra = np.max(n_near) - self.neighbours.shape[1]
+                self.neighbours = np.concatenate([
+                    self.neighbours, np.full((self.neighbours.shape[0], extra), -1, dtype=np.int64)
+                ], axis=1)
+            # Each row's near gaussians first, in order, then the padding
+            rows, cols = np.nonzero(near)
+            lists = np.full((n_near.size, self.neighbours.shape[1]), -1, dtype=np.int64)
+            lists[rows, np.arange(rows.size) - np.repeat(np.cumsum(n_near) - n_near, n_near)] = cols
+            self.neighbours[rebuild[start:start+chunk_size]] = lists
+        self.positions[:, rebuild] = rebuild_coords
+        self.n_rebuilds += rebuild.size
+        return self.neighbours[point_indices]
+
+
+def _gaussian_second_derivative(coords_transformed, field_strength, directions, mix_params):
+    """
+    Work out the second derivative of the field along a set of directions having already done some prior calculations.
+    Uses the analytic Hessian of each gaussian, H = g (r r^T / sigma^4 - I / sigma^2), without building it,
+    so only the directional form v^T H v is calculated.
+    :param coords_transformed:
+        Each point as a column vector transformed to the centre of each gaussian mix
+        Multiarray (d dimensions, n points, m gaussians)
+    :param field_strength:
+        The strength of the gaussian field for each point for each gaussian field
+        Matrix (n points, m gaussians)
+    :param directions:
+        Matrix (d dimensions, n points), the direction to take the second derivative in at each point
+    :param mix_params:
+        See docstring for gaussian_field.py
+    :return:
+        Vector shape (n points,)
+    """
+    sigma_sq = mix_params['sigma'][np.newaxis, :] ** 2
+    projected = np.sum(coords_transformed * directions[:, :, np.newaxis], axis=0)  # (n points, m gaussians)
+    directions_sq = np.sum(directions ** 2, axis=0)[:, np.newaxis]
+    return np.sum(field_strength * (projected ** 2 / sigma_sq ** 2 - directions_sq / sigma_sq), axis=1)
+
+
+def gaussian_field_derivatives(coords, directions, mix_params):
+    """
+    Calculate the field strength, the gradient and the second derivative along a direction at a set of coordinates.
+    The exponentials are only calculated once and shared between all three quantities.
+    :param coords:
+        Matrix shape (d dimensions, n points)
+    :param directions:
+        Matrix shape (d dimensions, n points), the direction to take the second derivative in at each point.
+        Use unit vectors to get the curvature along that direction.
+    :param mix_params:
+        See docstring for gaussian_field.py
+    :return:
+        strength vector (n points,), grad matrix (d dimensions, n points), second derivative vector (n points,)
+    """
+    coords_transformed = transform_coords(coords, mix_params)
+    field_strength = _field_strength(coords_transformed, mix_params)
+    return (
+        np.sum(field_strength, axis=1),
+        _gaussian_grad(coords_transformed, field_strength, mix_params),
+        _gaussian_second_derivative(coords_transformed, field_strength, directions, mix_params)
+    )
+
+
+def _orthogonal_directions(directions, grads):
+    """
+    Get a unit vector perpendicular to each direction, preferably in the direction of the gradient.
+    This is not possible for small gradients, or gradients in the direction of the path,
+    so instead the axis with the smallest component of the direction is made orthogonal to it.
+    :param directions:
+        Matrix shape (d dimensions, n points)
+    :param grads:
+        Matrix shape (d dimensions, n points)
+    :return:
+        orthogonal directions (d dimensions, n points), orthogonal gradient lengths (n points,)
+    """
+    directions_length_sq = np.sum(directions ** 2, axis=0, keepdims=True)
+    orthog_grads = grads - np.sum(grads * directions, axis=0, keepdims=True) * directions / directions_length_sq
+    orthog_grads_length = scila.norm(orthog_grads, axis=0)
+
+    # Fall back to a basis vector for the small gradients
+    basis = np.zeros_like(directions)
+    basis[np.argmin(np.abs(directions), axis=0), np.arange(directions.shape[1])] = 1
+    basis -= np.sum(basis * directions, axis=0, keepdims=True) * directions / directions_length_sq
+    basis /= scila.norm(basis, axis=0, keepdims=True)
+
+    use_grad = orthog_grads_length >= 1e-8
+    orthog_directions = np.where(
+        use_grad[np.newaxis, :], orthog_grads / np.where(use_grad, orthog_grads_length, 1)[np.newaxis, :], basis
+    )
+    return orthog_directions, orthog_grads_length
+
+
+def gaussian_field_for_quality_batch(coords0, coords1, mix_params, point_distance, length_cutoff):
+    """
+    Calculate the field information needed to score a batch of transitions between pairs of points.
+    The second derivative orthogonal to each transition is found analytically.
+    :param coords0:
+        Matrix shape (d dimensions, n pairs), the first point of each pair
+    :param coords1:
+        Matrix shape (d dimensions, n pairs), the second point of each pair
+    :param mix_params:
+        See docstring for gaussian_field.py
+    :param point_distance:
+        The distance between two neighbouring points in the sphere
+    :param length_cutoff:
+        Pairs further apart than length_cutoff * point_distance are not calculated
+    :return:
+        pos0_strength, pos1_strength, mid_strength, second_order, direction_length, orthog_grad_length,
+        each a vector for the close enough pairs, then the close_enough boolean vector shape (n pairs,)
+    """
+    directions = coords1 - coords0
+    directions_length = scila.norm(directions, axis=0)
+    close_enough = (directions_length <= length_cutoff * point_distance) & (directions_length > 0)
+    coords0, coords1 = coords0[:, close_enough], coords1[:, close_enough]
+    directions, directions_length = directions[:, close_enough], directions_length[close_enough]
+    n_pairs = directions.shape[1]
+
+    # Evaluate every point in one go so that each exponential is only calculated once
+    coords_transformed = transform_coords(np.concatenate([coords0, coords1, (coords0 + coords1) / 2], axis=1),
+                                          mix_params)
+    field_strength = _field_strength(coords_transformed, mix_params)
+    strengths = np.sum(field_strength, axis=1)
+
+    # The gradient and curvature are only needed at the midpoints
+    mid_transformed = coords_transformed[:, 2*n_pairs:, :]
+    mid_field_strength = field_strength[2*n_pairs:, :]
+    grads = _gaussian_grad(mid_transformed, mid_field_strength, mix_params)
+    orthog_directions, orthog_grads_length = _orthogonal_directions(directions, grads)
+    second_order = _gaussian_second_derivative(mid_transformed, mid_field_strength, orthog_directions, mix_params)
+
+    return (strengths[:n_pairs], strengths[n_pairs:2*n_pairs], strengths[2*n_pairs:], second_order,
+            directions_length, orthog_grads_length, close_enough)
+
+
+def gaussian_field_for_quality(coords, mix_params, point_distance, length_cutoff, order_2_step=None):
+    """
+    Calculate the field information needed to score the transition between two points.
+    :param coords:
+        Matrix shape (d dimensions, 2 points)
+    :param order_2_step:
+        If None the orthogonal second derivative is calculated analytically,
+        otherwise it is estimated by finite differences with steps of order_2_step * point_distance.
+    :return:
+        0 if the points are too far apart or identical, otherwise
+        pos0_strength, pos1_strength, mid_strength, second_order_guess, direction_length, orthog_grad_length
+    """
     direction = coords[:, 1] - coords[:, 0]
     direction_length = scila.norm(direction)
-    if direction_length > length_cutoff * point_distance:
+    if direction_length > length_cutoff * point_distance or direction_length == 0:
         return 0
+    if order_2_step is None:
+        *gaussian_info, close_enough = gaussian_field_for_quality_batch(
+            coords[:, [0]], coords[:, [1]], mix_params, point_distance, length_cutoff
+        )
+        return tuple(info[0] for info in gaussian_info)
+
     midpoint = (coords[:, [0]] + coords[:, [1]]) / 2
     coords = np.concatenate([coords, midpoint], axis=1)
 
@@ -107,29 +354,16 @@ def gaussian_field_for_quality(coords, mix_params, point_distance, length_cutoff
     pos0_strength, pos1_strength, mid_strength = np.sum(field_strength, axis=1)
 
     # Find the magnitude of the gradient perpendicular to the direction of the path_guess
-    grad = _gaussian_grad(coords_transformed[:, [2], :], field_strength[[2], :], mix_params)[:, 0]
-    orthog_grad = grad - np.dot(grad, direction) * direction / direction_length**2
-    orthog_grad_length = scila.norm(orthog_grad)
-
-    # Get a good vector perpendicular to the direction of the path_guess,
-    # preferably in the highest gradient direction
-    # not possible for small gradients, or gradients in the direction of the path_guess
-    if orthog_grad_length >= 1e-8:
-        orthog_direction = orthog_grad / orthog_grad_length
-    else:
-        min_dir = np.argmin(direction)
-        basis = np.zeros(coords.shape[0])
-        basis[min_dir] = 1
-        orthog_direction = basis - np.dot(basis, direction) * basis
-        orthog_direction /= scila.norm(orthog_direction)
+    grad = _gaussian_grad(coords_transformed[:, [2], :], field_strength[[2], :], mix_params)
+    orthog_direction, orthog_grad_length = _orthogonal_directions(direction[:, np.newaxis], grad)
 
     # Take small step either direction from the midpoint in the orthogonal direction
-    orthog_points = midpoint + np.array([[-1, 1]]) * point_distance * order_2_step * orthog_direction[:, np.newaxis]
+    orthog_points = midpoint + np.array([[-1, 1]]) * point_distance * order_2_step * orthog_direction
     orthog0_strength, orthog1_strength = gaussian_field(orthog_points, mix_params)
     # Use the finite difference method of estimating the second order derivative
     second_order_guess = (orthog1_strength - 2*mid_strength + orthog0_strength) / (point_distance * order_2_step)**2
 
-    return pos0_strength, pos1_strength, mid_strength, second_order_guess, direction_length, orthog_grad_length
+    return pos0_strength, pos1_strength, mid_strength, second_order_guess, direction_length, orthog_grad_length[0]
 
 
 def gaussian_field_for_better_quality(from_coord, to_coords, to_coord_indices, mix_params, length_cutoff,
@@ -158,8 +392,8 @@ def gaussian_field_for_better_quality(from_coord, to_coords, to_coord_indices, m
 def get_mix_params_info_decorator(n_iterations=1000, learning_rate=0.01, n_linspace=25):
     def find_mix_info_decorator(params_function):
         @functools.wraps(params_function)
-        def params_with_info(*args):
-            mix_params = params_function(*args)
+        def params_with_info(*args, **kwargs):
+            mix_params = params_function(*args, **kwargs)
 
             # First gradient descent to the actual minima
             minima_positions = mix_params['minima_guess']
@@ -128,12 +128,19 @@ def even_simplerer():
     }
 
 @get_mix_params_info_decorator()
-def randomly_generated(n_dims, n_maximas):
+def randomly_generated(n_dims, n_maximas, seed=None):
+    """
+    Two minima with randomly placed maxima around them
+    :param seed:
+        (Optional) Seed for the maxima, so the same mixture is made every time without touching the global
+        np.random state. By default the global np.random state is used.
+    """
+    random_state = np.random if seed is None else np.random.RandomState(seed)
     centres = np.array([
         [-0.1] + [0]*(n_dims-1),
         [1.1] + [0]*(n_dims-1)
-    ] + np.random.random((n_maximas, n_dims)).tolist()).T
-    centres[1:, 2:] = np.random.randn(*centres[1:, 2:].shape)*0.75
+    ] + random_state.random_sample((n_maximas, n_dims)).tolist()).T
+    centres[1:, 2:] = random_state.randn(*centres[1:, 2:].shape)*0.75
     return {
         'magnitude': np.array([-1, -1] + [1]*n_maximas),
         'sigma': np.array([0.2]*(n_maximas+2)),
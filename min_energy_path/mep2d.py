@@ -5,9 +5,9 @@ import logging
 
 from min_energy_path.gaussian_field import plot_gaussian, gaussian_field
 import min_energy_path.gaussian_params as gauss_params
-from min_energy_path.points_sphere import create_sphere_points
 from min_energy_path.path_helpers import (get_standard_transition_quality_function, get_good_path_start_samples, calculate_good_paths,
-                                          breakdown_good_path, generate_path_ftree_better)
+                                          breakdown_good_path)
+from min_energy_path.pipeline import MEPPipeline
 from min_energy_path import neb
 
 logging.basicConfig(level=logging.INFO)
@@ -19,20 +19,28 @@ start_time = time.time()
 # First set up some constants we're going to need
 N_SPANNING_GAP = 14
 
+LENGTH_CUTOFF = 3
+N_SLICES_BEHIND, N_SLICES_AHEAD = 0, 1
+# The stages are cached here, so running again only redoes the stages whose inputs changed
+pipeline = MEPPipeline('pipeline_cache')
+
 # Constants relating to the gaussian field
-MIX_PARAMS = gauss_params.starter()
+MIX_PARAMS, key = pipeline.mixture(gauss_params.starter)
 
-POINTS_INFO = create_sphere_points(MIX_PARAMS['minima_coords'], N_SPANNING_GAP)
+POINTS_INFO, key = pipeline.points(MIX_PARAMS, key, N_SPANNING_GAP)
+field_tables, key = pipeline.field_tables(POINTS_INFO, MIX_PARAMS, key, LENGTH_CUTOFF)
+transition_components, key = pipeline.transitions(POINTS_INFO, MIX_PARAMS, field_tables, key, LENGTH_CUTOFF,
+                                                  N_SLICES_BEHIND, N_SLICES_AHEAD)
 
-ftree = generate_path_ftree_better(
-    POINTS_INFO, MIX_PARAMS,
-    length_cutoff=3,
+ftree = pipeline.ftree(
+    POINTS_INFO, MIX_PARAMS, transition_components,
+    length_cutoff=LENGTH_CUTOFF,
     tuning_dist=0.02,
     tuning_strength=1,
     tuning_strength_diff=1.5,
     n_spanning_gap=N_SPANNING_GAP,
-    n_slices_behind=0,
-    n_slices_ahead=1
+    n_slices_behind=N_SLICES_BEHIND,
+    n_slices_ahead=N_SLICES_AHEAD
 )
 
 raise Exception('oop')
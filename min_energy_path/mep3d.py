@@ -7,9 +7,9 @@ import logging
 from min_energy_path import neb
 from min_energy_path.path_helpers import (get_standard_transition_quality_function, get_good_path_start_samples,
                                           calculate_good_paths,
-                                          generate_path_ftree, breakdown_good_path, generate_path_ftree_better)
+                                          generate_path_ftree, breakdown_good_path)
 import min_energy_path.gaussian_params as mix_params
-from min_energy_path.points_sphere import create_sphere_points
+from min_energy_path.pipeline import MEPPipeline
 
 
 logging.basicConfig(level=logging.INFO)
@@ -20,10 +20,18 @@ start_time = time.time()
 # First set up some constants we're going to need
 N_SPANNING_GAP = 7
 
-# Constants relating to the gaussian field
-MIX_PARAMS = mix_params.randomly_generated(3, 4)
+LENGTH_CUTOFF = 4
+N_SLICES_BEHIND, N_SLICES_AHEAD = 1, 2
+# The stages are cached here, so running again only redoes the stages whose inputs changed
+pipeline = MEPPipeline('pipeline_cache')
 
-POINTS_INFO = create_sphere_points(MIX_PARAMS['minima_coords'], N_SPANNING_GAP)
+# Constants relating to the gaussian field, seeded so the mixture can be cached
+MIX_PARAMS, key = pipeline.mixture(mix_params.randomly_generated, 3, 4, seed=0)
+
+POINTS_INFO, key = pipeline.points(MIX_PARAMS, key, N_SPANNING_GAP)
+field_tables, key = pipeline.field_tables(POINTS_INFO, MIX_PARAMS, key, LENGTH_CUTOFF)
+transition_components, key = pipeline.transitions(POINTS_INFO, MIX_PARAMS, field_tables, key, LENGTH_CUTOFF,
+                                                  N_SLICES_BEHIND, N_SLICES_AHEAD)
 
 # Plot the space we're exploring
 # fig = plt.figure()
@@ -48,15 +56,15 @@ POINTS_INFO = create_sphere_points(MIX_PARAMS['minima_coords'], N_SPANNING_GAP)
 #     n_slices_ahead=2
 # )
 
-ftree = generate_path_ftree_better(
-    POINTS_INFO, MIX_PARAMS,
-    length_cutoff=4,
+ftree = pipeline.ftree(
+    POINTS_INFO, MIX_PARAMS, transition_components,
+    length_cutoff=LENGTH_CUTOFF,
     tuning_dist=0.01,
     tuning_strength=1,
     tuning_strength_diff=2,
     n_spanning_gap=N_SPANNING_GAP,
-    n_slices_behind=1,
-    n_slices_ahead=2
+    n_slices_behind=N_SLICES_BEHIND,
+    n_slices_ahead=N_SLICES_AHEAD
 )
 
 
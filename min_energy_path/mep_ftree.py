@@ -1,7 +1,11 @@
+import numpy as np
+
 from structured_dpp.factor_tree import Factor, MaxProductRun, Variable
 from structured_dpp.semiring import MaxProductValue
+from structured_dpp.instrumentation import count, is_recording
 
-from min_energy_path.points_sphere import get_nearby_sphere_indexes
+from min_energy_path.points_sphere import get_neighbour_adjacency, get_neighbour_window
+from min_energy_path.transition_qualities import TransitionQualities, concatenate_ranges
 
 
 def for_debugging_plot(from_possible_values, fromm, to, value_of_to, factor):
@@ -25,19 +29,69 @@ def for_debugging_plot(from_possible_values, fromm, to, value_of_to, factor):
     plt.scatter(*factor.points_info['sphere'][:, assignment_weights_gt_0], c='y')
 
 
+def sparse_max_product(indptr, indices, data, rows, incoming, in_domain):
+    """
+    For each row in rows, finds the maximum of weight * incoming over the entries of that row of a CSR matrix
+    whose column is in the domain, along with the column giving the maximum.
+    Ties go to the largest column.
+    :param rows:
+        Array of the rows to calculate
+    :param incoming:
+        Array (n_points,) of the incoming message for each column
+    :param in_domain:
+        Boolean array (n_points,), whether the column can be chosen
+    :return:
+        maxima (n rows,), argmax columns (n rows,) which are -1 for rows with no entry in the domain
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    segment_starts = np.cumsum(lengths) - lengths
+    n_entries = np.sum(lengths)
+
+    # Gather all the entries in the rows
+    positions, segment_ids = concatenate_ranges(starts, indptr[rows + 1])
+    cols = indices[positions]
+    products = np.where(in_domain[cols], data[positions] * incoming[cols], -1.)
+
+    maxima = np.full(rows.size, -1.)
+    argmax = np.full(rows.size, -1)
+    non_empty = lengths > 0
+    if n_entries > 0:
+        maxima[non_empty] = np.maximum.reduceat(products, segment_starts[non_empty])
+        # The position of the last entry equal to the maximum of its row
+        is_max_positions = np.where(products == maxima[segment_ids], np.arange(n_entries), -1)
+        argmax[non_empty] = cols[np.maximum.reduceat(is_max_positions, segment_starts[non_empty])]
+    no_entry = maxima < 0
+    maxima[no_entry] = 0
+    argmax[no_entry] = -1
+    return maxima, argmax
+
+
 class MEPFactor(Factor):
     """
     A factor node for the *very specific case* where the factor is an intermediate node between two variables
     representing two points on a path, using all of the other stuff in the min_energy_path module.
     """
-    def __init__(self, transition_qualities: dict, length_cutoff, n_slices_behind, n_slices_ahead, points_info,
-                 parent=None, children=None, name=None):
+    __slots__ = ('transition_qualities', 'length_cutoff', 'n_slices_behind', 'n_slices_ahead', 'points_info')
+
+    def __init__(self, transition_qualities: TransitionQualities, length_cutoff, n_slices_behind, n_slices_ahead,
+                 points_info, parent=None, children=None, name=None):
+        """
+        :param transition_qualities:
+            See generate_transition_qualities. A dictionary of dictionaries is converted to a TransitionQualities,
+            pass the TransitionQualities in instead to share it between factors.
+        """
         super(MEPFactor, self).__init__(lambda *args: None, parent, children, name)
+        if isinstance(transition_qualities, dict):
+            transition_qualities = TransitionQualities.from_dict(transition_qualities,
+                                                                 len(points_info['sphere_index']))
         self.transition_qualities = transition_qualities
         self.length_cutoff = length_cutoff
         self.n_slices_behind = n_slices_behind
         self.n_slices_ahead = n_slices_ahead
         self.points_info = points_info
+        # Shared between all the factors using points_info, so only made once
+        get_neighbour_adjacency(points_info, length_cutoff)
 
     def get_weight(self, assignments, run=None):
         # Remember that the parent is closer to the root
@@ -50,13 +104,13 @@ class MEPFactor(Factor):
 
         # Work out what set of points this value can reach
         # Changes depending on whether we're going rootwards or leafwards
-        from_possible_values = get_nearby_sphere_indexes(
-            value_of_to, self.length_cutoff, self.points_info,
-            # to == self.parent ==> to is rootwards ==> from is leafwards
-            # to != self.parent ==> to is leafwards ==> from is rootwards
-            min_dir_index=fromm.slice_start,
-            max_dir_index=fromm.slice_end
+        # to == self.parent ==> to is rootwards ==> from is leafwards
+        # to != self.parent ==> to is leafwards ==> from is rootwards
+        from_possible_values = get_neighbour_window(
+            value_of_to, self.points_info, min_dir_index=fromm.slice_start, max_dir_index=fromm.slice_end
         )
+        if from_possible_values.size == 0:  # Nothing in reach, so no path can go through this value
+            return MaxProductValue(0, {fromm: fromm.allowed_values[0], to: value_of_to})
 
         for value_of_from in from_possible_values:
             assignment_weight = (
@@ -72,6 +126,53 @@ class MEPFactor(Factor):
 
         return message
 
+    def get_transition_csr(self, rootwards=True):
+        """
+        Get the transition qualities as a sparse matrix in CSR form.
+        :param rootwards:
+            If True the rows are the rootwards points (transition_qualities[row][column]),
+            otherwise it is transposed so the rows are the leafwards points.
+        """
+        if rootwards:
+            return self.transition_qualities.csr
+        return self.transition_qualities.transposed()
+
+    def create_all_messages_special(self, to, fromm, run=None):
+        """
+        Create the max product messages to every value of to at once.
+        Each message is the maximum over the transitions of the transition quality times the incoming message,
+        worked out for all the values together with sparse_max_product.
+        """
+        n_points = len(self.points_info['sphere_index'])
+        incoming_messages = fromm.outgoing_messages[run][self]
+        from_values = np.fromiter(incoming_messages.keys(), dtype=int, count=len(incoming_messages))
+        incoming = np.zeros(n_points)
+        incoming[from_values] = np.fromiter(
+            (m.v if isinstance(m, MaxProductValue) else m for m in incoming_messages.values()),
+            dtype=float, count=len(incoming_messages)
+        )
+        in_domain = np.zeros(n_points, dtype=bool)
+        in_domain[from_values] = True
+
+        to_values = np.asarray(to.allowed_values)
+        # to == self.parent ==> to is rootwards, so the rows of the matrix should be rootwards
+        indptr, indices, data = self.get_transition_csr(rootwards=to == self.parent)
+        maxima, argmax = sparse_max_product(indptr, indices, data, to_values, incoming, in_domain)
+        if is_recording():
+            # Every transition scanned is an assignment of the two variables with its weight looked up
+            n_scanned = int(np.sum(indptr[to_values + 1] - indptr[to_values]))
+            count('mep_factor_messages', to_values.size)
+            count('mep_factor_transitions_scanned', n_scanned)
+            count('assignments', n_scanned)
+            count('weight_evaluations', n_scanned)
+
+        # Values nothing can reach from can't be on a path
+        argmax[argmax < 0] = from_values[0]
+        return {
+            value_of_to: MaxProductValue(message_value, {fromm: value_of_from, to: value_of_to})
+            for value_of_to, message_value, value_of_from in zip(to_values, maxima.tolist(), argmax)
+        }
+
     def create_all_messages_to(self, to, run=None):
         parent = self.parent
         fromm: Variable = next(iter(self.children)) if to == parent else parent
@@ -81,14 +182,14 @@ class MEPFactor(Factor):
         if self.outgoing_messages.get(run, None) is None:
             self.outgoing_messages[run] = {}
 
-        new_messages = {
-            val: self.create_message_special(to, val, parent, run=run) for val in to.allowed_values
-        }
+        new_messages = self.create_all_messages_special(to, fromm, run=run)
         self.outgoing_messages[run][to] = new_messages
         return new_messages
 
 
 class MEPVariable(Variable):
+    __slots__ = ('slice_start', 'slice_end')
+
     def __init__(self, allowed_values, slice_start, slice_end, parent=None, children=None, name=None):
         self.slice_start = slice_start
         self.slice_end = slice_end
@@ -0,0 +1,94 @@
+import numpy as np
+import scipy.linalg as scila
+import logging
+
+from min_energy_path.points_sphere import create_sphere_points, restrict_points
+from min_energy_path.path_helpers import (generate_path_ftree_better, get_good_path_start_samples,
+                                          calculate_good_paths, prune_points)
+
+
+logger = logging.getLogger(__name__)
+
+
+def distance_to_paths(points, paths):
+    """
+    The distance from each point to the nearest of a number of paths made of straight line segments.
+    :param points:
+        Matrix (d dimensions, n points) of column vectors of the points
+    :param paths:
+        List of matrices (d dimensions, n path points), the points along each path
+    :return:
+        Vector (n points,) of the distances
+    """
+    distances = np.full(points.shape[1], np.inf)
+    for path in paths:
+        for start, end in zip(path.T[:-1], path.T[1:]):
+            segment = end - start
+            segment_length_sq = segment @ segment
+            # How far along the segment the nearest point is
+            along = np.zeros(points.shape[1]) if segment_length_sq == 0 else \
+                np.clip(segment @ (points - start[:, np.newaxis]) / segment_length_sq, 0, 1)
+            nearest = start[:, np.newaxis] + segment[:, np.newaxis] * along[np.newaxis, :]
+            distances = np.minimum(distances, scila.norm(points - nearest, axis=0))
+    return distances
+
+
+def find_paths_coarse_to_fine(mix_params, n_spanning_gaps=(5, 9, 17), n_paths=3, tube_radius=1.5, n_per_group=4,
+                              length_cutoff=3, tuning_dist=0.02, tuning_strength=1, tuning_strength_diff=1.5,
+                              n_slices_behind=1, n_slices_ahead=2, shrink_in_direction=1.0,
+                              prune_strength_margin=None):
+    """
+    Finds good paths between the minima at increasing resolutions.
+    The first resolution uses the whole sphere of points, every finer resolution only uses the points of its sphere
+    that are in a tube around the best paths found at the resolution before it,
+    which is much cheaper than using the whole fine sphere.
+    :param mix_params:
+        The parameters of the gaussian field, with the minima_coords
+    :param n_spanning_gaps:
+        The n_spanning_gap of each resolution, coarsest first
+    :param n_paths:
+        The number of best paths to find at each resolution, the tube is around all of them
+    :param tube_radius:
+        The radius of the tube around the paths, in units of the point_distance of the resolution the paths were found at
+    :param n_per_group:
+        See get_good_path_start_samples
+    :param prune_strength_margin:
+        (Optional) If given, the points at each resolution are also pruned with prune_points using this strength_margin
+    :return:
+        A list with a dictionary for each resolution, with keys n_spanning_gap, points_info, ftree, and paths,
+        a list of path infos (see calculate_good_paths) of the best paths, best first
+    """
+    levels = []
+    for n_spanning_gap in n_spanning_gaps:
+        logger.info(f'Finding paths with n_spanning_gap {n_spanning_gap}')
+        points_info = create_sphere_points(mix_params['minima_coords'], n_spanning_gap,
+                                           shrink_in_direction=shrink_in_direction)
+        if levels:
+            coarse = levels[-1]
+            in_tube = distance_to_paths(
+                points_info['sphere'], [path_info['path'] for path_info in coarse['paths']]
+            ) <= tube_radius * coarse['points_info']['point_distance']
+            in_tube[[points_info['root_index'], points_info['tail_index']]] = True
+            points_info = restrict_points(points_info, in_tube)
+        if prune_strength_margin is not None:
+            points_info = prune_points(points_info, mix_params, length_cutoff, strength_margin=prune_strength_margin)
+
+        ftree = generate_path_ftree_better(
+            points_info, mix_params, length_cutoff, tuning_dist, tuning_strength, tuning_strength_diff,
+            n_spanning_gap=n_spanning_gap, n_slices_behind=n_slices_behind, n_slices_ahead=n_slices_ahead
+        )
+        variables = list(ftree.get_variables())
+        var_middle = variables[(len(variables) // 2) - 1]
+        traversal, run = ftree.run_max_quality_forward(var_middle)
+
+        # The best paths through different parts of the middle variable
+        good_paths_start = get_good_path_start_samples(var_middle, run, points_info, n_per_group=n_per_group)
+        best_groups = sorted(good_paths_start, key=lambda group: good_paths_start[group][1], reverse=True)[:n_paths]
+        paths = calculate_good_paths({group: good_paths_start[group] for group in best_groups},
+                                     var_middle, traversal, run, ftree, points_info)
+
+        levels.append({'n_spanning_gap': n_spanning_gap,
+                       'points_info': points_info,
+                       'ftree': ftree,
+                       'paths': paths})
+    return levels
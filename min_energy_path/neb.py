@@ -9,6 +9,7 @@ import scipy.linalg as scila
 import logging
 
 import min_energy_path.gaussian_field as gf
+from structured_dpp.instrumentation import timed, span, count
 
 
 logger = logging.getLogger(__name__)
@@ -23,7 +24,9 @@ def plot_paths_and_tangents(path, tangent, scale=5, width=0.025):
     plt.show()
 
 
-def neb(path_guess, mix_params, force_cutoff=10**-5, n_max_iterations=8000, k=1., time_step=1.e-2, return_force_history=False):
+def neb(path_guess, mix_params, force_cutoff=10**-5, n_max_iterations=8000, k=1., time_step=1.e-2, return_force_history=False,
+        optimizer='quick_min', max_step=0.05, climbing_image=False, barrier_cutoff=None, n_barrier_iterations=20,
+        neighbour_skin=None):
     """
     Performs the NEB algorithm
     :param np.ndarray path_guess:
@@ -37,109 +40,506 @@ def neb(path_guess, mix_params, force_cutoff=10**-5, n_max_iterations=8000, k=1.
     :param k:
         The spring force component
     :param time_step:
-        The size of the step to take during an interation
+        The size of the step to take during an interation, for FIRE the starting time step
     :param return_force_history:
         If True returns the force L2 norm for each iteration
+    :param optimizer:
+        How the points are moved by the forces, see OPTIMIZERS
+        - 'quick_min': velocity projected onto the force with a fixed time step
+        - 'fire': the fast inertial relaxation engine, with an adaptive time step
+        - 'lbfgs': limited memory BFGS using the force as the negative gradient
+    :param max_step:
+        For 'fire' and 'lbfgs', the furthest any point can move in one iteration
+    :param climbing_image:
+        If True the highest energy point climbs up to the saddle point, so the barrier is found accurately
+        without needing points packed around it
+    :param barrier_cutoff:
+        (Optional) If given the path also quits once the barrier, the highest energy on the path,
+        has changed by less than this over the last n_barrier_iterations
+    :param n_barrier_iterations:
+        See barrier_cutoff
+    :param neighbour_skin:
+        (Optional) If given the field at each point is only calculated from the gaussians near it, using neighbour
+        lists with this skin that are only made again when the point has moved further than it,
+        see gf.GaussianNeighbourLists. Much quicker for mixtures of many gaussians.
     :return:
     """
-    logger.info('Starting neb run')
+    paths, force_histories = neb_batch([path_guess], mix_params, force_cutoff, n_max_iterations, k, time_step,
+                                       return_force_history=True, optimizer=optimizer, max_step=max_step,
+                                       climbing_image=climbing_image, barrier_cutoff=barrier_cutoff,
+                                       n_barrier_iterations=n_barrier_iterations, neighbour_skin=neighbour_skin)
+    if return_force_history:
+        return paths[0], force_histories[0]
+    return paths[0]
 
-    path = path_guess.copy()
 
-    velocity = np.zeros((path.shape[0], path.shape[1]-2))
-    old_force = np.zeros_like(velocity)
+def _pad_paths(paths):
+    """
+    Stacks paths with different numbers of points into a (n paths, d dimensions, max n points) tensor,
+    padding the end of shorter paths with their last point.
+    :return:
+        The tensor, and a vector of the number of points in each path
+    """
+    n_points = np.array([path.shape[1] for path in paths])
+    stacked = np.empty((len(paths), paths[0].shape[0], np.max(n_points)))
+    for i, path in enumerate(paths):
+        stacked[i, :, :path.shape[1]] = path
+        stacked[i, :, path.shape[1]:] = path[:, -1:]
+    return stacked, n_points
 
-    force_history = []
 
-    tangents = np.zeros((path.shape[0], path.shape[1]-2))
+def _interior_mask(n_points, max_n_points):
+    """Boolean tensor (n paths, 1, max n points - 2) of the interior points, that move, of each padded path"""
+    return (np.arange(1, max_n_points-1)[np.newaxis, :] < (n_points - 1)[:, np.newaxis])[:, np.newaxis, :]
 
-    for i in range(n_max_iterations):
-        # Calculate the energy at each point
-        coords_transformed = gf.transform_coords(path, mix_params)
+
+def neb_forces(paths, mix_params, k=1., interior=None, climbing=None, neighbours=None):
+    """
+    The NEB forces on the interior points of a number of paths: the spring force along the tangent of the path
+    and the gradient of the field orthogonal to it.
+    The field is evaluated for every point of every path together.
+    :param paths:
+        Tensor (n paths, d dimensions, n points), see _pad_paths for paths with different numbers of points
+    :param k:
+        The spring force component
+    :param interior:
+        (Optional) Boolean tensor (n paths, 1, n points - 2) of which points are interior points of their path,
+        see _interior_mask. Forces on other points are 0.
+    :param climbing:
+        (Optional) Boolean vector (n paths,) of the paths whose highest energy interior point is a climbing image,
+        which has no spring force and the tangential gradient reversed so that it climbs up to the saddle point
+    :param neighbours:
+        (Optional) Matrix (n paths * n points, k) of the gaussians near each point, path by path, padded with -1,
+        see gf.GaussianNeighbourLists. The field is only calculated from these gaussians, rather than all of them.
+    :return:
+        Tensor (n paths, d dimensions, n points - 2) of the forces,
+        matrix (n paths, n points) of the energy of every point,
+        and a boolean vector (n paths,) of the paths where a tangent couldn't be found, as two points are on each other
+    """
+    n_paths, dimensions, n_points = paths.shape
+    if interior is None:
+        interior = np.ones((n_paths, 1, n_points-2), dtype=bool)
+
+    # Calculate the energy at each point of every path with one call
+    coords = paths.transpose(1, 0, 2).reshape(dimensions, n_paths*n_points)
+    if neighbours is None:
+        coords_transformed = gf.transform_coords(coords, mix_params)
         field_strength = gf._field_strength(coords_transformed, mix_params)
-        path_energies = np.sum(field_strength, axis=1)
-
-        # Calculate the tangents
-        tip = path[:, 2:] - path[:, 1:-1]  # Tangent by difference to element in front
-        tim = path[:, 1:-1] - path[:, :-2]  # Tangent by difference to element behind
-        # From element 0 to n-1 is the next element bigger
-        # Also from element 1 to n is the previous element smaller
-        next_bigger = path_energies[:-1] < path_energies[1:]
-
-        energy_increasing = next_bigger[1:] & next_bigger[:-1]  # From element 1 to n-1 is E{i-1} < E{i} < E{i+1}
-        tangents[:, energy_increasing] = tip[:, energy_increasing]
-
-        energy_decreasing = (~next_bigger[1:]) & (~next_bigger[:-1])  # From element 1 to n-1 is E{i-1} > E{i} > E{i+1}
-        tangents[:, energy_decreasing] = tim[:, energy_decreasing]
-
-        # Critical points have a slightly different formula
-        # From element 1 to n-1 is it a max or min to its neighbors
-        at_critical = (~energy_increasing) & (~energy_decreasing)
-        # From element 1 to n-1 that are critical points the abs difference to the next element
-        next_next_bigger = path_energies[:-2] < path_energies[2:]  # From element 1 to n-1 is E{i-1} < E{i+1}
-        # Difference of critical points to point after
-        delta_e_forward = np.abs(path_energies[1:-1][at_critical] - path_energies[2:][at_critical])
-        delta_e_back = np.abs(path_energies[1:-1][at_critical] - path_energies[:-2][at_critical])
-        delta_e_table = np.array([delta_e_forward,
-                                  delta_e_back])
-        delta_e_max = np.max(delta_e_table, axis=0)
-        delta_e_min = np.min(delta_e_table, axis=0)
-        tangents[:, at_critical & next_next_bigger] = (
-                tip[:, at_critical & next_next_bigger]*delta_e_max[np.newaxis, next_next_bigger[at_critical]] +
-                tim[:, at_critical & next_next_bigger]*delta_e_min[np.newaxis, next_next_bigger[at_critical]]
-        )
-        tangents[:, at_critical & (~next_next_bigger)] = (
-                tip[:, at_critical & (~next_next_bigger)]*delta_e_min[np.newaxis, ~next_next_bigger[at_critical]] +
-                tim[:, at_critical & (~next_next_bigger)]*delta_e_max[np.newaxis, ~next_next_bigger[at_critical]]
+    else:
+        coords_transformed, field_strength, sigma = gf._near_field_strength(coords, mix_params, neighbours)
+    path_energies = np.sum(field_strength, axis=1).reshape(n_paths, n_points)
+
+    # Calculate the tangents
+    tip = paths[:, :, 2:] - paths[:, :, 1:-1]  # Tangent by difference to element in front
+    tim = paths[:, :, 1:-1] - paths[:, :, :-2]  # Tangent by difference to element behind
+    # From element 0 to n-1 is the next element bigger
+    # Also from element 1 to n is the previous element smaller
+    next_bigger = path_energies[:, :-1] < path_energies[:, 1:]
+
+    energy_increasing = next_bigger[:, 1:] & next_bigger[:, :-1]  # From element 1 to n-1 is E{i-1} < E{i} < E{i+1}
+    energy_decreasing = (~next_bigger[:, 1:]) & (~next_bigger[:, :-1])  # From element 1 to n-1 is E{i-1} > E{i} > E{i+1}
+
+    # Critical points (a max or min to their neighbors) have a slightly different formula
+    next_next_bigger = path_energies[:, :-2] < path_energies[:, 2:]  # From element 1 to n-1 is E{i-1} < E{i+1}
+    delta_e_forward = np.abs(path_energies[:, 1:-1] - path_energies[:, 2:])
+    delta_e_back = np.abs(path_energies[:, 1:-1] - path_energies[:, :-2])
+    delta_e_max = np.maximum(delta_e_forward, delta_e_back)[:, np.newaxis, :]
+    delta_e_min = np.minimum(delta_e_forward, delta_e_back)[:, np.newaxis, :]
+    tangents = np.where(
+        energy_increasing[:, np.newaxis, :], tip, np.where(
+            energy_decreasing[:, np.newaxis, :], tim, np.where(
+                next_next_bigger[:, np.newaxis, :],
+                tip*delta_e_max + tim*delta_e_min,
+                tip*delta_e_min + tim*delta_e_max
+            )
         )
-        tang_norm = scila.norm(tangents, axis=0, keepdims=True)
-        if np.any(tang_norm < 1e-20):
-            logger.error(f"Tangent norm less than 1e-20 returning early after {i+1} iterations")
-            if return_force_history:
-                return path, force_history
-            return path
-        tangents /= scila.norm(tangents, axis=0, keepdims=True)  # TODO: What if two points land on each other?
-
-        # Calculate the distance between the points
-        transitions = path[:, 1:] - path[:, :-1]
-        point_distances = scila.norm(transitions, axis=0, keepdims=True)
-
-        # Spring force component!
-        spring_component = k*(point_distances[:, 1:] - point_distances[:, :-1])*tangents
-
-        # Tangential gradient component
-        gradients = gf._gaussian_grad(coords_transformed[:, 1:-1, :], field_strength[1:-1, :], mix_params)
-        orth_grad_component = gradients - np.sum(gradients * tangents, axis=0, keepdims=True)*tangents
-
-        # Apply forces using gradient
-        force = spring_component - orth_grad_component
-        force_l2 = scila.norm(force)
-        force_history.append(force_l2)
-        if force_l2 < force_cutoff:
-            logger.info(f'Finished NEB from force cutoff after {i+1} iterations')
-            if return_force_history:
-                return path, force_history
-            return path
-
-        force_velocity = velocity * force
-        if np.sum(force_velocity) > 0:
-            velocity = force_velocity * force / scila.norm(force)**2
-            velocity += (old_force+force) / 2.
-        else:
-            velocity = (old_force + force) / 2.
+    )
+    tang_norm = np.where(interior, scila.norm(tangents, axis=1, keepdims=True), 1.)
+    collapsed = np.any(tang_norm < 1e-20, axis=(1, 2))
+    tangents /= np.where(tang_norm < 1e-20, 1., tang_norm)
+
+    # Calculate the distance between the points
+    transitions = paths[:, :, 1:] - paths[:, :, :-1]
+    point_distances = scila.norm(transitions, axis=1, keepdims=True)
+
+    # Spring force component!
+    spring_component = k*(point_distances[:, :, 1:] - point_distances[:, :, :-1])*tangents
+
+    # Tangential gradient component
+    interior_coords_transformed = coords_transformed.reshape(dimensions, n_paths, n_points, -1)[:, :, 1:-1, :].reshape(
+        dimensions, n_paths*(n_points-2), -1)
+    interior_field_strength = field_strength.reshape(n_paths, n_points, -1)[:, 1:-1, :].reshape(
+        n_paths*(n_points-2), -1)
+    if neighbours is None:
+        gradients = gf._gaussian_grad(interior_coords_transformed, interior_field_strength, mix_params)
+    else:
+        gradients = gf._near_gaussian_grad(interior_coords_transformed, interior_field_strength,
+                                           sigma.reshape(n_paths, n_points, -1)[:, 1:-1, :].reshape(
+                                               n_paths*(n_points-2), -1))
+    gradients = gradients.reshape(dimensions, n_paths, n_points-2).transpose(1, 0, 2)
+    orth_grad_component = gradients - np.sum(gradients * tangents, axis=1, keepdims=True)*tangents
+    force = spring_component - orth_grad_component
+
+    if climbing is not None and np.any(climbing):
+        climbing_paths = np.flatnonzero(climbing)
+        climbing_points = np.argmax(np.where(interior[climbing_paths, 0, :],
+                                             path_energies[climbing_paths, 1:-1], -np.inf), axis=1)
+        gradient = gradients[climbing_paths, :, climbing_points]
+        tangent = tangents[climbing_paths, :, climbing_points]
+        force[climbing_paths, :, climbing_points] = \
+            2*np.sum(gradient * tangent, axis=1, keepdims=True)*tangent - gradient
+
+    return np.where(interior, force, 0.), path_energies, collapsed
+
+
+def neb_force(path, mix_params, k=1.):
+    """
+    The NEB force on the interior points of one path, see neb_forces
+    :param path:
+        Matrix (d dimensions, n points)
+    :return:
+        Matrix (d dimensions, n points - 2)
+    """
+    return neb_forces(path[np.newaxis, :, :], mix_params, k)[0][0]
+
+
+class QuickMinOptimizer:
+    """
+    Moves the points with a velocity that only keeps the part in the direction of the force, with a fixed time step.
+    Every optimizer keeps its state for every path, and is stepped for some of the paths at a time.
+    """
+    def __init__(self, shape, time_step, max_step=None):
+        self.time_step = time_step
+        self.velocity = np.zeros(shape)
+        self.old_force = np.zeros(shape)
+
+    def step(self, path_indices, positions, force):
+        """
+        :param path_indices:
+            The paths to step
+        :param positions:
+            Tensor (n paths to step, d dimensions, n points - 2) of the interior points of the paths
+        :param force:
+            Tensor the same shape as positions of the forces
+        :return:
+            The displacement of the points
+        """
+        force_sq = np.sum(force**2, axis=(1, 2))
+        force_velocity = self.velocity[path_indices] * force
+        moving_with_force = (np.sum(force_velocity, axis=(1, 2)) > 0)[:, np.newaxis, np.newaxis]
+        velocity = (self.old_force[path_indices] + force) / 2.
+        velocity += np.where(moving_with_force,
+                             force_velocity * force / np.where(force_sq > 0, force_sq, 1.)[:, np.newaxis, np.newaxis],
+                             0.)
+        self.velocity[path_indices] = velocity
+        self.old_force[path_indices] = force
+        return velocity * self.time_step
+
+
+def _limit_step(displacement, max_step):
+    """Scales the displacement of each path so that no point moves further than max_step"""
+    longest = np.max(scila.norm(displacement, axis=1), axis=1)
+    return displacement * np.minimum(1., max_step / np.where(longest > 0, longest, 1.))[:, np.newaxis, np.newaxis]
+
+
+class FIREOptimizer:
+    """
+    The fast inertial relaxation engine (Bitzek et al. 2006).
+    Molecular dynamics where the velocity is steered towards the force, with the time step growing while the
+    velocity is going with the force, and the velocity being stopped when it goes against it.
+    """
+    def __init__(self, shape, time_step, max_step=0.05, time_step_max_factor=10., n_min=5, f_increase=1.1,
+                 f_decrease=0.5, alpha_start=0.1, f_alpha=0.99):
+        self.time_step_max = time_step * time_step_max_factor
+        self.max_step = max_step
+        self.n_min, self.f_increase, self.f_decrease = n_min, f_increase, f_decrease
+        self.alpha_start, self.f_alpha = alpha_start, f_alpha
+
+        self.velocity = np.zeros(shape)
+        self.time_step = np.full(shape[0], time_step)
+        self.alpha = np.full(shape[0], alpha_start)
+        self.n_with_force = np.zeros(shape[0], dtype=int)
+
+    def step(self, path_indices, positions, force):
+        """See QuickMinOptimizer.step"""
+        velocity = self.velocity[path_indices]
+        time_step, alpha = self.time_step[path_indices], self.alpha[path_indices]
+        n_with_force = self.n_with_force[path_indices]
+
+        power = np.sum(force * velocity, axis=(1, 2))
+        velocity_norm = np.sqrt(np.sum(velocity**2, axis=(1, 2)))
+        force_norm = np.sqrt(np.sum(force**2, axis=(1, 2)))
+        mix = (alpha * velocity_norm / np.where(force_norm > 0, force_norm, 1.))[:, np.newaxis, np.newaxis]
+        velocity = (1 - alpha)[:, np.newaxis, np.newaxis] * velocity + mix * force
+
+        with_force = power > 0
+        speed_up = with_force & (n_with_force > self.n_min)
+        time_step = np.where(speed_up, np.minimum(time_step * self.f_increase, self.time_step_max), time_step)
+        alpha = np.where(speed_up, alpha * self.f_alpha, alpha)
+        n_with_force = np.where(with_force, n_with_force + 1, 0)
+        # Going against the force, stop and slow down
+        velocity[~with_force] = 0
+        time_step = np.where(with_force, time_step, time_step * self.f_decrease)
+        alpha = np.where(with_force, alpha, self.alpha_start)
+
+        # Semi implicit Euler step
+        velocity += time_step[:, np.newaxis, np.newaxis] * force
+        displacement = _limit_step(time_step[:, np.newaxis, np.newaxis] * velocity, self.max_step)
+
+        self.velocity[path_indices] = velocity
+        self.time_step[path_indices], self.alpha[path_indices] = time_step, alpha
+        self.n_with_force[path_indices] = n_with_force
+        return displacement
+
+
+class LBFGSOptimizer:
+    """
+    Limited memory BFGS with the NEB force as the negative gradient.
+    The NEB force isn't the gradient of any energy, so there is no line search. Instead each point moves at most
+    max_step, and the memory is cleared whenever the last step went past the minimum along it or the force jumped up.
+    """
+    def __init__(self, shape, time_step, max_step=0.05, memory=10, initial_curvature=70.):
+        """
+        :param initial_curvature:
+            The guess of the curvature used to scale the steps when there is no memory
+        """
+        self.max_step = max_step
+        self.memory = memory
+        self.scale = 1 / initial_curvature
+        self.histories = [[] for _ in range(shape[0])]
+        self.previous = [None] * shape[0]
+
+    def _direction(self, history, force):
+        """The L-BFGS two loop recursion for the step direction -H g, where the gradient g is -force"""
+        q = -force
+        alphas = []
+        for s, y, rho in reversed(history):
+            alpha = rho * (s @ q)
+            q = q - alpha * y
+            alphas.append(alpha)
+        # Start from the curvature along the last step, or the guess if there isn't one
+        r = q * ((history[-1][0] @ history[-1][1]) / (history[-1][1] @ history[-1][1]) if history else self.scale)
+        for (s, y, rho), alpha in zip(history, reversed(alphas)):
+            beta = rho * (y @ r)
+            r = r + s * (alpha - beta)
+        return -r
+
+    def step(self, path_indices, positions, force):
+        """See QuickMinOptimizer.step"""
+        displacement = np.empty_like(force)
+        for i, path_index in enumerate(path_indices):
+            flat_positions, flat_force = positions[i].ravel(), force[i].ravel()
+            history = self.histories[path_index]
+            if self.previous[path_index] is not None:
+                previous_positions, previous_force = self.previous[path_index]
+                s, y = flat_positions - previous_positions, previous_force - flat_force
+                if s @ flat_force < 0 or flat_force @ flat_force > 4 * (previous_force @ previous_force):
+                    # Gone past the minimum along the last step or the force jumped up,
+                    # so the curvature information can't be trusted
+                    history.clear()
+                elif s @ y > 1e-12:  # Only keep curvature information that keeps the inverse hessian positive definite
+                    history.append((s, y, 1 / (s @ y)))
+                    del history[:-self.memory]
+            direction = self._direction(history, flat_force)
+            if direction @ flat_force <= 0:
+                # Not going with the force, forget the memory
+                history.clear()
+                direction = self._direction(history, flat_force)
+            self.previous[path_index] = (flat_positions, flat_force)
+            displacement[i] = direction.reshape(force[i].shape)
+
+        # Limit each point separately, a single point with a bad step doesn't hold back the rest of the path
+        point_steps = scila.norm(displacement, axis=1, keepdims=True)
+        return displacement * np.minimum(1., self.max_step / np.where(point_steps > 0, point_steps, 1.))
+
+
+OPTIMIZERS = {'quick_min': QuickMinOptimizer, 'fire': FIREOptimizer, 'lbfgs': LBFGSOptimizer}
+
+
+@timed('neb')
+def neb_batch(path_guesses, mix_params, force_cutoff=10**-5, n_max_iterations=8000, k=1., time_step=1.e-2,
+              return_force_history=False, optimizer='quick_min', max_step=0.05, climbing_image=False,
+              barrier_cutoff=None, n_barrier_iterations=20, neighbour_skin=None):
+    """
+    Performs the NEB algorithm on a number of paths at once, with the field evaluated for every point of every path
+    together each iteration. Each path stops when it converges, independently of the others.
+    The parameters are the same as neb.
+    :param path_guesses:
+        List of matrices (d dimensions, n points) of the initial path guesses,
+        which can have different numbers of points
+    :return:
+        List of the paths, and the list of force histories if return_force_history
+    """
+    logger.info(f'Starting neb run on {len(path_guesses)} paths with {optimizer}')
+
+    paths, n_points = _pad_paths(path_guesses)
+    n_paths, dimensions, max_n_points = paths.shape
+    interior = _interior_mask(n_points, max_n_points)
+    if optimizer not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer {optimizer}, use one of {', '.join(OPTIMIZERS)}")
+    path_optimizer = OPTIMIZERS[optimizer]((n_paths, dimensions, max_n_points-2), time_step, max_step=max_step)
+
+    force_histories = [[] for _ in range(n_paths)]
+    running = np.ones(n_paths, dtype=bool)
+    force_l2 = np.full(n_paths, np.inf)
+    climbing = np.full(n_paths, climbing_image)
+    # The barrier of each path over the last n_barrier_iterations, as a ring buffer
+    barrier_history = np.full((n_paths, n_barrier_iterations), np.nan)
+    neighbour_lists = None
+    if neighbour_skin is not None:
+        neighbour_lists = gf.GaussianNeighbourLists(mix_params, n_paths*max_n_points, neighbour_skin)
+
+    for i in range(n_max_iterations):
+        active = np.flatnonzero(running)
+        if active.size == 0:
+            break
+
+        neighbours = None
+        if neighbour_lists is not None:
+            neighbours = neighbour_lists.update(
+                paths[active].transpose(1, 0, 2).reshape(dimensions, -1),
+                (active[:, np.newaxis]*max_n_points + np.arange(max_n_points)[np.newaxis, :]).ravel()
+            )
+        with span('forces'):
+            force, path_energies, collapsed = neb_forces(paths[active], mix_params, k, interior[active],
+                                                         climbing[active], neighbours)
+        count('neb_iterations')
+        count('neb_image_updates', int(np.sum(interior[active])))
+        for path_index in active[collapsed]:
+            logger.error(f"Tangent norm less than 1e-20 for path {path_index} stopping early after {i+1} iterations")
+        running[active[collapsed]] = False
+
+        force_l2[active] = np.sqrt(np.sum(force**2, axis=(1, 2)))
+        for path_index in active[~collapsed]:
+            force_histories[path_index].append(force_l2[path_index])
+        converged = (force_l2[active] < force_cutoff) & ~collapsed
+        for path_index in active[converged]:
+            logger.info(f'Finished NEB of path {path_index} from force cutoff after {i+1} iterations')
+        if barrier_cutoff is not None:
+            barrier_history[active, i % n_barrier_iterations] = np.max(
+                np.where(interior[active, 0, :], path_energies[:, 1:-1], -np.inf), axis=1
+            )
+            barrier_change = np.ptp(barrier_history[active], axis=1)  # nan until there is a full history
+            barrier_converged = (barrier_change < barrier_cutoff) & ~converged & ~collapsed
+            for path_index in active[barrier_converged]:
+                logger.info(f'Finished NEB of path {path_index} from barrier cutoff after {i+1} iterations')
+            converged |= barrier_converged
+        running[active[converged]] = False
+
+        # Only the paths that are still running move
+        moving = running[active]
+        paths[active[moving], :, 1:-1] += path_optimizer.step(
+            active[moving], paths[active[moving], :, 1:-1], force[moving]
+        ) * interior[active[moving]]
+
+    for path_index in np.flatnonzero(running):
+        logger.info(f'Finished NEB of path {path_index} from max_iterations after {n_max_iterations} iterations '
+                    f'with force {force_l2[path_index]}')
+    if neighbour_lists is not None:
+        logger.info(f'Made {neighbour_lists.n_rebuilds} neighbour lists for {n_paths*max_n_points} points')
+
+    paths = [paths[i, :, :n] for i, n in enumerate(n_points)]
+    if return_force_history:
+        return paths, force_histories
+    return paths
+
 
-        path[:, 1:-1] += velocity * time_step
+def redistribute_images(path, path_energies, spacing, energy_weight=4., min_images=3):
+    """
+    Spreads new images along a path so that they are packed closer together where the energy is high,
+    around the barrier, and further apart where it is low, with the number of images set by how long the path is.
+    The images are spaced evenly in the arc length of the path weighted by
+    1 + energy_weight * (the energy scaled between 0 at the lowest point and 1 at the highest),
+    so flat low regions have an image every spacing and the barrier has one every spacing / (1 + energy_weight).
+    :param path:
+        Matrix (d dimensions, n points) of the points on the path, the end points are kept
+    :param path_energies:
+        Vector (n points,) of the energy at each point, linearly interpolated between them
+    :param spacing:
+        The distance between images where the energy is lowest
+    :param energy_weight:
+        How much closer the images are at the barrier
+    :param min_images:
+        The fewest images in the new path, including the end points
+    :return:
+        Matrix (d dimensions, n new points) of the new path
+    """
+    energy_range = np.max(path_energies) - np.min(path_energies)
+    scaled_energies = (path_energies - np.min(path_energies)) / (energy_range if energy_range > 0 else 1.)
+    segment_lengths = scila.norm(path[:, 1:] - path[:, :-1], axis=0)
+    segment_weights = 1 + energy_weight * (scaled_energies[1:] + scaled_energies[:-1]) / 2
+    weighted_length = np.concatenate([[0], np.cumsum(segment_lengths * segment_weights)])
 
-        old_force = force
+    n_images = max(min_images, int(np.ceil(weighted_length[-1] / spacing - 1e-9)) + 1)
+    targets = np.linspace(0, weighted_length[-1], n_images)
+    new_path = np.stack([np.interp(targets, weighted_length, coords) for coords in path])
+    new_path[:, [0, -1]] = path[:, [0, -1]]
+    return new_path
 
-    logger.info(f'Finished NEB from max_iterations after {n_max_iterations} iterations with force {force_l2}')
 
+def neb_adaptive_batch(path_guesses, mix_params, spacing, energy_weight=4., n_rounds=3, n_round_iterations=200,
+                       barrier_cutoff=1e-6, climbing_image=True, return_force_history=False, **neb_kwargs):
+    """
+    NEB that puts its images where they are needed for the barrier. Each round relaxes the paths for
+    n_round_iterations and then redistributes their images with redistribute_images, adding images around the
+    barrier and removing them from flat regions. The last run has a climbing image and stops once the barrier
+    has converged, or from the usual force_cutoff and n_max_iterations.
+    :param path_guesses:
+        List of matrices (d dimensions, n points) of the initial path guesses
+    :param spacing:
+        See redistribute_images
+    :param energy_weight:
+        See redistribute_images
+    :param n_rounds:
+        The number of times the images are redistributed
+    :param n_round_iterations:
+        The number of NEB iterations before each redistribution
+    :param barrier_cutoff:
+        See neb
+    :param climbing_image:
+        Whether the last run has a climbing image
+    :param neb_kwargs:
+        The other keyword arguments of neb_batch
+    :return:
+        List of the paths, and the list of force histories over every round if return_force_history
+    """
+    round_kwargs = dict(neb_kwargs, n_max_iterations=n_round_iterations, climbing_image=False, barrier_cutoff=None)
+    paths = path_guesses
+    force_histories = [[] for _ in path_guesses]
+    for round_index in range(n_rounds):
+        paths, round_force_histories = neb_batch(paths, mix_params, return_force_history=True, **round_kwargs)
+        paths = [redistribute_images(path, gf.gaussian_field(path, mix_params), spacing, energy_weight)
+                 for path in paths]
+        for force_history, round_force_history in zip(force_histories, round_force_histories):
+            force_history.extend(round_force_history)
+        logger.info(f"NEB round {round_index+1} redistributed the paths to {[path.shape[1] for path in paths]} images")
+
+    paths, final_force_histories = neb_batch(paths, mix_params, return_force_history=True,
+                                             climbing_image=climbing_image, barrier_cutoff=barrier_cutoff,
+                                             **neb_kwargs)
+    for force_history, final_force_history in zip(force_histories, final_force_histories):
+        force_history.extend(final_force_history)
     if return_force_history:
-        return path, force_history
-    return path
+        return paths, force_histories
+    return paths
 
 
-def neb_mep(mepath_info, points_info, mix_params, n_spanning_point_gap=3, force_cutoff=1e-6, n_max_iterations=3000, k=1., time_step=1.e-2):
+def neb_adaptive(path_guess, mix_params, spacing, return_force_history=False, **kwargs):
+    """
+    Performs neb_adaptive_batch on one path
+    :return:
+        The path, and the force history if return_force_history
+    """
+    paths, force_histories = neb_adaptive_batch([path_guess], mix_params, spacing, return_force_history=True,
+                                                **kwargs)
+    if return_force_history:
+        return paths[0], force_histories[0]
+    return paths[0]
+
+
+def neb_mep(mepath_info, points_info, mix_params, n_spanning_point_gap=3, force_cutoff=1e-6, n_max_iterations=3000, k=1., time_step=1.e-2,
+            optimizer='quick_min', max_step=0.05, climbing_image=False, barrier_cutoff=None, adaptive_spacing=None,
+            neighbour_skin=None):
     """
     Performs the NEB algorithm on the MEP generated path
     :param mepath_info:
@@ -158,8 +558,52 @@ def neb_mep(mepath_info, points_info, mix_params, n_spanning_point_gap=3, force_
         The spring force component
     :param time_step:
         The size of the step to take during an interation
+    :param optimizer:
+        See neb
+    :param max_step:
+        See neb
+    :param climbing_image:
+        See neb
+    :param barrier_cutoff:
+        See neb
+    :param adaptive_spacing:
+        (Optional) If given the images are redistributed with neb_adaptive, with the spacing in units of point_distance
+    :param neighbour_skin:
+        See neb
     :return:
     """
+    return neb_mep_batch([mepath_info], points_info, mix_params, n_spanning_point_gap, force_cutoff, n_max_iterations,
+                         k, time_step, optimizer=optimizer, max_step=max_step, climbing_image=climbing_image,
+                         barrier_cutoff=barrier_cutoff, adaptive_spacing=adaptive_spacing,
+                         neighbour_skin=neighbour_skin)[0]
+
+
+def neb_mep_batch(mepath_infos, points_info, mix_params, n_spanning_point_gap=3, force_cutoff=1e-6,
+                  n_max_iterations=3000, k=1., time_step=1.e-2, optimizer='quick_min', max_step=0.05,
+                  climbing_image=False, barrier_cutoff=None, adaptive_spacing=None, neighbour_skin=None):
+    """
+    Performs the NEB algorithm on a number of MEP generated paths at once, see neb_mep and neb_batch
+    :param mepath_infos:
+        List of the generated path_info dictionaries
+    :return:
+        List of the paths
+    """
+    neb_start_paths = [_neb_start_path(mepath_info, points_info, n_spanning_point_gap)
+                       for mepath_info in mepath_infos]
+    neb_kwargs = dict(force_cutoff=force_cutoff, n_max_iterations=n_max_iterations, k=k, time_step=time_step,
+                      optimizer=optimizer, max_step=max_step, climbing_image=climbing_image,
+                      barrier_cutoff=barrier_cutoff, neighbour_skin=neighbour_skin)
+    if adaptive_spacing is not None:
+        return neb_adaptive_batch(neb_start_paths, mix_params, adaptive_spacing * points_info['point_distance'],
+                                  **neb_kwargs)
+    return neb_batch(neb_start_paths, mix_params, **neb_kwargs)
+
+
+def _neb_start_path(mepath_info, points_info, n_spanning_point_gap):
+    """
+    The starting path for NEB from a MEP generated path, with the repeated points taken out
+    and n_spanning_point_gap NEB points for every point_distance
+    """
     # First check if the path ever crosses the same point twice
     # If it does, delete it!
     new_path_points = []
@@ -198,9 +642,7 @@ def neb_mep(mepath_info, points_info, mix_params, n_spanning_point_gap=3, force_
         points += ((p1-p0)/(2*n_points))[:, np.newaxis]  # Shift the points so that they are equidistant from both end points
         neb_start_path.append(points)
 
-    neb_start_path = np.concatenate(neb_start_path, axis=1)
-
-    return neb(neb_start_path, mix_params, force_cutoff, n_max_iterations, k, time_step)
+    return np.concatenate(neb_start_path, axis=1)
 
 
 if __name__ == '__main__':
@@ -1,42 +1,61 @@
 import numpy as np
+import scipy.linalg as scila
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import connected_components
+import warnings
 import logging
 
 from min_energy_path.mep_ftree import MEPFactor, MEPVariable
-from min_energy_path.gaussian_field import gaussian_field_for_quality, gaussian_field_for_better_quality
+from min_energy_path.transition_qualities import TransitionComponents, concatenate_ranges
+from min_energy_path.points_sphere import get_neighbour_adjacency, get_neighbour_window_bounds, restrict_points
+from min_energy_path.gaussian_field import gaussian_field, gaussian_field_for_quality, gaussian_field_for_quality_batch
 
 from structured_dpp.factor_tree import *
+from structured_dpp.instrumentation import timed, count
 
 
 logger = logging.getLogger(__name__)
 
 
-def generate_path_ftree(quality_function, points_info, n_spanning_gap, n_slices_behind, n_slices_ahead):
+def generate_path_ftree(quality_function, points_info, n_spanning_gap, n_slices_behind, n_slices_ahead,
+                        batch_quality_function=None):
+    """
+    Creates the path factor tree where every factor uses quality_function.
+    If batch_quality_function is given (see get_standard_transition_quality_batch_function) each factor's
+    qualities are instead calculated up front in one batched call and looked up from a table.
+    """
     current_var = Variable((points_info['root_index'],), name='RootVar0')
-    nodes_to_add = [current_var]
+    variables, transition_factors = [current_var], []
     for i in range(n_spanning_gap+1):
+        if i == n_spanning_gap:  # Give the last variable only one possible position, the tail
+            allowed_values = (points_info['tail_index'],)
+        else:
+            # Sphere slice bounds
+            slice_start = max(points_info['root_dir_index']+i-n_slices_behind, 0)
+            slice_end = points_info['root_dir_index']+i+1+n_slices_ahead
+            in_slice = (slice_start <= points_info['dir_index']) & (points_info['dir_index'] < slice_end)
+            allowed_values = points_info['sphere_index'][in_slice].T
+
         # Add transition factor
-        transition_factor = Factor(quality_function,
+        factor_quality_function = quality_function if batch_quality_function is None else _table_quality_function(
+            generate_factor_quality_table(batch_quality_function, current_var.allowed_values, allowed_values)
+        )
+        transition_factor = Factor(factor_quality_function,
                                    parent=current_var,
                                    name=f'Fac{i}-{i+1}')
-        nodes_to_add.append(transition_factor)
+        transition_factors.append(transition_factor)
 
-        if i == n_spanning_gap:  # Give the last variable only one possible position, the tail
-            current_var = Variable((points_info['tail_index'],),
+        if i == n_spanning_gap:
+            current_var = Variable(allowed_values,
                                    parent=transition_factor,
                                    name=f'TailVar{i+1}')
         else:
-            # Sphere slice bounds
-            slice_of_dir = points_info['dir_component'][
-                max(points_info['root_dir_index']+i-n_slices_behind, 0):points_info['root_dir_index']+i+1+n_slices_ahead
-            ]
-            in_slice = (np.min(slice_of_dir) <= points_info['sphere_before'][0, :]) & (points_info['sphere_before'][0, :] <= np.max(slice_of_dir))
-
-            current_var = Variable(points_info['sphere_index'][in_slice].T,
+            current_var = Variable(allowed_values,
                                    parent=transition_factor,
                                    name=f'Var{i+1}')
-        nodes_to_add.append(current_var)
+        variables.append(current_var)
 
-    ftree = FactorTree.create_from_connected_nodes(nodes_to_add)
+    ftree = FactorTree.chain(variables, transition_factors)
 
     return ftree
 
@@ -46,20 +65,28 @@ def generate_path_ftree_better(points_info, mix_params,
                                length_cutoff,
                                tuning_dist, tuning_strength, tuning_strength_diff,
                                # Parameters relating to variables and slicing
-                               n_spanning_gap, n_slices_behind=1, n_slices_ahead=2):
-    transition_qualities = generate_transition_qualities(
-        points_info, mix_params, length_cutoff, tuning_dist, tuning_strength, tuning_strength_diff, n_slices_behind,
-        n_slices_ahead
-    )
+                               n_spanning_gap, n_slices_behind=1, n_slices_ahead=2,
+                               transition_qualities=None):
+    """
+    Makes the factor tree of a path from the root to the tail made of MEPVariables and MEPFactors.
+    :param transition_qualities:
+        (Optional) Already generated transition qualities, for example from TransitionComponents.qualities,
+        in which case the tuning parameters aren't used
+    """
+    if transition_qualities is None:
+        transition_qualities = generate_transition_qualities(
+            points_info, mix_params, length_cutoff, tuning_dist, tuning_strength, tuning_strength_diff,
+            n_slices_behind, n_slices_ahead
+        )
 
     current_var = Variable((points_info['root_index'],), name='RootVar0')
-    nodes_to_add = [current_var]
+    variables, transition_factors = [current_var], []
 
     for i in range(n_spanning_gap+1):
         # Add transition factor
         transition_factor = MEPFactor(transition_qualities, length_cutoff, n_slices_behind, n_slices_ahead, points_info,
                                       parent=current_var, name=f'Fac{i}-{i+1}')
-        nodes_to_add.append(transition_factor)
+        transition_factors.append(transition_factor)
 
         if i == n_spanning_gap:  # Give the last variable only one possible position, the tail
             current_var = Variable((points_info['tail_index'],),
@@ -69,28 +96,88 @@ def generate_path_ftree_better(points_info, mix_params,
             # Sphere slice bounds
             slice_start = max(points_info['root_dir_index']+i-n_slices_behind, 0)
             slice_end = points_info['root_dir_index']+i+1+n_slices_ahead
-            slice_of_dir = points_info['dir_component'][
-                slice_start:slice_end
-            ]
-            in_slice = (np.min(slice_of_dir) <= points_info['sphere_before'][0, :]) & (points_info['sphere_before'][0, :] <= np.max(slice_of_dir))
+            in_slice = (slice_start <= points_info['dir_index']) & (points_info['dir_index'] < slice_end)
 
             current_var = MEPVariable(points_info['sphere_index'][in_slice].T,
                                       slice_start, slice_end,
                                       parent=transition_factor,
                                       name=f'Var{i+1}')
-        nodes_to_add.append(current_var)
+        variables.append(current_var)
 
-    ftree = FactorTree.create_from_connected_nodes(nodes_to_add)
+    ftree = FactorTree.chain(variables, transition_factors)
 
     return ftree
 
 
+def retune_path_ftree(ftree, transition_components, tuning_dist, tuning_strength, tuning_strength_diff,
+                      dtype=np.float64):
+    """
+    Points every MEPFactor of a tree made by generate_path_ftree_better at the transition qualities for new tuning
+    parameters, without evaluating the field again or rebuilding the tree.
+    :param transition_components:
+        The TransitionComponents of the tree's points, see generate_transition_components
+    :return:
+        The new TransitionQualities
+    """
+    transition_qualities = transition_components.qualities(tuning_dist, tuning_strength, tuning_strength_diff,
+                                                           dtype=dtype)
+    mep_factors = [factor for factor in ftree.get_factors() if isinstance(factor, MEPFactor)]
+    for factor in mep_factors:
+        factor.transition_qualities = transition_qualities
+    ftree.mark_changed(*mep_factors)
+    return transition_qualities
+
+
+def _transition_scores(pos0_strength, pos1_strength, mid_strength, second_order, direction_length,
+                       orthog_grad_length, points_info, mix_params,
+                       tuning_dist, tuning_strength, tuning_strength_diff, tuning_grad, tuning_second_order):
+    """
+    Works out the score breakdown of transitions from their field information.
+    Works both on single transitions and on vectors of transitions.
+    """
+    return (
+        # Distance score
+        # Favor smaller distances
+        # Give negative score to long distances
+        - tuning_dist * direction_length / points_info['point_distance'],
+        # Strength score
+        # Favor lower strengths
+        # Give negative score to very positive strengths
+        - tuning_strength * (
+            ((pos0_strength + mid_strength) / 2 - mix_params['min_minima_strength'])
+            / mix_params['max_line_strength_diff']
+        ),
+        # Strength diff quality_function
+        # Penalise going upward
+        # If pos0_strength (closer to the tail) is bigger than pos1_strength
+        # then a negative value will be added to the score
+        + tuning_strength_diff * (
+            np.minimum(0, pos1_strength - np.maximum(mid_strength, pos0_strength))
+            / mix_params['max_line_strength_diff']
+        ),
+        # Gradient score
+        # Favor small tangential gradients in areas with a high second order derivative
+        # Give negative score to very large orthogonal gradient lengths
+        - tuning_grad * orthog_grad_length * np.exp(tuning_second_order * second_order),
+        # Second order score
+        # Favor the path_guess being at a minimum orthogonal to the path_guess
+        # This means that the two points orthogonal to the direction of the path_guess
+        # will have higher strengths than the midpoint
+        # Only give this advantage if the path has slipped to the minimum point (small orthog grad)
+        + tuning_second_order * second_order * np.exp(-tuning_grad*orthog_grad_length)
+    )
+
+
 def get_standard_transition_quality_function(points_info, mix_params, length_cutoff,
                                              tuning_dist, tuning_strength, tuning_strength_diff, tuning_grad, tuning_second_order,
-                                             order_2_step=0.2):
+                                             order_2_step=None):
     """
     Returns the factor quality_function function given the input parameters.
+    The second order score uses the analytic curvature unless order_2_step is given,
+    in which case it is estimated by finite differences.
     """
+    tuning = (tuning_dist, tuning_strength, tuning_strength_diff, tuning_grad, tuning_second_order)
+
     @assignment_to_var_arguments
     def intermediate_factor_quality(idx0, idx1, return_breakdown=False):  # idx1 closer to the root
         if idx0 == idx1:
@@ -103,39 +190,7 @@ def get_standard_transition_quality_function(points_info, mix_params, length_cut
         if gaussian_info == 0:  # Returns 0 when length cutoff reached
             return 0
 
-        pos0_strength, pos1_strength, mid_strength, second_order_guess, direction_length, orthog_grad_length = gaussian_info
-
-        score = (
-                # Distance score
-                # Favor smaller distances
-                # Give negative score to long distances
-                - tuning_dist * direction_length / points_info['point_distance'],
-                # Strength score
-                # Favor lower strengths
-                # Give negative score to very positive strengths
-                - tuning_strength * (
-                    ((pos0_strength + mid_strength) / 2 - mix_params['min_minima_strength'])
-                    / mix_params['max_line_strength_diff']
-                ),
-                # Strength diff quality_function
-                # Penalise going upward
-                # If pos0_strength (closer to the tail) is bigger than pos1_strength
-                # then a negative value will be added to the score
-                + tuning_strength_diff * (
-                    min(0, pos1_strength - max(mid_strength, pos0_strength))
-                    / mix_params['max_line_strength_diff']
-                ),
-                # Gradient score
-                # Favor small tangential gradients in areas with a high second order derivative
-                # Give negative score to very large orthogonal gradient lengths
-                - tuning_grad * orthog_grad_length * np.exp(tuning_second_order * second_order_guess),
-                # Second order score
-                # Favor the path_guess being at a minimum orthogonal to the path_guess
-                # This means that the two points orthogonal to the direction of the path_guess
-                # will have higher strengths than the midpoint
-                # Only give this advantage if the path has slipped to the minimum point (small orthog grad)
-                + tuning_second_order * second_order_guess * np.exp(-tuning_grad*orthog_grad_length)
-        )
+        score = _transition_scores(*gaussian_info, points_info, mix_params, *tuning)
 
         if return_breakdown:
             return score
@@ -144,15 +199,82 @@ def get_standard_transition_quality_function(points_info, mix_params, length_cut
     return intermediate_factor_quality
 
 
-def get_good_path_start_samples(var, run, points_info, n_per_group=3):
+def get_standard_transition_quality_batch_function(points_info, mix_params, length_cutoff,
+                                                   tuning_dist, tuning_strength, tuning_strength_diff, tuning_grad,
+                                                   tuning_second_order, batch_size=4096):
+    """
+    Returns a batched version of the standard quality function.
+    It takes arrays of idx0 and idx1 (idx1 closer to the root) and calculates the quality of every pair at once,
+    evaluating the field batch_size pairs at a time to limit memory use.
+    The returned function gives the qualities, or (qualities, breakdown) when return_breakdown is True,
+    where breakdown is a matrix (5 scores, n pairs) that is zero for pairs with zero quality.
+    """
+    tuning = (tuning_dist, tuning_strength, tuning_strength_diff, tuning_grad, tuning_second_order)
+
+    def transition_quality_batch(idx0, idx1, return_breakdown=False):
+        idx0, idx1 = np.asarray(idx0).ravel(), np.asarray(idx1).ravel()
+        qualities = np.zeros(idx0.size)
+        breakdown = np.zeros((len(tuning), idx0.size))
+        for batch_start in range(0, idx0.size, batch_size):
+            batch_idx0 = idx0[batch_start:batch_start+batch_size]
+            batch_idx1 = idx1[batch_start:batch_start+batch_size]
+            *gaussian_info, close_enough = gaussian_field_for_quality_batch(
+                points_info['sphere'][:, batch_idx0], points_info['sphere'][:, batch_idx1], mix_params,
+                points_info['point_distance'], length_cutoff
+            )
+            score = np.array(_transition_scores(*gaussian_info, points_info, mix_params, *tuning))
+            batch_positions = batch_start + np.flatnonzero(close_enough)
+            qualities[batch_positions] = np.exp(np.sum(score, axis=0))
+            breakdown[:, batch_positions] = score
+
+        if return_breakdown:
+            return qualities, breakdown
+        return qualities
+    return transition_quality_batch
+
+
+def generate_factor_quality_table(batch_quality_function, rootward_values, leafward_values):
+    """
+    Calculates the quality of every transition between two variables' allowed values in one batched call.
+    :param batch_quality_function:
+        See get_standard_transition_quality_batch_function
+    :return:
+        The non-zero qualities as a dictionary table[rootward][leafward]
+    """
+    rootward_values, leafward_values = np.asarray(rootward_values), np.asarray(leafward_values)
+    rootward_grid, leafward_grid = np.meshgrid(rootward_values, leafward_values, indexing='ij')
+    qualities = batch_quality_function(leafward_grid.ravel(), rootward_grid.ravel()).reshape(rootward_grid.shape)
+
+    table = {}
+    for rootward, row_qualities in zip(rootward_values, qualities):
+        non_zero = np.flatnonzero(row_qualities)
+        table[rootward] = dict(zip(leafward_values[non_zero], row_qualities[non_zero]))
+    return table
+
+
+def _table_quality_function(table):
+    """
+    Returns a factor quality_function that looks the transition quality up in a table made by
+    generate_factor_quality_table.
+    """
+    @assignment_to_var_arguments
+    def table_factor_quality(idx0, idx1):  # idx1 closer to the root
+        return table[idx1].get(idx0, 0)
+    return table_factor_quality
+
+
+def get_good_path_start_samples(var, run, points_info, n_per_group=3, max_marginals=None):
     """
     Takes var, which has had a max quality_function run performed on it, and returns a start_sample of the max quality_function paths.
     The start_sample is the max path_guess that passes through one section of the variables allowed variables.
+    :param max_marginals:
+        (Optional) The max-marginals of var from FactorTree.run_max_marginals, used instead of its beliefs
+        so any variable can be sampled after one run
     """
     sample = {}
     for idx in var.allowed_values:
         group = tuple(points_info['sphere_before'][1:, idx] / points_info['point_distance'] // n_per_group)
-        value = var.outgoing_messages[run][None][idx].v
+        value = var.outgoing_messages[run][None][idx].v if max_marginals is None else max_marginals[idx]
         route_before = sample.get(group, None)
         if route_before is None or value > route_before[1]:
             sample[group] = (idx, value)
@@ -203,76 +325,191 @@ Dist, Strength, Strength Diff, Grad, Second Order
     print('Overall', total)
 
 
+@timed('generate_transition_qualities')
 def generate_transition_qualities(points_info, mix_params,
                                   # Parameters for the quality
                                   length_cutoff,
                                   tuning_dist, tuning_strength, tuning_strength_diff,  # not doing grad qualities
                                   # Parameters for the path variables
-                                  n_slices_behind, n_slices_ahead):
-    logger.info('Starting to generate transition qualities')
+                                  n_slices_behind, n_slices_ahead,
+                                  dtype=np.float64):
+    """
+    Calculates the quality of every transition that a MEPFactor could use.
+    To try a number of tuning parameters, use generate_transition_components and TransitionComponents.qualities
+    so the field is only evaluated once.
+    :param dtype:
+        The dtype the qualities are stored with, np.float32 halves the memory of the qualities
+    :return:
+        TransitionQualities, read as transition_qualities[rootwards][leafwards]
+    """
+    transition_components = generate_transition_components(points_info, mix_params, length_cutoff,
+                                                           n_slices_behind, n_slices_ahead)
+    transition_qualities = transition_components.qualities(tuning_dist, tuning_strength, tuning_strength_diff,
+                                                           dtype=dtype)
+    logger.info(f'Generated {transition_qualities.n_transitions} transition qualities '
+                f'using {transition_qualities.nbytes / 1e6:.1f}MB')
+    return transition_qualities
 
-    # Step 1 - Work out all the possible transition qualities
+
+def _transition_components(directions_length, from_strength, midpoint_strengths, to_strengths,
+                           points_info, mix_params):
+    """
+    The raw components of the quality of transitions, see TransitionComponents.
+    """
+    return np.array([
+        # Distance
+        directions_length / points_info['point_distance'],
+        # Mean strength of the to point and the midpoint
+        ((midpoint_strengths + to_strengths) / 2 - mix_params['min_minima_strength'])
+        / mix_params['max_line_strength_diff'],
+        # Going uphill from the from point
+        np.maximum(np.maximum(midpoint_strengths, to_strengths) - from_strength, 0)
+        / mix_params['max_line_strength_diff']
+    ])
+
+
+@timed('generate_field_tables')
+def generate_field_tables(points_info, mix_params, length_cutoff, chunk_size=65536):
+    """
+    Evaluates the field everywhere transitions need it: at every point, and at the midpoint of every edge
+    of the neighbour adjacency (see get_neighbour_adjacency).
+    The tables don't depend on how the points are sliced into variables.
+    :param chunk_size:
+        The number of midpoints to evaluate the field at together
+    :return:
+        Dictionary with keys point_strengths (n points,), and edge_lengths and midpoint_strengths,
+        both in the same order as the adjacency's indices
+    """
+    logger.info('Generating field tables')
+    neighbours = get_neighbour_adjacency(points_info, length_cutoff)
+    rows = np.repeat(points_info['sphere_index'], np.diff(neighbours['indptr']))
+    cols = neighbours['indices']
+    sphere = points_info['sphere']
+
+    edge_lengths = np.empty(cols.size)
+    midpoint_strengths = np.empty(cols.size)
+    for start in range(0, cols.size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        from_coords, to_coords = sphere[:, rows[chunk]], sphere[:, cols[chunk]]
+        edge_lengths[chunk] = scila.norm(to_coords - from_coords, axis=0)
+        midpoint_strengths[chunk] = gaussian_field((to_coords + from_coords) / 2, mix_params)
+
+    return {'point_strengths': gaussian_field(sphere, mix_params),
+            'edge_lengths': edge_lengths,
+            'midpoint_strengths': midpoint_strengths}
+
+
+@timed('generate_transition_components')
+def generate_transition_components(points_info, mix_params,
+                                   # Parameters for the quality
+                                   length_cutoff,
+                                   # Parameters for the path variables
+                                   n_slices_behind, n_slices_ahead,
+                                   field_tables=None):
+    """
+    Calculates the raw components of the quality of every transition that a MEPFactor could use,
+    which don't depend on the tuning parameters.
+    :param field_tables:
+        (Optional) The output of generate_field_tables for the points, mix_params and length_cutoff,
+        otherwise they're generated
+    :return:
+        TransitionComponents, see TransitionComponents.qualities to turn them into transition qualities
+    """
+    logger.info('Starting to generate transition components')
+    if field_tables is None:
+        field_tables = generate_field_tables(points_info, mix_params, length_cutoff)
+    neighbours = points_info['neighbours']
+    dir_index = points_info['dir_index']
+    root_index, tail_index = points_info['root_index'], points_info['tail_index']
+
+    # Step 1 - Work out all the possible transitions
     # First, we work out which variables we need to calculate transitions from
     min_dir_index = max(points_info['root_dir_index']-n_slices_behind, 0)
     max_dir_index = points_info['tail_dir_index']+1+n_slices_ahead
+    from_idx = points_info['sphere_index'][(min_dir_index <= dir_index) & (dir_index <= max_dir_index)]
 
-    # Then actually calculate, for each "from" point, the quality to each possible "to" point
+    # Then the window of slices each "from" point can transition to
+    # Only points within length_cutoff can be transitioned to, which are the neighbours of the point
     # from is rootwards, to is leafwards
-    # transition_qualities[rootwards][leafwards]
-    transition_qualities = {}
-
-    for i, fromm in enumerate(points_info['sphere_index']):
-        if i % 500 == 0:
-            logger.info(f'Generating transition {i}')
-        from_pos = np.unravel_index(points_info['spherey_index_index'][fromm], points_info['spherey_index'].shape)
-        if from_pos[0] < min_dir_index or from_pos[0] > max_dir_index:
-            continue
-        to_slices_behind = from_pos[0] - n_slices_behind - n_slices_ahead + (
-            1 if fromm != points_info['root_index'] else 0)
-        to_slices_ahead = from_pos[0] + n_slices_behind + n_slices_ahead + 2
-        to_calculate_idx = points_info['spherey_index'][
-            (slice(max(to_slices_behind, min_dir_index), min(to_slices_ahead, max_dir_index)),) +
-            tuple(
-                slice(max(from_dim_pos-length_cutoff, 0), from_dim_pos+1+length_cutoff)
-                for from_dim_pos in from_pos[1:]
-            )
-        ]
-        to_calculate_idx = to_calculate_idx[~np.isin(to_calculate_idx, [-1, fromm])]
-        directions_length, to_calculate_idx, from_strength, midpoint_strengths, to_strengths, close_enough = \
-            gaussian_field_for_better_quality(
-                points_info['sphere'][:, [fromm]], points_info['sphere'][:, to_calculate_idx], to_calculate_idx,
-                mix_params, length_cutoff, points_info['point_distance']
-            )
-        to_qualities = np.exp(
-            - tuning_dist * directions_length / points_info['point_distance']
-            - tuning_strength * (
-                ((midpoint_strengths + to_strengths) / 2 - mix_params['min_minima_strength'])
-                / mix_params['max_line_strength_diff']
-            )
-            - tuning_strength_diff * (
-                np.maximum(np.maximum(midpoint_strengths, to_strengths) - from_strength, 0)
-                / mix_params['max_line_strength_diff']
-            )
-        )
-        transition_qualities[fromm] = dict(zip(to_calculate_idx, to_qualities))
-        if n_slices_behind == 0 and from_pos[0] >= points_info['tail_dir_index'] and fromm != points_info['tail_index']:
-            directions_length, to_calculate_idx, from_strength, midpoint_strengths, to_strengths, close_enough = \
-                gaussian_field_for_better_quality(
-                    points_info['sphere'][:, [fromm]], points_info['sphere'][:, [points_info['tail_index']]],
-                    np.array([points_info['tail_index']]),
-                    mix_params, length_cutoff, points_info['point_distance']
-                )
-            if close_enough[0]:
-                transition_qualities[fromm][points_info['tail_index']] = np.exp(
-                    - tuning_dist * directions_length / points_info['point_distance']
-                    - tuning_strength * (
-                        ((midpoint_strengths + to_strengths) / 2 - mix_params['min_minima_strength'])
-                        / mix_params['max_line_strength_diff']
-                    )
-                    - tuning_strength_diff * (
-                        np.maximum(np.maximum(midpoint_strengths, to_strengths) - from_strength, 0)
-                        / mix_params['max_line_strength_diff']
-                    )
-                )[0]
+    from_dir_index = dir_index[from_idx]
+    to_slices_behind = from_dir_index - n_slices_behind - n_slices_ahead + (from_idx != root_index)
+    to_slices_ahead = from_dir_index + n_slices_behind + n_slices_ahead + 2
+    window_starts, window_ends = get_neighbour_window_bounds(
+        from_idx, points_info, np.maximum(to_slices_behind, min_dir_index), np.minimum(to_slices_ahead, max_dir_index)
+    )
+    positions, window_ids = concatenate_ranges(window_starts, window_ends)
+    rows = from_idx[window_ids]
+
+    if n_slices_behind == 0:
+        # Points at or past the tail can always transition to it
+        tail_from = from_idx[(from_dir_index >= points_info['tail_dir_index']) & (from_idx != tail_index)]
+        tail_positions = neighbours['indptr'][tail_from] + np.array([
+            np.searchsorted(neighbours['indices'][neighbours['indptr'][fromm]:neighbours['indptr'][fromm+1]],
+                            tail_index)
+            for fromm in tail_from
+        ], dtype=int)
+        is_tail_edge = tail_positions < neighbours['indptr'][tail_from+1]
+        is_tail_edge[is_tail_edge] = neighbours['indices'][tail_positions[is_tail_edge]] == tail_index
+        tail_positions = tail_positions[is_tail_edge]
+        new_tail_edge = ~np.isin(tail_positions, positions)
+        positions = np.append(positions, tail_positions[new_tail_edge])
+        rows = np.append(rows, tail_from[is_tail_edge][new_tail_edge])
+
+    # Filter out transitions too far away
+    close_enough = field_tables['edge_lengths'][positions] / points_info['point_distance'] <= length_cutoff
+    positions, rows = positions[close_enough], rows[close_enough]
+    cols = neighbours['indices'][positions]
+
+    transition_components = TransitionComponents.from_coo(
+        rows, cols,
+        _transition_components(field_tables['edge_lengths'][positions], field_tables['point_strengths'][rows],
+                               field_tables['midpoint_strengths'][positions], field_tables['point_strengths'][cols],
+                               points_info, mix_params),
+        len(points_info['sphere_index'])
+    )
+    logger.info(f'Generated components of {transition_components.n_transitions} transitions '
+                f'using {transition_components.nbytes / 1e6:.1f}MB')
+    count('transitions', transition_components.n_transitions)
+    return transition_components
 
-    return transition_qualities
+
+def prune_points(points_info, mix_params, length_cutoff, strength_margin=0.25, max_strength=None):
+    """
+    Removes the points that can't be on a minimum energy path before the factor tree is made,
+    so the transitions, the variable domains and the messages are all smaller.
+    Points are removed if their field strength is too high,
+    or if they can't be reached from the root and the tail without going through points that are too high.
+    :param points_info:
+        The points_info dictionary, see function create_sphere_points or create_cloud_points
+    :param length_cutoff:
+        The length_cutoff transitions will be made with, which sets which points can be reached from each other
+    :param strength_margin:
+        How far above max_line_strength (the highest point on the straight line between the minima) points can be,
+        as a proportion of max_line_strength_diff
+    :param max_strength:
+        (Optional) The highest field strength allowed, instead of working it out from strength_margin
+    :return:
+        The pruned points_info dictionary, see restrict_points
+    """
+    if max_strength is None:
+        max_strength = mix_params['max_line_strength'] + strength_margin * mix_params['max_line_strength_diff']
+    keep = gaussian_field(points_info['sphere'], mix_params) <= max_strength
+    keep[[points_info['root_index'], points_info['tail_index']]] = True
+
+    # Only keep the points connected to the root and tail by transitions between kept points
+    neighbours = get_neighbour_adjacency(points_info, length_cutoff)
+    n_points = len(points_info['sphere_index'])
+    rows = np.repeat(points_info['sphere_index'], np.diff(neighbours['indptr']))
+    cols = neighbours['indices']
+    both_kept = keep[rows] & keep[cols]
+    graph = sparse.csr_matrix((np.ones(np.sum(both_kept)), (rows[both_kept], cols[both_kept])),
+                              shape=(n_points, n_points))
+    _, labels = connected_components(graph, directed=False)
+    root_label, tail_label = labels[points_info['root_index']], labels[points_info['tail_index']]
+    if root_label != tail_label:
+        warnings.warn("The root and tail aren't connected by points below the maximum strength, "
+                      "no path can be found between them")
+    keep &= (labels == root_label) | (labels == tail_label)
+
+    logger.info(f'Pruning removed {n_points - np.sum(keep)} of {n_points} points')
+    return restrict_points(points_info, keep)
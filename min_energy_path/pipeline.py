@@ -0,0 +1,296 @@
+import os
+import hashlib
+import inspect
+import functools
+import numpy as np
+import logging
+
+from min_energy_path.points_sphere import create_sphere_points
+from min_energy_path.path_helpers import (generate_field_tables, generate_transition_components,
+                                          generate_path_ftree_better)
+from min_energy_path.transition_qualities import TransitionQualities, TransitionComponents
+from min_energy_path import neb
+
+
+logger = logging.getLogger(__name__)
+
+
+def hash_inputs(*inputs):
+    """
+    A hash of the content of the inputs to a stage, which can be numbers, strings, arrays,
+    and lists, tuples and dictionaries of them.
+    """
+    digest = hashlib.sha1()
+
+    def update(value):
+        if isinstance(value, dict):
+            digest.update(b'dict')
+            for key in sorted(value, key=str):
+                update(str(key))
+                update(value[key])
+        elif isinstance(value, (list, tuple)):
+            digest.update(f'{type(value).__name__}{len(value)}'.encode())
+            for item in value:
+                update(item)
+        elif isinstance(value, np.ndarray) or isinstance(value, np.generic):
+            value = np.ascontiguousarray(value)
+            digest.update(f'array{value.dtype.str}{value.shape}'.encode())
+            digest.update(value.tobytes())
+        else:
+            digest.update(f'{type(value).__name__}{value!r}'.encode())
+
+    for value in inputs:
+        update(value)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def source_hash(function):
+    """
+    A hash of the source code of a function, so cached outputs aren't used after the code making them is edited.
+    Falls back on the function's name when the source isn't available.
+    """
+    try:
+        source = inspect.getsource(function)
+    except (OSError, TypeError):
+        source = f'{function.__module__}.{function.__qualname__}'
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
+def _flatten(dictionary, prefix=''):
+    """Turns nested dictionaries of arrays, numbers and tuples into the flat dictionary of arrays saved in an npz"""
+    arrays = {}
+    for key, value in dictionary.items():
+        if isinstance(value, dict):
+            arrays.update(_flatten(value, f'{prefix}{key}/'))
+        elif isinstance(value, tuple):
+            arrays[f'{prefix}{key}/tuple'] = np.array(value)
+        elif value is None:
+            arrays[f'{prefix}{key}/none'] = np.array(0)
+        else:
+            arrays[f'{prefix}{key}'] = np.asarray(value)
+    return arrays
+
+
+def _unflatten(arrays):
+    """The reverse of _flatten"""
+    dictionary = {}
+    for name, value in arrays.items():
+        *path, key = name.split('/')
+        if key == 'tuple':
+            *path, key = path
+            value = tuple(value.tolist())
+        elif key == 'none':
+            *path, key = path
+            value = None
+        elif value.ndim == 0:
+            value = value.item()
+        inner = dictionary
+        for part in path:
+            inner = inner.setdefault(part, {})
+        inner[key] = value
+    return dictionary
+
+
+class StageCache:
+    """
+    Stores the outputs of pipeline stages on disk as npz files, under a hash of the stage's inputs.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits, self.misses = {}, {}
+
+    def _path(self, stage, key):
+        return os.path.join(self.cache_dir, f'{stage}-{key}.npz')
+
+    def load(self, stage, key):
+        """The stored output of the stage, or None if it hasn't been stored"""
+        path = self._path(stage, key)
+        if not os.path.exists(path):
+            self.misses[stage] = self.misses.get(stage, 0) + 1
+            return None
+        self.hits[stage] = self.hits.get(stage, 0) + 1
+        logger.info(f'Loading {stage} from the cache')
+        with np.load(path, allow_pickle=False) as stored:
+            return _unflatten({name: stored[name] for name in stored.files})
+
+    def save(self, stage, key, output):
+        """Store the output of a stage, a (possibly nested) dictionary of arrays and numbers"""
+        # Write to a temporary file first so a half written file is never loaded
+        path = self._path(stage, key)
+        temporary_path = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(temporary_path, **_flatten(output))
+        os.replace(temporary_path, path)
+
+    def cached(self, stage, key, calculate):
+        """The stored output of the stage if there is one, otherwise calculate it with calculate() and store it"""
+        output = self.load(stage, key)
+        if output is None:
+            output = calculate()
+            self.save(stage, key, output)
+        return output
+
+
+class MEPPipeline:
+    """
+    The stages of finding a minimum energy path, with the output of every stage cached on disk under a hash of
+    everything it depends on, so that only the stages whose inputs change are run again.
+    Every stage returns its output and the key it was cached under, which is an input to the stages after it.
+    - mixture: the gaussian mix params with their minima
+    - points: the sphere of points
+    - field_tables: the field strength at every point and transition midpoint, see generate_field_tables
+    - transitions: the transition components, see generate_transition_components
+    - path: the best path through the factor tree, from the forward pass and traceback
+    - neb: the path after NEB
+    So changing the NEB parameters only runs NEB again,
+    and changing n_slices_ahead reuses the points and the field tables.
+
+    The keys also hold the stage's entry in STAGE_VERSIONS and a hash of the source of the function doing the stage's
+    work (see STAGE_FUNCTIONS), so editing that function makes the stage and the ones after it run again.
+    Changes deeper down, for example in a helper of generate_transition_components, aren't seen by the source hash,
+    so bump the stage's version when making them.
+    """
+    STAGE_VERSIONS = {'mixture': 1, 'points': 1, 'field_tables': 1, 'transitions': 1, 'path': 1, 'neb': 1}
+    # The function doing each stage's work, the mixture's is the params function it is given
+    STAGE_FUNCTIONS = {'points': create_sphere_points, 'field_tables': generate_field_tables,
+                       'transitions': generate_transition_components, 'path': generate_path_ftree_better,
+                       'neb': neb.neb_mep}
+
+    def __init__(self, cache_dir):
+        self.cache = StageCache(cache_dir)
+
+    def stage_key(self, stage, *inputs, function=None):
+        """
+        The key a stage's output is cached under, from its inputs, version and code
+        :param function:
+            (Optional) The function doing the stage's work, by default the one in STAGE_FUNCTIONS
+        """
+        function = function if function is not None else self.STAGE_FUNCTIONS[stage]
+        return hash_inputs(stage, self.STAGE_VERSIONS[stage], source_hash(function), *inputs)
+
+    def mixture(self, params_function, *args, seed=None):
+        """
+        :param params_function:
+            A function from gaussian_params, called with args
+        :param seed:
+            Passed to params_function as its seed keyword, needed to cache randomly generated mixtures
+            such as gaussian_params.randomly_generated
+        """
+        if seed is not None and 'seed' not in inspect.signature(params_function).parameters:
+            raise ValueError(f'{params_function.__qualname__} does not take a seed')
+        key = self.stage_key('mixture', params_function.__module__, params_function.__qualname__, args, seed,
+                             function=params_function)
+
+        def calculate():
+            if seed is not None:
+                return params_function(*args, seed=seed)
+            return params_function(*args)
+        return self.cache.cached('mixture', key, calculate), key
+
+    def points(self, mix_params, mixture_key, n_spanning_gap, gap_proportion=0.7, shrink_in_direction=1.0):
+        key = self.stage_key('points', mixture_key, n_spanning_gap, gap_proportion, shrink_in_direction)
+        return self.cache.cached('points', key, lambda: create_sphere_points(
+            mix_params['minima_coords'], n_spanning_gap, gap_proportion, shrink_in_direction
+        )), key
+
+    def field_tables(self, points_info, mix_params, points_key, length_cutoff):
+        """
+        Also stores the neighbour adjacency the tables were made over in points_info
+        """
+        key = self.stage_key('field_tables', points_key, length_cutoff)
+
+        def calculate():
+            field_tables = generate_field_tables(points_info, mix_params, length_cutoff)
+            return dict(field_tables, neighbours=points_info['neighbours'])
+        field_tables = self.cache.cached('field_tables', key, calculate)
+        points_info['neighbours'] = field_tables.pop('neighbours')
+        return field_tables, key
+
+    def transitions(self, points_info, mix_params, field_tables, field_tables_key, length_cutoff,
+                    n_slices_behind, n_slices_ahead):
+        key = self.stage_key('transitions', field_tables_key, n_slices_behind, n_slices_ahead)
+
+        def calculate():
+            transition_components = generate_transition_components(
+                points_info, mix_params, length_cutoff, n_slices_behind, n_slices_ahead, field_tables=field_tables
+            )
+            return {'indptr': transition_components.structure.indptr,
+                    'indices': transition_components.structure.indices,
+                    'components': transition_components.components}
+        stored = self.cache.cached('transitions', key, calculate)
+        components = stored['components']
+        structure = TransitionQualities(stored['indptr'], stored['indices'], components[0])
+        return TransitionComponents(structure, components), key
+
+    @staticmethod
+    def ftree(points_info, mix_params, transition_components, length_cutoff, tuning_dist, tuning_strength,
+              tuning_strength_diff, n_spanning_gap, n_slices_behind, n_slices_ahead):
+        """
+        The factor tree of the path stage, for scripts that need more from it than the best path.
+        It isn't cached, but is quick to make from the cached transition components.
+        """
+        return generate_path_ftree_better(
+            points_info, mix_params, length_cutoff, tuning_dist, tuning_strength, tuning_strength_diff,
+            n_spanning_gap, n_slices_behind, n_slices_ahead,
+            transition_qualities=transition_components.qualities(tuning_dist, tuning_strength, tuning_strength_diff)
+        )
+
+    def path(self, points_info, mix_params, transition_components, transitions_key, length_cutoff,
+             tuning_dist, tuning_strength, tuning_strength_diff, n_spanning_gap, n_slices_behind, n_slices_ahead):
+        """
+        Builds the factor tree, runs the forward pass from the tail and traces back the best path.
+        :return:
+            The path info dictionary with keys value, path_indexes and path, and its key
+        """
+        key = self.stage_key('path', transitions_key, tuning_dist, tuning_strength, tuning_strength_diff,
+                             n_spanning_gap)
+
+        def calculate():
+            ftree = self.ftree(points_info, mix_params, transition_components, length_cutoff, tuning_dist,
+                               tuning_strength, tuning_strength_diff, n_spanning_gap, n_slices_behind, n_slices_ahead)
+            tail_var = next(iter(ftree.levels[-1]))
+            traversal, run = ftree.run_max_quality_forward(tail_var)
+            max_quality, max_assignment = tail_var.calculate_max_message_assignment(run)
+            assignment = ftree.get_max_from_start_assignment(tail_var, max_assignment, traversal, run)
+            path_indexes = np.array([assignment[var] for var in ftree.get_variables()])
+            return {'value': max_quality,
+                    'path_indexes': path_indexes,
+                    'path': points_info['sphere'][:, path_indexes]}
+        path_info = self.cache.cached('path', key, calculate)
+        path_info['path_indexes'] = path_info['path_indexes'].tolist()
+        return path_info, key
+
+    def neb(self, path_info, points_info, mix_params, path_key, **neb_kwargs):
+        """
+        :param neb_kwargs:
+            Keyword arguments of neb.neb_mep
+        """
+        key = self.stage_key('neb', path_key, neb_kwargs)
+        return self.cache.cached('neb', key, lambda: {
+            'path': neb.neb_mep(path_info, points_info, mix_params, **neb_kwargs)
+        })['path'], key
+
+    def run(self, params_function, params_args, n_spanning_gap, seed=None, gap_proportion=0.7,
+            shrink_in_direction=1.0, length_cutoff=3, tuning_dist=0.02, tuning_strength=1, tuning_strength_diff=1.5,
+            n_slices_behind=1, n_slices_ahead=2, neb_kwargs=None):
+        """
+        Runs every stage, see the stage methods for the parameters.
+        :return:
+            Dictionary with keys mix_params, points_info, path_info and neb_path
+        """
+        mix_params, key = self.mixture(params_function, *params_args, seed=seed)
+        points_info, key = self.points(mix_params, key, n_spanning_gap, gap_proportion, shrink_in_direction)
+        field_tables, key = self.field_tables(points_info, mix_params, key, length_cutoff)
+        transition_components, key = self.transitions(points_info, mix_params, field_tables, key, length_cutoff,
+                                                      n_slices_behind, n_slices_ahead)
+        path_info, key = self.path(points_info, mix_params, transition_components, key, length_cutoff,
+                                   tuning_dist, tuning_strength, tuning_strength_diff,
+                                   n_spanning_gap, n_slices_behind, n_slices_ahead)
+        neb_path = None
+        if neb_kwargs is not None:
+            neb_path, key = self.neb(path_info, points_info, mix_params, key, **neb_kwargs)
+        return {'mix_params': mix_params,
+                'points_info': points_info,
+                'path_info': path_info,
+                'neb_path': neb_path}
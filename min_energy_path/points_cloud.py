@@ -0,0 +1,154 @@
+import numpy as np
+import scipy.linalg as scila
+import scipy.stats as stats
+from scipy.spatial import cKDTree
+from scipy.stats import qmc
+import warnings
+import logging
+
+from min_energy_path.points_sphere import create_sphere_basis, neighbour_adjacency_from_edges
+
+
+logger = logging.getLogger(__name__)
+
+
+def sample_tube(n_points, dimensions, tube_length, tube_radius, method='sobol', seed=None):
+    """
+    Samples points evenly spread through a tube (a cylinder with a (d-1)-ball cross section) using a low discrepancy
+    sequence. The tube starts at the origin and goes along the first axis.
+    :param n_points:
+        The number of points to sample
+    :param tube_length:
+        The length of the tube along the first axis
+    :param tube_radius:
+        The radius of the tube in the other axes
+    :param method:
+        'sobol' or 'halton', the scipy.stats.qmc sequence to use
+    :param seed:
+        Seed for the scrambling of the sequence
+    :return:
+        Matrix (d dimensions, n_points) of column vectors of the points
+    """
+    # One coordinate for the position along the tube, one for the distance from the centre of the tube
+    # and d-1 for the direction from the centre of the tube
+    n_uniform = dimensions + 1
+    if method == 'sobol':
+        # Sobol sequences are balanced for powers of 2, so make the next one up and keep the start of it
+        sampler = qmc.Sobol(n_uniform, scramble=True, seed=seed)
+        uniform = sampler.random_base2(int(np.ceil(np.log2(max(n_points, 1)))))[:n_points]
+    elif method == 'halton':
+        sampler = qmc.Halton(n_uniform, scramble=True, seed=seed)
+        uniform = sampler.random(n_points)
+    else:
+        raise ValueError(f"Unknown sampling method {method}, use 'sobol' or 'halton'")
+    uniform = np.clip(uniform.T, 1e-12, 1 - 1e-12)
+
+    along = uniform[0] * tube_length
+    # Uniform in the volume of the ball, the volume within radius r grows as r^(d-1)
+    radius = tube_radius * uniform[1] ** (1 / max(dimensions - 1, 1))
+    directions = stats.norm.ppf(uniform[2:])
+    directions /= scila.norm(directions, axis=0)
+    return np.concatenate([along[np.newaxis, :], radius * directions], axis=0)
+
+
+def create_cloud_points(minima, n_spanning_gap, n_points, n_neighbours=12, gap_proportion=0.7,
+                        radius_proportion=0.5, method='sobol', seed=None):
+    """
+    Creates a scattered cloud of points in a tube between (and a bit beyond) two minima, as an alternative to
+    create_sphere_points for high dimensions, where the number of points is set by n_points rather than
+    growing exponentially with the number of dimensions.
+    The points are split into slices along the direction between the minima in the same way as the sphere,
+    and the transitions between points are the edges of the k nearest neighbours graph.
+    The output can be used wherever the output of create_sphere_points is,
+    with the neighbours already stored (see get_neighbour_adjacency), apart from the grid based functions.
+    :param minima:
+        Matrix size (d dimensions, 2) column vectors of the two minima
+    :param n_spanning_gap:
+        The number of slices between the two minima including the two minima
+    :param n_points:
+        The number of points to sample, the two minima are added to these
+    :param n_neighbours:
+        The number of nearest neighbours each point can transition to. The graph is made symmetric,
+        so points can have more neighbours than this.
+        The neighbours need to reach into the next slices for a path to get from one minima to the other,
+        so more points need more neighbours, especially in low dimensions.
+    :param gap_proportion:
+        The proportion of the length of the tube that is spanned by the two minima
+    :param radius_proportion:
+        The radius of the tube as a proportion of the distance between the minima
+    :param method:
+        'sobol' or 'halton', see sample_tube
+    :param seed:
+        Seed for the sampling
+    :return:
+        The points_info dictionary
+    """
+    logger.info('Creating cloud points')
+
+    # Useful quantities, the same as for the sphere
+    dimensions = minima.shape[0]
+    minima_delta = minima[:, 1] - minima[:, 0]
+    minima_distance = scila.norm(minima_delta)
+    minima_direction = minima_delta / minima_distance
+    point_distance = minima_distance/(n_spanning_gap - 1)
+
+    n_total = (n_spanning_gap - 1) / gap_proportion
+    n_total -= (n_total - n_spanning_gap) % 2
+    n_total = int(round(n_total))
+    if n_total < n_spanning_gap + 2:
+        warnings.warn("n_spanning_gap and gap_proportion mean that there aren't enough slices "
+                      "for some to go behind the minima")
+    n_overflow = (n_total - n_spanning_gap)//2
+    first_point_pos = minima[:, 0] - minima_direction * point_distance * n_overflow
+
+    # Slice i is centred on i*point_distance along the tube
+    dir_component = np.arange(n_total)*point_distance
+    cloud_before = sample_tube(n_points, dimensions, n_total*point_distance, radius_proportion*minima_distance,
+                               method=method, seed=seed)
+    cloud_before[0] -= point_distance/2
+    minima_before = np.zeros((dimensions, 2))
+    minima_before[0] = dir_component[[n_overflow, n_overflow + n_spanning_gap - 1]]
+    cloud_before = np.concatenate([cloud_before, minima_before], axis=1)
+
+    # Put the points in order of the slices so that the neighbours of each point are in order of slice
+    order = np.argsort(cloud_before[0], kind='stable')
+    cloud_before = cloud_before[:, order]
+    sphere_index = np.arange(cloud_before.shape[1])
+    root_index, tail_index = np.argsort(order)[-2:]
+    dir_index = np.clip(np.round(cloud_before[0] / point_distance).astype(int), 0, n_total-1)
+
+    basis = create_sphere_basis(minima)
+    cloud = first_point_pos[:, np.newaxis] + basis @ cloud_before
+
+    logger.info(f'Cloud has {cloud.shape[1]} points')
+
+    # The k nearest neighbours graph, made symmetric so every transition can be taken in either direction
+    tree = cKDTree(cloud.T)
+    _, nearest = tree.query(cloud.T, k=min(n_neighbours+1, cloud.shape[1]))
+    rows = np.repeat(sphere_index, nearest.shape[1])
+    cols = nearest.ravel()
+    not_self = rows != cols
+    edges = np.unique(np.concatenate([
+        np.stack([rows[not_self], cols[not_self]]), np.stack([cols[not_self], rows[not_self]])
+    ], axis=1), axis=1)
+    neighbours = neighbour_adjacency_from_edges(
+        edges[0], edges[1], dir_index, int(np.max(np.abs(dir_index[edges[1]] - dir_index[edges[0]]), initial=0))
+    )
+    neighbours['length_cutoff'] = None
+
+    return {'sphere_before': cloud_before,
+            'sphere': cloud,
+            'sphere_index': sphere_index,
+            'dir_index': dir_index,  # Array sphere index => slice the point is in
+            'neighbours': neighbours,
+            'n_total': n_total,
+            'basis': basis,
+            'minima_distance': minima_distance,
+            'point_distance': point_distance,
+            'n_overflow': n_overflow,
+            'dir_component': dir_component,
+            'root_index': root_index,
+            'tail_index': tail_index,
+            'root_dir_index': dir_index[root_index],
+            'tail_dir_index': dir_index[tail_index]
+            }
@@ -3,6 +3,8 @@ import scipy.linalg as scila
 import warnings
 import logging
 
+from structured_dpp.instrumentation import timed, count
+
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +28,40 @@ def create_sphere_basis(minima):
     return np.concatenate((minima_direction[:, np.newaxis], basis), axis=1)
 
 
+def iterate_sphere_rows(dir_measurement, other_measurement, dimensions, sphere_radius):
+    """
+    Generates the grid positions inside the sphere one slice (row in the direction of the minima) at a time,
+    without creating the grid around the sphere.
+    The sphere is built up one dimension at a time, dropping positions already outside the sphere,
+    and the squares are summed in the same order as scila.norm so the same points are kept as a norm of the grid.
+    :param dir_measurement:
+        Vector of the position of each slice relative to the center of the sphere
+    :param other_measurement:
+        Vector of the position of each grid line in the other dimensions relative to the center of the sphere,
+        scaled for any shrinking of the sphere
+    :param dimensions:
+        The number of dimensions
+    :param sphere_radius:
+        Radius of the sphere
+    :return:
+        Generator of matrices (d-1 dimensions, n points in the slice) of the grid positions in the other dimensions,
+        in the order of the grid
+    """
+    other_squared = other_measurement * other_measurement
+    for dir_position in dir_measurement:
+        squared_sum = np.array([dir_position * dir_position])
+        in_sphere = np.sqrt(squared_sum) <= sphere_radius
+        positions = np.zeros((0, 1), dtype=int)[:, in_sphere]
+        squared_sum = squared_sum[in_sphere]
+        for _ in range(dimensions-1):
+            new_squared_sum = squared_sum[:, np.newaxis] + other_squared[np.newaxis, :]
+            keep_position, keep_step = np.nonzero(np.sqrt(new_squared_sum) <= sphere_radius)
+            positions = np.concatenate([positions[:, keep_position], keep_step[np.newaxis, :]])
+            squared_sum = new_squared_sum[keep_position, keep_step]
+        yield positions
+
+
+@timed('create_sphere_points')
 def create_sphere_points(minima, n_spanning_gap, gap_proportion=0.7, shrink_in_direction=1.0):
     """
     Creates the sphere of points between two minima
@@ -64,18 +100,22 @@ def create_sphere_points(minima, n_spanning_gap, gap_proportion=0.7, shrink_in_d
     # Where is the first point located?
     first_point_pos = minima[:, 0] - minima_direction * point_distance * n_overflow
 
-    # Create a grid
+    # Find the points of the grid that are in the sphere, one slice in the direction of the minima at a time
     dir_component = np.arange(n_total)*point_distance
     other_component = np.arange(-n_horizontal, n_horizontal+1)*point_distance
-    other_components = np.tile(other_component, (dimensions-1, 1))
-    grid_griddy = np.meshgrid(dir_component, *other_components, indexing='ij')
-    grid_flattened = np.array([component.flatten() for component in grid_griddy])  # This turns the grid into column vectors
-
-    measurement_grid = grid_flattened.copy()
-    measurement_grid[0, :] -= np.max(dir_component)/2
-    measurement_grid[1:, :] /= shrink_in_direction
-    in_sphere = scila.norm(measurement_grid, axis=0) <= sphere_radius
-    sphere_before = grid_flattened[:, in_sphere]
+    grid_shape = (dir_component.size,) + (other_component.size,)*(dimensions-1)
+    dir_measurement = dir_component - np.max(dir_component)/2
+    other_measurement = other_component / shrink_in_direction
+    grid_index = np.concatenate(
+        [np.empty((dimensions, 0), dtype=int)] + [
+            np.concatenate([np.full((1, row.shape[1]), dir_index), row])
+            for dir_index, row in enumerate(
+                iterate_sphere_rows(dir_measurement, other_measurement, dimensions, sphere_radius)
+            )
+        ],
+        axis=1
+    )
+    sphere_before = np.concatenate([dir_component[grid_index[:1]], other_component[grid_index[1:]]])
 
     basis = create_sphere_basis(minima)
     sphere = first_point_pos[:, np.newaxis] + basis @ sphere_before
@@ -83,29 +123,27 @@ def create_sphere_points(minima, n_spanning_gap, gap_proportion=0.7, shrink_in_d
     logger.info(f'Sphere has {sphere.shape[1]} points')
 
     # Find the minima indices
-    root_index, tail_index = None, None
-    for i, point in enumerate(sphere.T):
-        if np.allclose(point, minima[:, 0]):
-            root_index = i
-        if np.allclose(point, minima[:, 1]):
-            tail_index = i
-    if None in [root_index, tail_index]:
+    is_root = np.flatnonzero(np.all(np.isclose(sphere, minima[:, [0]]), axis=0))
+    is_tail = np.flatnonzero(np.all(np.isclose(sphere, minima[:, [1]]), axis=0))
+    if is_root.size == 0 or is_tail.size == 0:
         raise ValueError("Couldn't find root or tail index.")
-    root_dir_index = np.where(dir_component == sphere_before[0, root_index])[0][0]
-    tail_dir_index = np.where(dir_component == sphere_before[0, tail_index])[0][0]
+    root_index, tail_index = is_root[-1], is_tail[-1]
+    root_dir_index = grid_index[0, root_index]
+    tail_dir_index = grid_index[0, tail_index]
 
     # Sphere index stuff
+    # The points are in the order of the grid, so spherey_index_index is sorted and can be searched
     sphere_index = np.arange(sphere.shape[1])
-    spherey_index = np.ones(grid_flattened.shape[1]) * -1
-    spherey_index[in_sphere] = sphere_index
-    spherey_index = spherey_index.reshape(grid_griddy[0].shape).astype(int)
-    spherey_index_index = np.arange(grid_flattened.shape[1])[in_sphere].copy()
+    spherey_index_index = np.ravel_multi_index(grid_index, grid_shape)
+    count('sphere_points', sphere.shape[1])
 
     return {'sphere_before': sphere_before,
             'sphere': sphere,
             'sphere_index': sphere_index,
-            'spherey_index': spherey_index,  # A grid whos elements are the 2D index of the elements in the sphere array
-            'spherey_index_index': spherey_index_index,  # Array sphere index => grid index of spherey flattened
+            'grid_shape': grid_shape,  # The shape of the grid the sphere is cut out of
+            'spherey_index_index': spherey_index_index,  # Array sphere index => index in the flattened grid, sorted
+            'grid_index': grid_index,  # Matrix (d dimensions, n points) of the position of each point in the grid
+            'dir_index': grid_index[0],  # Array sphere index => slice the point is in
             'n_total': n_total,
             'basis': basis,
             'minima_distance': minima_distance,
@@ -171,34 +209,250 @@ def get_nearby_sphere_indexes(center_index, n_around, points_info,
     if not return_lower:
         slices_behind = 0
 
-    # Get the 3D index of the center in the spherey index
-    c_spherey_idx_idx = points_info['spherey_index_index'][center_index]
-    c_unraveled_idx = np.unravel_index(c_spherey_idx_idx, points_info['spherey_index'].shape)
-
-    # Slice a grid around the center in the spherey index
-    indices_to_scan = points_info['spherey_index'][
-        (
-            slice(
-                max(c_unraveled_idx[0]-slices_behind, min_dir_index),
-                (
-                    c_unraveled_idx[0]+1+slices_ahead
-                    if max_dir_index is None else
-                    min(c_unraveled_idx[0]+1+slices_ahead, max_dir_index)
-                )
-            ),
-        ) + tuple(
-            slice(max(dim_index-n_around, 0), dim_index+1+n_around)
-            for dim_index in c_unraveled_idx[1:]
+    # Get the position of the center in the grid
+    center_grid_index = points_info['grid_index'][:, center_index]
+    grid_shape = points_info['grid_shape']
+
+    # Look up every grid position in a box around the center
+    box_ranges = [
+        np.arange(
+            max(center_grid_index[0]-slices_behind, min_dir_index),
+            min(
+                center_grid_index[0]+1+slices_ahead if max_dir_index is None else
+                min(center_grid_index[0]+1+slices_ahead, max_dir_index),
+                grid_shape[0]
+            )
         )
+    ] + [
+        np.arange(max(dim_index-n_around, 0), min(dim_index+1+n_around, dim_size))
+        for dim_index, dim_size in zip(center_grid_index[1:], grid_shape[1:])
     ]
+    box_grid_coords = np.array([component.ravel() for component in np.meshgrid(*box_ranges, indexing='ij')])
+    indices_to_scan = grid_to_sphere_index(box_grid_coords, points_info)
+
     if return_lower and not return_center:
-        return indices_to_scan[~np.isin(indices_to_scan, [-1, center_index])]
-    if return_lower and return_center:
-        return indices_to_scan[indices_to_scan >= 0]
-    if not return_lower and return_center:
-        return indices_to_scan[indices_to_scan >= center_index]
-    if not return_lower and not return_center:
-        return indices_to_scan[indices_to_scan > center_index]
+        indices_to_scan = indices_to_scan[~np.isin(indices_to_scan, [-1, center_index])]
+    elif return_lower and return_center:
+        indices_to_scan = indices_to_scan[indices_to_scan >= 0]
+    elif not return_lower and return_center:
+        indices_to_scan = indices_to_scan[indices_to_scan >= center_index]
+    else:
+        indices_to_scan = indices_to_scan[indices_to_scan > center_index]
+    return indices_to_scan.tolist()
+
+
+def grid_to_sphere_index(grid_coords, points_info):
+    """
+    Looks up the sphere index of points given by their position in the grid.
+    :param grid_coords:
+        Matrix (d dimensions, n points) of integer positions in the grid
+    :param points_info:
+        The points_info dictionary, see function create_sphere_points
+    :return:
+        Vector (n points,) of sphere indices, -1 where the grid position is not in the sphere
+    """
+    grid_shape = points_info['grid_shape']
+    in_grid = np.all((grid_coords >= 0) & (grid_coords < np.array(grid_shape)[:, np.newaxis]), axis=0)
+    sphere_indices = np.full(grid_coords.shape[1], -1)
+
+    # The sphere's flattened grid indices are sorted, so they can be searched rather than storing the whole grid
+    flat_index = np.ravel_multi_index(grid_coords[:, in_grid], grid_shape)
+    spherey_index_index = points_info['spherey_index_index']
+    position = np.minimum(np.searchsorted(spherey_index_index, flat_index), spherey_index_index.size-1)
+    found = spherey_index_index[position] == flat_index
+    sphere_indices[np.flatnonzero(in_grid)[found]] = position[found]
+    return sphere_indices
+
+
+def _ball_offsets(dimensions, radius):
+    """
+    All the integer offsets with an L2 norm of at most radius, in lexicographic order, excluding the zero offset.
+    The ball is built one dimension at a time so the surrounding cube is never created.
+    :return:
+        Matrix (n offsets, d dimensions)
+    """
+    steps = np.arange(-radius, radius+1)
+    offsets = np.zeros((1, 0), dtype=int)
+    offsets_sq = np.zeros(1, dtype=int)
+    for _ in range(dimensions):
+        new_offsets_sq = offsets_sq[:, np.newaxis] + steps[np.newaxis, :]**2
+        keep_offset, keep_step = np.nonzero(new_offsets_sq <= radius**2)
+        offsets = np.concatenate([offsets[keep_offset], steps[keep_step, np.newaxis]], axis=1)
+        offsets_sq = new_offsets_sq[keep_offset, keep_step]
+    return offsets[np.any(offsets != 0, axis=1)]
+
+
+def create_neighbour_adjacency(points_info, length_cutoff):
+    """
+    Works out the neighbours of every point in the sphere, those within length_cutoff grid steps, as a CSR structure.
+    The neighbours of point i are indices[indptr[i]:indptr[i+1]], sorted by sphere index,
+    which also sorts them by the slice they are in.
+    slice_ptr[i, k] is where the neighbours of i that are k - max_slice_offset slices ahead of i start,
+    so that the neighbours within a range of slices is a contiguous sub-range, see get_neighbour_window.
+    :param points_info:
+        The points_info dictionary, see function create_sphere_points
+    :param int length_cutoff:
+        The maximum distance to a neighbour, in units of point_distance
+    :return:
+        Dictionary with keys indptr, indices, slice_ptr, max_slice_offset and length_cutoff
+    """
+    logger.info('Creating neighbour adjacency')
+    grid_index = points_info['grid_index']
+    offsets = _ball_offsets(grid_index.shape[0], length_cutoff)
+
+    rows, cols = [], []
+    for offset in offsets:
+        neighbours = grid_to_sphere_index(grid_index + offset[:, np.newaxis], points_info)
+        found = np.flatnonzero(neighbours >= 0)
+        rows.append(found)
+        cols.append(neighbours[found])
+
+    neighbours = neighbour_adjacency_from_edges(np.concatenate(rows), np.concatenate(cols),
+                                                points_info['dir_index'], length_cutoff)
+    neighbours['length_cutoff'] = length_cutoff
+    return neighbours
+
+
+def neighbour_adjacency_from_edges(rows, cols, dir_index, max_slice_offset):
+    """
+    Makes the neighbour adjacency structure described in create_neighbour_adjacency from a list of edges.
+    :param rows:
+        Array of the point each edge is from
+    :param cols:
+        Array of the neighbour each edge goes to, with no repeated edges
+    :param dir_index:
+        Array sphere index => slice the point is in,
+        the points must be in order of slice for the neighbours in a range of slices to be contiguous
+    :param max_slice_offset:
+        The largest number of slices any edge spans
+    :return:
+        Dictionary with keys indptr, indices, slice_ptr and max_slice_offset
+    """
+    n_points = dir_index.size
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    dir_offsets = dir_index[cols] - dir_index[rows]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_points))])
+
+    n_slice_offsets = 2*max_slice_offset + 1
+    slice_counts = np.bincount(rows*n_slice_offsets + dir_offsets + max_slice_offset,
+                               minlength=n_points*n_slice_offsets).reshape(n_points, n_slice_offsets)
+    slice_ptr = indptr[:-1, np.newaxis] + np.concatenate(
+        [np.zeros((n_points, 1), dtype=int), np.cumsum(slice_counts, axis=1)], axis=1
+    )
+
+    logger.info(f'Neighbour adjacency has {cols.size} entries')
+    return {'indptr': indptr,
+            'indices': cols,
+            'slice_ptr': slice_ptr,
+            'max_slice_offset': max_slice_offset}
+
+
+def get_neighbour_adjacency(points_info, length_cutoff):
+    """
+    Gets the neighbour adjacency stored in points_info, creating and storing it if it doesn't exist yet
+    or was made for a different length_cutoff. See create_neighbour_adjacency.
+    Adjacencies with a length_cutoff of None are fixed, like the nearest neighbours of a point cloud, and always used.
+    """
+    neighbours = points_info.get('neighbours', None)
+    if neighbours is None or neighbours['length_cutoff'] not in (None, length_cutoff):
+        neighbours = create_neighbour_adjacency(points_info, length_cutoff)
+        points_info['neighbours'] = neighbours
+    return neighbours
+
+
+def get_neighbour_window(center_index, points_info, min_dir_index=0, max_dir_index=None):
+    """
+    Get the neighbours of a point that are in a range of slices, using the adjacency made by get_neighbour_adjacency.
+    :param center_index:
+        The index of the column in the sphere matrix corresponding to the point
+    :param points_info:
+        The points_info dictionary, see function create_sphere_points
+    :param min_dir_index:
+        The minimum slice layer for which points can be returned
+    :param max_dir_index:
+        The upper value for the slice layer for which points can be returned, the same as get_nearby_sphere_indexes.
+    :return:
+        Array of sphere indices, a view into the adjacency
+    """
+    neighbours = points_info['neighbours']
+    max_slice_offset = neighbours['max_slice_offset']
+    center_dir_index = points_info['dir_index'][center_index]
+    lower = min(max(min_dir_index - center_dir_index + max_slice_offset, 0), 2*max_slice_offset + 1)
+    upper = 2*max_slice_offset + 1 if max_dir_index is None else \
+        min(max(max_dir_index - center_dir_index + max_slice_offset, lower), 2*max_slice_offset + 1)
+    slice_ptr = neighbours['slice_ptr'][center_index]
+    return neighbours['indices'][slice_ptr[lower]:slice_ptr[upper]]
+
+
+def get_neighbour_window_bounds(center_indices, points_info, min_dir_indices, max_dir_indices):
+    """
+    The same as get_neighbour_window for many points at once,
+    but gives where the windows are in the adjacency rather than the neighbours in them.
+    :param center_indices:
+        Array of the points
+    :param min_dir_indices:
+        Array of the minimum slice layer for each point
+    :param max_dir_indices:
+        Array of the upper value for the slice layer for each point
+    :return:
+        Arrays of the start and end of each window in neighbours['indices']
+    """
+    neighbours = points_info['neighbours']
+    max_slice_offset = neighbours['max_slice_offset']
+    center_dir_indices = points_info['dir_index'][center_indices]
+    lower = np.clip(min_dir_indices - center_dir_indices + max_slice_offset, 0, 2*max_slice_offset + 1)
+    upper = np.clip(np.maximum(max_dir_indices - center_dir_indices + max_slice_offset, lower),
+                    0, 2*max_slice_offset + 1)
+    slice_ptr = neighbours['slice_ptr'][center_indices]
+    rows = np.arange(center_indices.size)
+    return slice_ptr[rows, lower], slice_ptr[rows, upper]
+
+
+def restrict_points(points_info, keep):
+    """
+    Makes a points_info with only some of the points, for example after pruning them.
+    The points keep their order, and are given new sphere indices.
+    The stored neighbour adjacency is restricted to the kept points too.
+    :param points_info:
+        The points_info dictionary, see function create_sphere_points or create_cloud_points
+    :param keep:
+        Boolean array (n points,), whether to keep each point. The root and the tail must be kept.
+    :return:
+        The new points_info dictionary, with 'original_index' added as an array new sphere index => sphere index in
+        the points_info the points were first created in
+    """
+    keep = np.asarray(keep, dtype=bool)
+    if not (keep[points_info['root_index']] and keep[points_info['tail_index']]):
+        raise ValueError("The root and tail points can't be removed.")
+    new_index = np.cumsum(keep) - 1
+    kept_index = np.flatnonzero(keep)
+
+    restricted = dict(points_info)
+    restricted['sphere_index'] = np.arange(kept_index.size)
+    restricted['original_index'] = points_info.get('original_index', points_info['sphere_index'])[kept_index]
+    restricted['root_index'] = new_index[points_info['root_index']]
+    restricted['tail_index'] = new_index[points_info['tail_index']]
+    for key in ['sphere_before', 'sphere', 'grid_index']:
+        if key in points_info:
+            restricted[key] = points_info[key][:, kept_index]
+    for key in ['spherey_index_index', 'dir_index']:
+        if key in points_info:
+            restricted[key] = points_info[key][kept_index]
+
+    neighbours = points_info.get('neighbours', None)
+    if neighbours is not None:
+        rows = np.repeat(points_info['sphere_index'], np.diff(neighbours['indptr']))
+        cols = neighbours['indices']
+        both_kept = keep[rows] & keep[cols]
+        restricted['neighbours'] = neighbour_adjacency_from_edges(
+            new_index[rows[both_kept]], new_index[cols[both_kept]], restricted['dir_index'],
+            neighbours['max_slice_offset']
+        )
+        restricted['neighbours']['length_cutoff'] = neighbours['length_cutoff']
+
+    logger.info(f'Restricted to {kept_index.size} of {keep.size} points')
+    return restricted
 
 
 if __name__ == "__main__":
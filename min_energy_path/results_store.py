@@ -0,0 +1,168 @@
+"""
+An append only store of the results of many runs, e.g. one record per trial of an experiment.
+
+The records are stored column by column in compressed npz chunks, with an index.json of the chunks and columns,
+so a statistic of a few columns can be worked out by streaming over the chunks, only reading those columns.
+Columns are either scalar (one number or string per record) or ragged (a 1D array per record, of any length,
+stored as the concatenated values and the offset of each record).
+"""
+import os
+import json
+import numpy as np
+
+
+class ResultsStore:
+    """
+    Usage:
+        with ResultsStore('results/6d') as store:
+            store.append({'seed': 3, 'mrf_max': 0.2, 'mrf_ep': np.array([...])})
+        for chunk in ResultsStore('results/6d').iter_chunks(['mrf_max']):
+            ...
+    """
+    INDEX_NAME = 'index.json'
+
+    def __init__(self, directory, chunk_size=256):
+        """
+        :param directory:
+            The directory of the store, made if it doesn't exist. An existing store is appended to.
+        :param chunk_size:
+            The number of records in each chunk
+        """
+        self.directory = directory
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+        index_path = os.path.join(directory, self.INDEX_NAME)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'columns': {}, 'chunks': []}
+        self.index.setdefault('dtype_kinds', {})  # Scalar column name => numpy dtype kind, e.g. 'U' for strings
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    @property
+    def columns(self):
+        """Dictionary of column name => 'scalar' or 'ragged'"""
+        return self.index['columns']
+
+    def __len__(self):
+        return sum(chunk['n_records'] for chunk in self.index['chunks']) + len(self._buffer)
+
+    def append(self, record):
+        """
+        Add a record, a dictionary of column name => number, string or 1D array.
+        Records are written when there are chunk_size of them waiting, or on flush.
+        """
+        for name, value in record.items():
+            kind = 'ragged' if np.ndim(value) > 0 else 'scalar'
+            if self.columns.setdefault(name, kind) != kind:
+                raise ValueError(f'Column {name} is {self.columns[name]} but was given a {kind} value')
+        self._buffer.append(record)
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def flush(self):
+        """Write the waiting records as a new chunk"""
+        if not self._buffer:
+            return
+        arrays = {}
+        for name, kind in self.columns.items():
+            present = [name in record for record in self._buffer]
+            if not any(present):
+                continue
+            if kind == 'scalar':
+                values = [record.get(name) for record in self._buffer]
+                if any(isinstance(value, str) for value in values):
+                    self.index['dtype_kinds'][name] = 'U'
+                fill = self._missing_scalar(name)
+                arrays[name] = np.array([fill if value is None else value for value in values])
+                self.index['dtype_kinds'].setdefault(name, arrays[name].dtype.kind)
+            else:
+                values = [np.asarray(record.get(name, []), dtype=float).ravel() for record in self._buffer]
+                arrays[f'{name}/values'] = np.concatenate(values)
+                arrays[f'{name}/offsets'] = np.concatenate([[0], np.cumsum([value.size for value in values])])
+            arrays[f'{name}/present'] = np.array(present)
+
+        chunk_name = f'chunk-{len(self.index["chunks"]):05d}.npz'
+        # Write to temporary files first so a half written chunk or index is never loaded
+        temporary_path = os.path.join(self.directory, chunk_name[:-len('.npz')] + '.tmp.npz')
+        np.savez_compressed(temporary_path, **arrays)
+        os.replace(temporary_path, os.path.join(self.directory, chunk_name))
+        self.index['chunks'].append({'file': chunk_name, 'n_records': len(self._buffer)})
+        self._buffer = []
+
+        index_path = os.path.join(self.directory, self.INDEX_NAME)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def iter_chunks(self, columns=None):
+        """
+        Iterate over the written chunks, only reading the columns asked for.
+        :param columns:
+            (Optional) The columns to read, by default all of them
+        :return:
+            Generator of dictionaries of column name => array (n records in chunk,) for scalar columns
+            or list of arrays for ragged columns. Records without a value have nan (or '') or an empty array.
+        """
+        columns = list(self.columns) if columns is None else columns
+        for chunk in self.index['chunks']:
+            with np.load(os.path.join(self.directory, chunk['file'])) as stored:
+                arrays = {}
+                for name in columns:
+                    if self.columns.get(name) == 'ragged' and f'{name}/values' in stored.files:
+                        offsets = stored[f'{name}/offsets']
+                        arrays[name] = np.split(stored[f'{name}/values'], offsets[1:-1])
+                    elif self.columns.get(name) == 'scalar' and name in stored.files:
+                        arrays[name] = stored[name]
+                    elif self.columns.get(name) == 'ragged':
+                        arrays[name] = [np.empty(0) for _ in range(chunk['n_records'])]
+                    else:
+                        arrays[name] = np.full(chunk['n_records'], self._missing_scalar(name))
+                yield arrays
+
+    def _missing_scalar(self, name):
+        """The value of a scalar column for records without one, '' for strings otherwise nan"""
+        return '' if self.index['dtype_kinds'].get(name) == 'U' else np.nan
+
+    def column(self, name):
+        """
+        The whole of a column
+        :return:
+            Array (n records,) for a scalar column or list of arrays for a ragged column
+        """
+        chunks = [chunk[name] for chunk in self.iter_chunks([name])]
+        if self.columns[name] == 'ragged':
+            return [value for chunk in chunks for value in chunk]
+        return np.concatenate(chunks) if chunks else np.empty(0)
+
+    def iter_records(self, columns=None):
+        """Iterate over the written records, as dictionaries of column name => value"""
+        for chunk in self.iter_chunks(columns):
+            n_records = len(next(iter(chunk.values()))) if chunk else 0
+            for i in range(n_records):
+                yield {name: values[i] for name, values in chunk.items()}
+
+    def reduce(self, function, columns, initial=0):
+        """
+        Stream a statistic over the store one chunk at a time, e.g. the number of records where x > y with
+        store.reduce(lambda total, chunk: total + np.sum(chunk['x'] > chunk['y']), ['x', 'y'])
+        :param function:
+            function(accumulated, chunk) returning the new accumulated value, chunk as from iter_chunks
+        :param columns:
+            The columns function needs
+        """
+        accumulated = initial
+        for chunk in self.iter_chunks(columns):
+            accumulated = function(accumulated, chunk)
+        return accumulated
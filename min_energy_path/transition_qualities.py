@@ -0,0 +1,265 @@
+"""
+Compact storage for the transition qualities between points in the sphere.
+
+The qualities are a sparse matrix transition_qualities[rootwards][leafwards], stored in CSR form
+(indptr, indices, data) rather than as a dictionary of dictionaries,
+but can still be read like the dictionaries they replace.
+"""
+import numpy as np
+
+
+def concatenate_ranges(starts, ends):
+    """
+    The concatenation of np.arange(start, end) for each start and end, without a Python loop.
+    :return:
+        Array of all the positions in the ranges, and the array of the range each position belongs to
+    """
+    lengths = ends - starts
+    range_starts = np.cumsum(lengths) - lengths
+    positions = np.arange(np.sum(lengths)) + np.repeat(starts - range_starts, lengths)
+    return positions, np.repeat(np.arange(starts.size), lengths)
+
+
+def transpose_csr(indptr, indices, n_points):
+    """
+    Transposes the structure of a square sparse matrix in CSR form, keeping the columns of each row sorted.
+    :return:
+        indptr_t, indices_t and the permutation taking data to data_t
+    """
+    rows = np.repeat(np.arange(n_points, dtype=indices.dtype), np.diff(indptr))
+    order = np.argsort(indices, kind='stable').astype(indices.dtype)
+    indptr_t = np.concatenate([[0], np.cumsum(np.bincount(indices, minlength=n_points))])
+    return indptr_t, rows[order], order
+
+
+class TransitionRow:
+    """
+    The qualities from one rootwards point, read only, behaving like the {leafwards: quality} dictionary.
+    """
+    __slots__ = ('indices', 'data')
+
+    def __init__(self, indices, data):
+        self.indices = indices
+        self.data = data
+
+    def _position(self, key):
+        position = np.searchsorted(self.indices, key)
+        if position < self.indices.size and self.indices[position] == key:
+            return position
+        return None
+
+    def get(self, key, default=None):
+        position = self._position(key)
+        return default if position is None else self.data[position]
+
+    def __getitem__(self, key):
+        position = self._position(key)
+        if position is None:
+            raise KeyError(key)
+        return self.data[position]
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def __len__(self):
+        return self.indices.size
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def keys(self):
+        return self.indices
+
+    def values(self):
+        return self.data
+
+    def items(self):
+        return zip(self.indices, self.data)
+
+
+class TransitionQualities:
+    """
+    The transition qualities transition_qualities[rootwards][leafwards] as a sparse matrix in CSR form.
+    A row exists for every point, rows of points with no transitions are empty.
+    Reading is the same as for a dictionary of dictionaries, e.g. transition_qualities[fromm].get(to, 0)
+    """
+    def __init__(self, indptr, indices, data, with_transpose=False):
+        """
+        :param indptr:
+            Array (n_points+1,), the transitions from point i are in positions indptr[i]:indptr[i+1]
+        :param indices:
+            Array (n transitions,), the leafwards point of each transition, sorted within each row
+        :param data:
+            Array (n transitions,), the quality of each transition
+        :param with_transpose:
+            Whether to make the transposed copy, with a row for each leafwards point, straight away.
+            Otherwise it is only made when first asked for.
+        """
+        self.indptr = np.asarray(indptr)
+        self.indices = np.asarray(indices)
+        self.data = np.asarray(data)
+        self._transpose = None
+        if with_transpose:
+            self.transposed()
+
+    @classmethod
+    def from_coo(cls, rows, cols, data, n_points, dtype=np.float64, with_transpose=False):
+        """
+        Create from arrays of the rootwards point, leafwards point and quality of each transition, in any order.
+        :param dtype:
+            The dtype to store the qualities with, float32 halves the memory used.
+        """
+        order = np.lexsort((cols, rows))
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=n_points))])
+        index_dtype = np.int32 if n_points < np.iinfo(np.int32).max else np.int64
+        return cls(indptr, np.asarray(cols)[order].astype(index_dtype), np.asarray(data)[order].astype(dtype),
+                   with_transpose=with_transpose)
+
+    @classmethod
+    def from_dict(cls, transition_qualities, n_points, dtype=np.float64, with_transpose=False):
+        """
+        Create from a transition_qualities[rootwards][leafwards] dictionary of dictionaries.
+        """
+        rows = np.fromiter((fromm for fromm, tos in transition_qualities.items() for _ in range(len(tos))), dtype=int)
+        cols = np.fromiter((to for tos in transition_qualities.values() for to in tos), dtype=int)
+        data = np.fromiter((quality for tos in transition_qualities.values() for quality in tos.values()),
+                           dtype=float)
+        return cls.from_coo(rows, cols, data, n_points, dtype=dtype, with_transpose=with_transpose)
+
+    def with_data(self, data, dtype=None):
+        """
+        A new TransitionQualities with the same transitions but different qualities, sharing the index arrays.
+        :param data:
+            Array (n transitions,) in the same order as self.data
+        :param dtype:
+            The dtype to store the qualities with, by default the same as self.data
+        """
+        new = TransitionQualities(self.indptr, self.indices,
+                                  np.asarray(data, dtype=self.data.dtype if dtype is None else dtype))
+        if self._transpose is not None:
+            indptr_t, indices_t, order, _ = self._transpose
+            new._transpose = (indptr_t, indices_t, order, new.data[order])
+        return new
+
+    @property
+    def n_points(self):
+        return self.indptr.size - 1
+
+    @property
+    def n_transitions(self):
+        return self.indices.size
+
+    @property
+    def csr(self):
+        """The matrix with a row for each rootwards point, as (indptr, indices, data)"""
+        return self.indptr, self.indices, self.data
+
+    def transposed(self):
+        """The matrix with a row for each leafwards point, as (indptr, indices, data)"""
+        if self._transpose is None:
+            indptr_t, indices_t, order = transpose_csr(self.indptr, self.indices, self.n_points)
+            self._transpose = (indptr_t, indices_t, order, self.data[order])
+        indptr_t, indices_t, _, data_t = self._transpose
+        return indptr_t, indices_t, data_t
+
+    @property
+    def nbytes(self):
+        """The memory used by the arrays, including the transposed copy if it has been made"""
+        nbytes = self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+        if self._transpose is not None:
+            nbytes += sum(array.nbytes for array in self._transpose)
+        return nbytes
+
+    def to_dict(self):
+        return {fromm: dict(row.items()) for fromm, row in self.items()}
+
+    # Dictionary reading
+    def __getitem__(self, fromm):
+        start, end = self.indptr[fromm], self.indptr[fromm + 1]
+        return TransitionRow(self.indices[start:end], self.data[start:end])
+
+    def get(self, fromm, default=None):
+        if 0 <= fromm < self.n_points:
+            return self[fromm]
+        return default
+
+    def __contains__(self, fromm):
+        return 0 <= fromm < self.n_points and self.indptr[fromm + 1] > self.indptr[fromm]
+
+    def keys(self):
+        """The points with transitions from them"""
+        return np.flatnonzero(np.diff(self.indptr))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.keys().size
+
+    def values(self):
+        return (self[fromm] for fromm in self.keys())
+
+    def items(self):
+        return ((fromm, self[fromm]) for fromm in self.keys())
+
+    def __repr__(self):
+        return f'TransitionQualities({self.n_transitions} transitions, {self.nbytes / 1e6:.1f}MB)'
+
+
+class TransitionComponents:
+    """
+    The raw components of the transition qualities, which don't depend on the tuning parameters,
+    so qualities for any tuning parameters are quick to make: qualities = exp(weights @ components).
+    The components of each transition are
+    - distance: the length of the transition in units of point_distance
+    - strength: the mean field strength of the midpoint and the leafwards point, normalised by the mixture
+    - strength_diff: how far the field goes up from the rootwards point, normalised by the mixture
+    """
+    COMPONENTS = ('distance', 'strength', 'strength_diff')
+
+    def __init__(self, structure: TransitionQualities, components):
+        """
+        :param structure:
+            TransitionQualities with the transitions, whose index arrays and transpose are shared by all the qualities
+        :param components:
+            Matrix (n components, n transitions) in the same order as structure.data
+        """
+        self.structure = structure
+        self.components = np.asarray(components)
+
+    @classmethod
+    def from_coo(cls, rows, cols, components, n_points):
+        """
+        Create from arrays of the rootwards point, leafwards point and components (n components, n transitions)
+        of each transition, in any order.
+        """
+        # Sort the order of the transitions along with them
+        structure = TransitionQualities.from_coo(rows, cols, np.arange(len(cols)), n_points, dtype=np.int64)
+        components = np.asarray(components, dtype=np.float64)[:, structure.data]
+        return cls(TransitionQualities(structure.indptr, structure.indices, components[0]), components)
+
+    @property
+    def n_transitions(self):
+        return self.structure.n_transitions
+
+    @property
+    def nbytes(self):
+        """The memory used by the arrays, the structure's data is a view of the components"""
+        return self.structure.nbytes - self.structure.data.nbytes + self.components.nbytes
+
+    @staticmethod
+    def weights(tuning_dist, tuning_strength, tuning_strength_diff):
+        """The weights of the components for some tuning parameters, every component is a penalty"""
+        return -np.array([tuning_dist, tuning_strength, tuning_strength_diff])
+
+    def qualities(self, tuning_dist, tuning_strength, tuning_strength_diff, dtype=np.float64):
+        """
+        The transition qualities for some tuning parameters, sharing the transitions (and their transpose)
+        with every other set of qualities made from these components.
+        :return:
+            TransitionQualities
+        """
+        weights = self.weights(tuning_dist, tuning_strength, tuning_strength_diff)
+        self.structure.transposed()  # Made once here rather than once for every set of qualities
+        return self.structure.with_data(np.exp(weights @ self.components), dtype=dtype)
+
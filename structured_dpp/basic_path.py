@@ -67,7 +67,7 @@ factor_for_root = SDPPFactor(get_quality=root_var_quality,
                              name='Fac0')
 # Then create the rest in a chain
 current_var = root
-nodes_created = [root, factor_for_root]
+variables, transition_factors, one_var_factors = [root], [], [factor_for_root]
 for i in range(1, N_VARIABLES):
     transition_factor = SDPPFactor(get_quality=transition_quality,
                                    get_diversity=zero_diversity,
@@ -80,7 +80,9 @@ for i in range(1, N_VARIABLES):
                                 get_diversity_matrix=one_var_diversity_matrix,
                                 parent=current_var,
                                 name=f'Fac{i}')
-    nodes_created.extend((transition_factor, current_var, one_var_factor))
+    variables.append(current_var)
+    transition_factors.append(transition_factor)
+    one_var_factors.append(one_var_factor)
 # i += 1
 # transition_factor = SDPPFactor(get_quality=transition_quality,
 #                                get_diversity=zero_diversity,
@@ -93,9 +95,11 @@ for i in range(1, N_VARIABLES):
 #                             get_diversity_matrix=one_var_diversity_matrix,
 #                             parent=current_var,
 #                             name=f'Fac{i}')
-# nodes_created.extend((transition_factor, current_var, one_var_factor))
+# variables.append(current_var)
+# transition_factors.append(transition_factor)
+# one_var_factors.append(one_var_factor)
 
-ftree = SDPPFactorTree.create_from_connected_nodes(nodes_created)
+ftree = SDPPFactorTree.chain(variables, transition_factors, one_var_factors)
 
 
 def plot_path_assignments(assignments, ftree, title, fname=None):
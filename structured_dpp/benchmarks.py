@@ -0,0 +1,335 @@
+"""
+Benchmarks of the message passing in structured_dpp, to judge changes to the engine on numbers.
+
+The trees are chains of variables like basic_path.py: a root variable with a quality factor, and width chains
+hanging from it, each of length variables joined by transition factors and with a diversity factor on every
+variable. They are parameterised by
+- length: the number of variables in each chain
+- width: the number of chains from the root
+- n_positions: the domain size of every variable
+- n_dims: the dimension D of the diversity features
+
+Run from the top of the repo with
+    python -m structured_dpp.benchmarks                  # Compare against the stored baseline
+    python -m structured_dpp.benchmarks --save-baseline  # Replace the stored baseline
+A benchmark regresses when its best time is more than threshold slower than the baseline.
+Baselines are only comparable on the same machine, so save one before changing the engine.
+A baseline saved on a different machine, python or numpy isn't compared against unless --ignore-machine is given.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import logging
+import numpy as np
+import scipy.stats as scistat
+
+from structured_dpp.factor_tree import (SDPPFactorTree, SDPPFactor, Variable, assignment_to_var_arguments,
+                                        QualityOnlySamplingRun)
+
+
+logger = logging.getLogger(__name__)
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+DEFAULT_THRESHOLD = 0.25
+
+BASE_CASE = {'length': 10, 'width': 1, 'n_positions': 10, 'n_dims': 10}
+# Each parameter is swept with the others at the base case
+SWEEPS = {
+    'length': (10, 40),
+    'width': (1, 4),
+    'n_positions': (10, 25),
+    'n_dims': (10, 50),
+}
+
+
+def build_chain_tree(length, width=1, n_positions=10, n_dims=10, movement_scale=1):
+    """
+    Make an SDPPFactorTree of width chains of variables from a root variable, as in basic_path.py
+    :param length:
+        The number of variables in each chain, after the root
+    :param width:
+        The number of chains from the root variable
+    :param n_positions:
+        The number of values each variable can take
+    :param n_dims:
+        The dimension of the diversity features, which are gaussian bumps around each position
+    :param movement_scale:
+        The scale of the normal distribution of the transition qualities
+    :return:
+        SDPPFactorTree
+    """
+    positions = np.arange(n_positions)
+    centres = np.linspace(0, n_positions - 1, n_dims)
+    diversity_vectors = np.exp(-(positions[:, np.newaxis] - centres[np.newaxis, :])**2 / 5)
+    diversity_vectors /= np.linalg.norm(diversity_vectors, axis=1, keepdims=True)
+    diversity_matrices = np.einsum('pi,pj->pij', diversity_vectors, diversity_vectors)
+    transition_table = scistat.norm.pdf((positions[:, np.newaxis] - positions[np.newaxis, :]) / movement_scale)
+    zeros_vector, zeros_matrix = np.zeros(n_dims), np.zeros((n_dims, n_dims))
+
+    @assignment_to_var_arguments
+    def root_quality(pos):
+        return ((pos + 1) / n_positions)**2
+
+    def quality_one(*args):
+        return 1
+
+    @assignment_to_var_arguments
+    def one_var_diversity(pos):
+        return diversity_vectors[pos]
+
+    @assignment_to_var_arguments
+    def one_var_diversity_matrix(pos):
+        return diversity_matrices[pos]
+
+    @assignment_to_var_arguments
+    def transition_quality(pos1, pos2):
+        return transition_table[pos1, pos2]
+
+    def zero_diversity(*args):
+        return zeros_vector
+
+    def zero_diversity_matrix(*args):
+        return zeros_matrix
+
+    root = Variable(positions, name='RootVar')
+    nodes = [root, SDPPFactor(get_quality=root_quality, get_diversity=one_var_diversity,
+                              get_diversity_matrix=one_var_diversity_matrix, parent=root, name='RootFac')]
+    for chain in range(width):
+        current_var = root
+        for i in range(length):
+            transition_factor = SDPPFactor(get_quality=transition_quality, get_diversity=zero_diversity,
+                                           get_diversity_matrix=zero_diversity_matrix, parent=current_var,
+                                           name=f'Fac{chain}:{i-1}-{i}')
+            current_var = Variable(positions, parent=transition_factor, name=f'Var{chain}:{i}')
+            one_var_factor = SDPPFactor(get_quality=quality_one, get_diversity=one_var_diversity,
+                                        get_diversity_matrix=one_var_diversity_matrix, parent=current_var,
+                                        name=f'Fac{chain}:{i}')
+            nodes.extend((transition_factor, current_var, one_var_factor))
+    return SDPPFactorTree.create_from_connected_nodes(nodes)
+
+
+# Each benchmark is setup(ftree) => state, which isn't timed, and then function(ftree, state) which is
+def _forward_pass(ftree, state):
+    ftree.run_forward_pass(run=state)
+
+
+def _backward_pass(ftree, state):
+    ftree.run_backward_pass(run=state)
+
+
+def _setup_backward_pass(ftree):
+    run = QualityOnlySamplingRun('benchmark')
+    ftree.run_forward_pass(run=run)
+    return run
+
+
+def _calculate_C(ftree, state):
+    ftree.calculate_C()
+
+
+def _setup_sample(ftree):
+    ftree.calculate_C()
+    ftree.calculate_C_eigendecompositon()
+    return np.random.RandomState(0)
+
+
+def _sample_from_kSDPP(ftree, state):
+    ftree.sample_from_kSDPP(2, random_state=state)
+
+
+def _sample_quality_only(ftree, state):
+    ftree.sample_quality_only(2, random_state=state)
+
+
+BENCHMARKS = {
+    'forward_pass': (lambda ftree: QualityOnlySamplingRun('benchmark'), _forward_pass),
+    'backward_pass': (_setup_backward_pass, _backward_pass),
+    'calculate_C': (lambda ftree: None, _calculate_C),
+    'sample_from_kSDPP': (_setup_sample, _sample_from_kSDPP),
+    'sample_quality_only': (lambda ftree: None, _sample_quality_only),
+}
+
+
+def case_name(benchmark, params):
+    return f"{benchmark}[{','.join(f'{key}={value}' for key, value in params.items())}]"
+
+
+def benchmark_cases(benchmarks=None, sweeps=None, base_case=None):
+    """
+    The cases of the benchmark suite, every benchmark on the base case and on the sweep of each parameter
+    :return:
+        List of (benchmark name, params dictionary), without duplicates
+    """
+    benchmarks = list(BENCHMARKS) if benchmarks is None else benchmarks
+    sweeps = SWEEPS if sweeps is None else sweeps
+    base_case = BASE_CASE if base_case is None else base_case
+    all_params = [dict(base_case)]
+    for key, values in sweeps.items():
+        for value in values:
+            params = dict(base_case, **{key: value})
+            if params not in all_params:
+                all_params.append(params)
+    return [(benchmark, params) for params in all_params for benchmark in benchmarks]
+
+
+def time_function(function, setup=None, repeats=5, min_time=0.1):
+    """
+    Time a function, calling setup before every call, without timing it
+    :param function:
+        function(state), with state the return of setup
+    :param setup:
+        (Optional) setup(), by default state is None
+    :param repeats:
+        The number of timed calls
+    :param min_time:
+        Carry on calling function after repeats until this much time has been spent in it
+    :return:
+        Dictionary with keys best, median and mean of the times in seconds, and n_calls
+    """
+    times = []
+    while len(times) < repeats or sum(times) < min_time:
+        state = setup() if setup is not None else None
+        start_time = time.perf_counter()
+        function(state)
+        times.append(time.perf_counter() - start_time)
+    return {'best': min(times), 'median': float(np.median(times)), 'mean': float(np.mean(times)),
+            'n_calls': len(times)}
+
+
+def run_benchmarks(cases=None, repeats=5, min_time=0.1):
+    """
+    Run the cases of the benchmark suite
+    :param cases:
+        (Optional) List of (benchmark name, params), by default benchmark_cases()
+    :return:
+        Dictionary of case name => time_function result with params
+    """
+    cases = benchmark_cases() if cases is None else cases
+    results = {}
+    trees = {}
+    for benchmark, params in cases:
+        key = tuple(params.items())
+        if key not in trees:
+            trees[key] = build_chain_tree(**params)
+        ftree = trees[key]
+        setup, function = BENCHMARKS[benchmark]
+        name = case_name(benchmark, params)
+        results[name] = dict(time_function(lambda state: function(ftree, state), lambda: setup(ftree),
+                                           repeats=repeats, min_time=min_time), params=params)
+        logger.info(f"{name}: {results[name]['best'] * 1e3:.2f}ms")
+    return results
+
+
+def machine_info():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'processor': platform.processor(), 'system': platform.system()}
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump({'machine': machine_info(), 'results': results}, f, indent=2)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def load_machine(path):
+    with open(path) as f:
+        return json.load(f).get('machine')
+
+
+def machine_differences(machine, other):
+    """The keys of machine_info that differ between two machines, with (machine's, other's) values"""
+    machine, other = machine or {}, other or {}
+    return {key: (machine.get(key), other.get(key)) for key in sorted({*machine, *other})
+            if machine.get(key) != other.get(key)}
+
+
+def compare_to_baseline(results, baseline, threshold=DEFAULT_THRESHOLD, statistic='best', min_difference=0.):
+    """
+    Compare benchmark results against a baseline
+    :param results:
+        As from run_benchmarks
+    :param baseline:
+        Results of the same form, e.g. from load_results
+    :param threshold:
+        The fraction slower than the baseline a case has to be to count as a regression
+    :param statistic:
+        Which time to compare, best, median or mean
+    :param min_difference:
+        The seconds slower a case has to be to count as a regression, so very quick cases aren't flagged for noise
+    :return:
+        List of (case name, baseline time, new time, ratio, regressed) for the cases in both, in order of results
+    """
+    comparisons = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name][statistic], result[statistic]
+        ratio = new / old if old > 0 else np.inf
+        comparisons.append((name, old, new, ratio, ratio > 1 + threshold and new - old > min_difference))
+    return comparisons
+
+
+def format_comparisons(comparisons):
+    lines = [f"{'case':<70} {'baseline':>10} {'new':>10} {'ratio':>7}"]
+    for name, old, new, ratio, regressed in comparisons:
+        lines.append(f"{name:<70} {old * 1e3:>8.2f}ms {new * 1e3:>8.2f}ms {ratio:>7.2f}"
+                     f"{'  REGRESSED' if regressed else ''}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the structured_dpp message passing')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='The baseline results file')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the baseline')
+    parser.add_argument('--output', help='Also save the results to this file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='The fraction slower than the baseline that counts as a regression')
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS), help='Only run these benchmarks')
+    parser.add_argument('--ignore-machine', action='store_true',
+                        help='Compare against a baseline from a different machine anyway')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    logging.getLogger('structured_dpp.factor_tree').setLevel(logging.WARNING)
+
+    compare = not args.save_baseline
+    if compare and not os.path.exists(args.baseline):
+        logger.error(f'There is no baseline at {args.baseline}, make one with --save-baseline')
+        return 1
+    if compare and not args.ignore_machine:
+        differences = machine_differences(machine_info(), load_machine(args.baseline))
+        if differences:
+            # Timings from other hardware or library versions would show differences that aren't regressions
+            described = ', '.join(f'{key}: {ours} here, {theirs} there' for key, (ours, theirs) in differences.items())
+            logger.error(f'The baseline at {args.baseline} is from a different machine ({described}). '
+                         f'Make one for this machine with --save-baseline, or compare anyway with --ignore-machine')
+            return 2
+
+    results = run_benchmarks(benchmark_cases(args.benchmarks), repeats=args.repeats, min_time=args.min_time)
+    if args.output:
+        save_results(results, args.output)
+    if args.save_baseline:
+        save_results(results, args.baseline)
+        logger.info(f'Saved the baseline to {args.baseline}')
+        return 0
+
+    comparisons = compare_to_baseline(results, load_results(args.baseline), args.threshold)
+    print(format_comparisons(comparisons))
+    regressions = [name for name, *_, regressed in comparisons if regressed]
+    if regressions:
+        logger.error(f'{len(regressions)} of {len(comparisons)} cases regressed by more than {args.threshold:.0%}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
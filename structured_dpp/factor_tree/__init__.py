@@ -5,3 +5,4 @@ from .factor_tree import FactorTree
 from .sdpp_factor_tree import SDPPFactorTree
 from .decorators import assignment_to_var_arguments
 from .run_types import C_RUN, CRun, SamplingRun, QualityOnlySamplingRun, MaxProductRun
+from .profiler import NodeProfiler
@@ -2,6 +2,7 @@ from functools import reduce
 from types import MethodType
 
 from structured_dpp.semiring import MaxProductValue
+from structured_dpp.instrumentation import count, is_recording
 
 from .node import Node
 from .run_types import SamplingRun, MaxProductRun
@@ -14,6 +15,8 @@ class Factor(Node):
     associated with the factor.
     All connected nodes (parent, children) must be Variables
     """
+    __slots__ = ('_get_weight',)
+
     def __init__(self, get_weight, parent=None, children=None, name=None):
         """
         :param function get_weight:
@@ -53,7 +56,7 @@ class Factor(Node):
         Generator to yield all assignment combinations relating to the factor consistent with var=value
         :yields: A possible assignment combination for each variable.
         """
-        other_vars = list(self.get_connected_nodes(exclude=var))
+        other_vars = self.get_connected_nodes(exclude=var)
         if len(other_vars) == 0:
             yield {var: value}
             return
@@ -79,7 +82,8 @@ class Factor(Node):
 
     def create_message(self, to, value, run=None):
         message = None
-        for assignment in self.get_consistent_assignments(to, value):
+        n_assignments = 0
+        for n_assignments, assignment in enumerate(self.get_consistent_assignments(to, value), 1):
             # Sum together the weight of each assignment
             # taking into account the value of the assignment to preceeding nodes
             # by taking the product of the messages relating to that assignment
@@ -101,6 +105,9 @@ class Factor(Node):
             else:
                 message = message + assignment_value if message is not None else assignment_value
 
+        if is_recording():  # Every assignment has its weight evaluated
+            count('assignments', n_assignments)
+            count('weight_evaluations', n_assignments)
         return message
 
     def create_all_messages_to(self, to, run=None):
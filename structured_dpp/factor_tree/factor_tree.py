@@ -1,15 +1,51 @@
 from warnings import warn
+from contextlib import contextmanager, nullcontext
 import logging
 
 from .factor import Factor
 from .node import Node
 from .variable import Variable
-from .run_types import MaxProductRun
+from .run_types import MaxProductRun, BaseFixedVarsRun
+from .profiler import NodeProfiler
+from ..instrumentation import span, count, recording, is_recording
 
 
 logger = logging.getLogger(__name__)
 
 
+class _ForwardPass:
+    """The messages of a finished forward pass on a run towards start_node, and the nodes changed since"""
+    __slots__ = ('start_node', 'traversal', 'changed', '_positions')
+
+    def __init__(self, start_node, traversal=None):
+        """
+        :param traversal: The traversal the pass followed, or None for a pass by levels towards the root
+        """
+        self.start_node = start_node
+        self.traversal = traversal
+        self.changed = set()
+        self._positions = None  # Node => (order in the pass, node_above), made when first needed
+
+    def stale_messages(self, ftree):
+        """
+        The messages that are out of date because of the changed nodes,
+        which are the ones on the paths from the changed nodes to start_node.
+        :return: List of (node, node_above) for the messages to recreate, in the order the pass made them
+        """
+        if self._positions is None:
+            if self.traversal is None:
+                self._positions = {node: (level, node.parent) for node, level in ftree.item_directory.items()}
+            else:
+                self._positions = {node: (i, node_above) for i, (node, node_above) in enumerate(self.traversal)}
+        stale = {}
+        for node in self.changed:
+            while node is not self.start_node and node not in stale:
+                stale[node] = self._positions[node]
+                node = stale[node][1]
+        ordered = sorted(stale.items(), key=lambda item: item[1][0], reverse=True)
+        return [(node, node_above) for node, (_, node_above) in ordered]
+
+
 class FactorTree:
     def __init__(self, root_node):
         if not isinstance(root_node, Variable):
@@ -17,6 +53,13 @@ class FactorTree:
         self.root = root_node
         self.levels = [{root_node}]
         self.item_directory = {root_node: 0}
+        self.nodes = [root_node]  # Indexed by node_id
+        root_node.node_id = 0
+        self.profiler = None
+        # When incremental, forward passes only recreate the messages made stale by nodes changed since the last
+        # pass on the same run, see mark_changed
+        self.incremental = False
+        self._forward_passes = {}  # (run, start node) => _ForwardPass
 
     def add_parent_edges(self, parent, *children):
         """
@@ -26,28 +69,55 @@ class FactorTree:
         If the parent is a variable node, the child must be a factor, or the reverse.
         """
         # Integrity checks
-        if (isinstance(parent, Variable) and any(not isinstance(child, Factor) for child in children)) or \
-            (isinstance(parent, Factor) and any(not isinstance(child, Variable) for child in children)) or \
-                not (isinstance(parent, Variable) or isinstance(parent, Factor)):
-            raise ValueError('The parent must be a variable or factor, and the children must be the opposite of the '
-                             'parent. Aka a variable parent must have factor children and visa versa.')
-        if any(child.parent not in (None, parent) for child in children):
-            raise ValueError(f'Child has parent attribute set already and it is not correct.')
-        if any(child in self.item_directory for child in children):
-            raise ValueError('Trying to add node that is already in the tree.')
+        self.check_children(parent, children)
+        self._check_new_children(parent, children)
 
         # Work out which level the parent is at
         parent_level = self.item_directory.get(parent, None)
         if parent_level is None:
             raise KeyError('Parent must be added to tree before you can add children to it.')
+        self._add_children(parent, children, parent_level + 1)
+        self._forward_passes.clear()  # The passes no longer cover the whole tree
+
+    def check_children(self, parent, children):
+        """
+        Raises a ValueError if the nodes can't be children of parent in this type of tree.
+        A variable parent must have factor children and visa versa.
+        """
+        if isinstance(parent, Variable):
+            child_type = Factor
+        elif isinstance(parent, Factor):
+            child_type = Variable
+        else:
+            child_type = None
+        if child_type is None or not all(isinstance(child, child_type) for child in children):
+            raise ValueError('The parent must be a variable or factor, and the children must be the opposite of the '
+                             'parent. Aka a variable parent must have factor children and visa versa.')
+
+    @staticmethod
+    def _check_parents(parent, children):
+        for child in children:
+            child_parent = child.parent
+            if child_parent is not None and child_parent is not parent:
+                raise ValueError(f'Child has parent attribute set already and it is not correct.')
+
+    def _check_new_children(self, parent, children):
+        self._check_parents(parent, children)
+        if any(child in self.item_directory for child in children):
+            raise ValueError('Trying to add node that is already in the tree.')
+
+    def _add_children(self, parent, children, level):
+        """Adds the children to the tree under parent at level, without any checks"""
         parent.add_children(children)
         for child in children:
             child.parent = parent
-            self.item_directory[child] = parent_level + 1
-        if len(self.levels) - 1 <= parent_level:  # Does the next level exist yet?
+            child.node_id = len(self.nodes)
+            self.nodes.append(child)
+            self.item_directory[child] = level
+        if len(self.levels) <= level:  # Does the level exist yet?
             self.levels.append({*children})
         else:
-            self.levels[parent_level + 1].update(children)
+            self.levels[level].update(children)
 
     def get_nodes(self):
         """Iterates through the nodes in the FactorTree"""
@@ -65,36 +135,108 @@ class FactorTree:
             if isinstance(node, Factor):
                 yield node
 
+    def create_messages(self, node, to, run=None):
+        """
+        Has node create all its messages to 'to', through the profiler if there is one.
+        All the passes create their messages with this.
+        """
+        if self.profiler is None:
+            return node.create_all_messages_to(to, run)
+        return self.profiler.create_all_messages_to(node, to, run)
+
+    @contextmanager
+    def profiling(self, profiler=None):
+        """
+        Profile the message creation of every node in the passes run inside it, see profiler.NodeProfiler.
+        Starts an instrumentation recording for the counters if there isn't one active.
+        :param profiler:
+            (Optional) A NodeProfiler to add to, by default a new one
+        :return:
+            The NodeProfiler
+        """
+        profiler = NodeProfiler() if profiler is None else profiler
+        previous = self.profiler
+        self.profiler = profiler
+        try:
+            with nullcontext() if is_recording() else recording():
+                yield profiler
+        finally:
+            self.profiler = previous
+
+    def mark_changed(self, *nodes):
+        """
+        Tells the tree that the weights of these factors or the allowed values of these variables have changed,
+        so their messages are stale. With incremental set, the next forward pass on a run only recreates the
+        messages on the paths from them to the query's start node.
+        A variable's allowed values are also used by the messages its neighbouring factors make, so they are
+        marked too.
+        """
+        changed = set()
+        for node in nodes:
+            if node not in self.item_directory:
+                raise KeyError(f'{node} is not in the tree.')
+            changed.add(node)
+            if isinstance(node, Variable):
+                changed.update(node.get_connected_nodes())
+        for forward_pass in self._forward_passes.values():
+            forward_pass.changed.update(changed)
+
+    def set_allowed_values(self, variable, allowed_values):
+        """Changes the allowed values of a variable in the tree and marks it changed"""
+        variable.allowed_values = allowed_values
+        self.mark_changed(variable)
+
+    def _update_forward_pass(self, run, start_node):
+        """
+        Recreates the stale messages of the last forward pass on run towards start_node, if incremental
+        :return: The _ForwardPass, or None if there isn't one to update and a full pass is needed
+        """
+        if not self.incremental:
+            return None
+        forward_pass = self._forward_passes.get((run, start_node))
+        if forward_pass is None:
+            return None
+        logger.info('Starting incremental forward pass on run %s', run)
+        stale_messages = forward_pass.stale_messages(self)
+        with span('incremental_forward_pass'):
+            for node, node_above in stale_messages:
+                new_messages = self.create_messages(node, node_above, run)
+                count('messages', len(new_messages) if new_messages else 0)
+        count('stale_nodes', len(stale_messages))
+        forward_pass.changed.clear()
+        return forward_pass
+
+    def _save_forward_pass(self, run, start_node, traversal=None):
+        # Sampling runs change their messages as variables are fixed, so their passes can't be reused
+        if self.incremental and not isinstance(run, BaseFixedVarsRun):
+            self._forward_passes[(run, start_node)] = _ForwardPass(start_node, traversal)
+
     def generate_up_messages_on_level(self, level, run=None):
         node: Node
         for node in self.levels[level]:
-            node.create_all_messages_to(node.parent, run=run)
+            self.create_messages(node, node.parent, run=run)
 
     def generate_down_messages_on_level(self, level, run=None):
         node: Node
         for node in self.levels[level]:
             for child_node in node.children:
-                node.create_all_messages_to(child_node, run=run)
+                self.create_messages(node, child_node, run=run)
 
     def run_forward_pass(self, run=None):
-        logger.info(f'Starting forward pass on run {run}')
+        if self._update_forward_pass(run, self.root) is not None:
+            return
+        logger.info('Starting forward pass on run %s', run)
         for level in reversed(range(1, len(self.levels))):
-            logger.debug(f'Forward pass level {level} on run {run}')
+            logger.debug('Forward pass level %s on run %s', level, run)
             self.generate_up_messages_on_level(level, run=run)
+        self._save_forward_pass(run, self.root)
 
     def run_backward_pass(self, run=None):
-        logger.info(f'Starting backward pass on run {run}')
+        logger.info('Starting backward pass on run %s', run)
         for level in range(len(self.levels)):
-            logger.debug(f'Backward pass level {level} on run {run}')
+            logger.debug('Backward pass level %s on run %s', level, run)
             self.generate_down_messages_on_level(level, run=run)
 
-    def nodes_to_add_based_on_parents(self, nodes):
-        """
-        Generator to get the nodes who's parents are in the tree
-        Only used for create_from_connected_nodes
-        """
-        return filter(lambda x: x.parent in self.item_directory, nodes)
-
     @classmethod
     def create_from_connected_nodes(cls, nodes):
         """
@@ -103,6 +245,7 @@ class FactorTree:
         The children attribute should be unset!
         :return: Created FactorTree
         """
+        nodes = list(dict.fromkeys(nodes))  # Without duplicates, keeping the order
         # Integrity check
         if any(len(node.children) > 0 for node in nodes):
             warn('Children attributes are already set for node being added to FactorTree. '
@@ -120,24 +263,75 @@ class FactorTree:
         # Create the tree!
         ftree = cls(root_node=root)
 
-        # We see if we're done by keeping track of the nodes remaining, and the ones that need to be added next
-        nodes_remaining = {*nodes}
-        nodes_remaining.remove(root)
-        next_to_add = list(ftree.nodes_to_add_based_on_parents(nodes_remaining))
-        while True:
-            if len(next_to_add) == 0 or len(nodes_remaining) == 0:
-                if len(next_to_add) == 0 and len(nodes_remaining) == 0:
-                    return ftree  # Success!
-                else:
-                    raise ValueError('Not all the nodes in the tree were added. '
-                                     'This might be because of a cycle in the graph or other invalid structure. '
-                                     'Check the tree is valid and that you have listed all the nodes that need to be '
-                                     'added to the tree as an argument.')
-            node: Node
-            for node in next_to_add:
-                ftree.add_parent_edges(node.parent, node)
-                nodes_remaining.remove(node)
-            next_to_add = list(ftree.nodes_to_add_based_on_parents(nodes_remaining))
+        # Index the nodes by their parent, so each level is found from the one above in a single pass
+        children_by_parent = {}
+        for node in nodes:
+            if node is not root:
+                children_by_parent.setdefault(node.parent, []).append(node)
+
+        level, level_index = [root], 0
+        while level:
+            next_level = []
+            for parent in level:
+                children = children_by_parent.pop(parent, None)
+                if children:
+                    ftree._add_children(parent, children, level_index + 1)
+                    next_level.extend(children)
+            # Every node in a level is the same type, so the children are checked a level at a time
+            if next_level:
+                ftree.check_children(level[0], next_level)
+            level, level_index = next_level, level_index + 1
+
+        # Anything left has a parent that isn't connected to the root
+        if children_by_parent:
+            raise ValueError('Not all the nodes in the tree were added. '
+                             'This might be because of a cycle in the graph or other invalid structure. '
+                             'Check the tree is valid and that you have listed all the nodes that need to be '
+                             'added to the tree as an argument.')
+        return ftree
+
+    @classmethod
+    def chain(cls, variables, transition_factors, variable_factors=None):
+        """
+        Creates a FactorTree of a chain of variables, the shape of a path, rooted at the first variable:
+        variables[i] - transition_factors[i] - variables[i+1], with the factors of only variables[i] in
+        variable_factors[i]. Each level is known so this is much quicker than create_from_connected_nodes.
+        The parents of the nodes are set, they can already be set but only to the same node.
+        :param variables: The n variables along the chain.
+        :param transition_factors: The n-1 factors between neighbouring variables.
+        :param variable_factors: (Optional) For each variable, a factor, a list of factors or None.
+        :return: Created FactorTree
+        """
+        if len(transition_factors) != len(variables) - 1:
+            raise ValueError('A chain needs one transition factor between each pair of neighbouring variables.')
+        if variable_factors is not None and len(variable_factors) != len(variables):
+            raise ValueError('variable_factors needs an entry for every variable.')
+        if variables[0].parent is not None:
+            raise ValueError('The first variable is the root so it cannot have a parent.')
+
+        own_factors = [[] if factors is None else list(factors) if isinstance(factors, (list, tuple)) else [factors]
+                       for factors in (variable_factors if variable_factors is not None else [None]*len(variables))]
+        all_factors = list(transition_factors) + [factor for factors in own_factors for factor in factors]
+        if len({*variables, *all_factors}) != len(variables) + len(all_factors):
+            raise ValueError('Trying to add node that is already in the tree.')
+
+        ftree = cls(root_node=variables[0])
+        # The checks only depend on the type of the parent, so are done once for all the nodes
+        if all_factors:
+            ftree.check_children(variables[0], all_factors)
+        if transition_factors:
+            ftree.check_children(transition_factors[0], variables[1:])
+
+        for i, variable in enumerate(variables):
+            children = own_factors[i] + [transition_factors[i]] if i < len(transition_factors) else own_factors[i]
+            if children:
+                ftree._check_parents(variable, children)
+                ftree._add_children(variable, children, 2*i + 1)
+            if i < len(transition_factors):
+                next_variable = (variables[i + 1],)
+                ftree._check_parents(transition_factors[i], next_variable)
+                ftree._add_children(transition_factors[i], next_variable, 2*i + 2)
+        return ftree
 
     def __str__(self):
         return f'FactorTree({len(self.item_directory)} nodes, {len(self.levels)} levels)'
@@ -192,17 +386,19 @@ class FactorTree:
                 return traversal
 
     def run_forward_pass_from_traversal(self, traversal, run=None):
-        logger.info(f'Starting forward pass on run {run}')
+        logger.info('Starting forward pass on run %s', run)
         node: Node
-        for node, node_above in reversed(traversal[1:]):
-            node.create_all_messages_to(node_above, run)
+        with span('forward_pass'):
+            for node, node_above in reversed(traversal[1:]):
+                new_messages = self.create_messages(node, node_above, run)
+                count('messages', len(new_messages) if new_messages else 0)
 
     def run_backward_pass_from_traversal(self, traversal, run=None):
-        logger.info(f'Starting backward pass on run {run}')
+        logger.info('Starting backward pass on run %s', run)
         node: Node
         node_above: Node
         for node, node_above in traversal[1:]:
-            node_above.create_all_messages_to(node, run)
+            self.create_messages(node_above, node, run)
 
     def run_max_quality_forward(self, start_node=None, run_uid=None):
         start_node = start_node if start_node else self.root
@@ -210,12 +406,36 @@ class FactorTree:
             raise ValueError('Max quality_function runs must start from a Variable')
 
         run = MaxProductRun(run_uid)
-        traversal = self.generate_depth_first_traversal(start_node=start_node)
-
-        self.run_forward_pass_from_traversal(traversal, run)
+        forward_pass = self._update_forward_pass(run, start_node)
+        if forward_pass is not None:
+            traversal = forward_pass.traversal
+        else:
+            traversal = self.generate_depth_first_traversal(start_node=start_node)
+            self.run_forward_pass_from_traversal(traversal, run)
+            self._save_forward_pass(run, start_node, traversal)
         start_node.calculate_all_beliefs(run)
         return traversal, run
 
+    def run_max_marginals(self, start_node=None, run_uid=None):
+        """
+        Max product to every variable at once, with a forward pass towards start_node and a backward pass away from it.
+        Afterwards every variable has the messages from all its neighbours, so its max-marginals are known and the
+        best assignment through any of its values can be traced, see get_max_assignment_through.
+        :return: max_marginals, a dictionary of variable => {value: max-marginal}, and the run
+        """
+        traversal, run = self.run_max_quality_forward(start_node, run_uid)
+        with span('backward_pass'):
+            self.run_backward_pass_from_traversal(traversal, run)
+        max_marginals = {variable: variable.calculate_max_marginals(run) for variable in self.get_variables()}
+        return max_marginals, run
+
+    def get_max_assignment_through(self, variable, value, run):
+        """
+        The best assignment of every variable with variable set to value, after run_max_marginals
+        """
+        traversal = self.generate_depth_first_traversal(start_node=variable)
+        return self.get_max_from_start_assignment(variable, value, traversal, run)
+
     def get_max_from_start_assignment(self, start_node, start_assignment, traversal, run):
         assignments = {start_node: start_assignment}
         for node, node_above in traversal[1:]:  # Selects factor levels only
@@ -1,71 +1,86 @@
-import weakref
+_NO_CHILDREN = frozenset()
 
 
 class Node:
     """
     A node on a standard bidirectional graph with message passing.
-    Allows for circular references without causing memory leakage.
+    Nodes use __slots__ to keep the memory of big trees down, so subclasses should declare __slots__ too.
     """
+    __slots__ = ('_parent', '_children', '_neighbours', '_child_nodes', 'outgoing_messages', 'name', 'node_id')
+
     def __init__(self, parent=None, children=None, name=None):
         """
         :param Node parent: Parent node in the tree structure
         :param list children: Child nodes in the tree structure
         :param str name: String name for pretty printing
         """
-        self._parent = weakref.ref(parent) if parent else None
-        self._children = {*children} if children else set()
+        self._parent = parent if parent else None
+        # The set is only made once there are children, as many nodes are leaves
+        self._children = {*children} if children else None
+        self._neighbours = None  # Cached tuple of the connected nodes, None when it needs remaking
+        self._child_nodes = None
         self.outgoing_messages = {}
         self.name = name if name else self.__class__.__name__
+        self.node_id = None  # The node's index in the FactorTree it's added to
 
     # Children
     # The descendant nodes, stored in a set to avoid children being double counted
+    # They are read only, change them with add_child, add_children or by setting children so the connected nodes
+    # are remade
     @property
     def children(self):
-        return self._children
+        return frozenset(self._children) if self._children else _NO_CHILDREN
 
     @children.setter
     def children(self, children):
         self._children = {*children}  # To allow it to be set to a list and to then remove duplicates
+        self._neighbours = None
 
     def add_child(self, child):
-        self.children.add(child)
+        if self._children is None:
+            self._children = set()
+        self._children.add(child)
+        self._neighbours = None
 
     def add_children(self, children):
-        self.children.update(children)
+        if self._children is None:
+            self._children = set()
+        self._children.update(children)
+        self._neighbours = None
 
     # Parent
-    # The parent node cannot be referenced directly as that would be a circular reference
-    # (assuming that the parent stores this node as a child)
-    # but the weakref library fixes that, but means we need to add this extra code.
+    # The parent is a normal reference, so a parent and child reference each other.
+    # The FactorTree holds every node and Python's garbage collector frees the cycles once the tree is gone.
     @property
     def parent(self):
-        """
-        Parent setter.
-        To avoid circular references use a weakref to refer to parent from the child.
-        """
-        if not self._parent:
-            return self._parent
-        _parent = self._parent()
-        if _parent:
-            return _parent
-        else:
-            raise LookupError('Parent was destroyed by garbage collector.')
+        return self._parent
 
     @parent.setter
     def parent(self, parent):
-        self._parent = weakref.ref(parent)
+        self._parent = parent
+        self._neighbours = None
 
     # Helpful graph traversing functions
+    def _update_neighbours(self):
+        self._child_nodes = tuple(self._children) if self._children is not None else ()
+        self._neighbours = self._child_nodes if self._parent is None else self._child_nodes + (self._parent,)
+        return self._neighbours
+
     def get_connected_nodes(self, exclude=None):
         """
-        Generator that yields all the connected nodes, not distinguishing between parent and children
-        :param Node exclude: If this node is encountered it won't be yeilded.
+        All the connected nodes, not distinguishing between parent and children, the children first.
+        The tuple is cached until the node's connections change, as it is needed for every message.
+        :param Node exclude: If given this node is left out.
+        :return: Tuple of the nodes
         """
-        for x in self.children:
-            if x != exclude:
-                yield x
-        if self.parent and self.parent != exclude:
-            yield self.parent
+        neighbours = self._neighbours
+        if neighbours is None:
+            neighbours = self._update_neighbours()
+        if exclude is None:
+            return neighbours
+        if exclude is self._parent:
+            return self._child_nodes
+        return tuple(node for node in neighbours if node is not exclude)
 
     # Message functions
     # Messages are all about communicating theoretical value assignments in variables and calculating their weight.
@@ -119,5 +134,5 @@ class Node:
         raise NotImplementedError()
 
     def __repr__(self):
-        return f'{self.name}(parent={self.parent.name if self._parent else None},' \
+        return f'{self.name}(parent={self._parent.name if self._parent else None},' \
                f'{len(self.children)} children)'
@@ -0,0 +1,131 @@
+"""
+Per node profiling of the message passing in a FactorTree, to find which factors or variables make a pass slow.
+
+    with ftree.profiling() as profiler:
+        ftree.run_max_quality_forward(var)
+    print(profiler.report())
+
+For every node and run it records the time spent creating messages, the weight evaluations and assignments
+enumerated (from the 'weight_evaluations' and 'assignments' counters of the instrumentation)
+and the memory of the messages created.
+"""
+import sys
+import time
+import numpy as np
+
+from structured_dpp.instrumentation import current_recorder
+from structured_dpp.semiring import MaxProductValue
+
+
+def _value_nbytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, tuple):  # The semirings are named tuples of arrays
+        return sys.getsizeof(value) + sum(_value_nbytes(item) for item in value)
+    if isinstance(value, MaxProductValue):
+        nbytes = sys.getsizeof(value) + sys.getsizeof(value.assignment)
+        return nbytes + (sys.getsizeof(value.__dict__) if hasattr(value, '__dict__') else 0)
+    return sys.getsizeof(value)
+
+
+def message_nbytes(messages):
+    """
+    The approximate memory of a dictionary of messages {value: message}, including the dictionary.
+    Messages shared with other nodes are counted in full.
+    """
+    return sys.getsizeof(messages) + sum(_value_nbytes(message) for message in messages.values())
+
+
+class NodeProfile:
+    """The totals for one node on one run"""
+    __slots__ = ('node', 'run', 'n_calls', 'time', 'weight_evaluations', 'assignments', 'n_messages',
+                 'message_bytes')
+
+    def __init__(self, node, run):
+        self.node = node
+        self.run = run
+        self.n_calls = 0
+        self.time = 0.
+        self.weight_evaluations = 0
+        self.assignments = 0
+        self.n_messages = 0
+        self.message_bytes = 0
+
+    def to_dict(self):
+        return {'node': self.node.name, 'type': type(self.node).__name__, 'run': str(self.run),
+                'n_calls': self.n_calls, 'time': self.time, 'weight_evaluations': self.weight_evaluations,
+                'assignments': self.assignments, 'n_messages': self.n_messages, 'message_bytes': self.message_bytes}
+
+
+class NodeProfiler:
+    """
+    Records the message creation of each node, see FactorTree.profiling.
+    Needs an active instrumentation recording for the weight evaluations and assignments.
+    """
+    SORT_KEYS = ('time', 'weight_evaluations', 'assignments', 'n_messages', 'message_bytes', 'n_calls')
+
+    def __init__(self):
+        self.profiles = {}  # (node, run) => NodeProfile
+
+    def create_all_messages_to(self, node, to, run=None):
+        """Calls node.create_all_messages_to(to, run), recording it"""
+        recorder = current_recorder()
+        counters = recorder.counters if recorder is not None else {}
+        weight_evaluations, assignments = counters.get('weight_evaluations', 0), counters.get('assignments', 0)
+        start_time = time.perf_counter()
+        new_messages = node.create_all_messages_to(to, run)
+        elapsed = time.perf_counter() - start_time
+
+        profile = self.profiles.get((node, run))
+        if profile is None:
+            profile = self.profiles[(node, run)] = NodeProfile(node, run)
+        profile.n_calls += 1
+        profile.time += elapsed
+        profile.weight_evaluations += counters.get('weight_evaluations', 0) - weight_evaluations
+        profile.assignments += counters.get('assignments', 0) - assignments
+        if new_messages:
+            profile.n_messages += len(new_messages)
+            profile.message_bytes += message_nbytes(new_messages)
+        return new_messages
+
+    def sorted_profiles(self, sort_by='time'):
+        """The profile of every node and run, the most of sort_by first"""
+        if sort_by not in self.SORT_KEYS:
+            raise ValueError(f'Can only sort by one of {self.SORT_KEYS}, not {sort_by}')
+        return sorted(self.profiles.values(), key=lambda profile: getattr(profile, sort_by), reverse=True)
+
+    def totals_by_type(self):
+        """
+        :return:
+            Dictionary of node class name => dictionary of the totals of the nodes of that class over all runs
+        """
+        totals = {}
+        for profile in self.profiles.values():
+            total = totals.setdefault(type(profile.node).__name__, dict.fromkeys(self.SORT_KEYS, 0))
+            for key in self.SORT_KEYS:
+                total[key] += getattr(profile, key)
+        return totals
+
+    def report(self, sort_by='time', limit=20):
+        """
+        A table of the nodes that took the most of sort_by, and the totals of each type of node
+        :param limit:
+            The number of nodes in the table, None for all of them
+        """
+        header = f"{'node':<24} {'type':<16} {'run':<24} {'calls':>6} {'time (ms)':>10} {'weights':>10} " \
+                 f"{'assignments':>12} {'messages':>9} {'memory (KB)':>12}"
+        lines = [header]
+        for profile in self.sorted_profiles(sort_by)[:limit]:
+            lines.append(f"{profile.node.name[:24]:<24} {type(profile.node).__name__[:16]:<16} "
+                         f"{str(profile.run)[:24]:<24} {profile.n_calls:>6} {profile.time * 1e3:>10.2f} "
+                         f"{profile.weight_evaluations:>10} {profile.assignments:>12} {profile.n_messages:>9} "
+                         f"{profile.message_bytes / 1e3:>12.1f}")
+        lines.append('')
+        lines.append(f"{'total by type':<66} {'calls':>6} {'time (ms)':>10} {'weights':>10} "
+                     f"{'assignments':>12} {'messages':>9} {'memory (KB)':>12}")
+        totals = sorted(self.totals_by_type().items(), key=lambda item: item[1][sort_by], reverse=True)
+        for type_name, total in totals:
+            lines.append(f"{type_name:<66} {total['n_calls']:>6} {total['time'] * 1e3:>10.2f} "
+                         f"{total['weight_evaluations']:>10} {total['assignments']:>12} {total['n_messages']:>9} "
+                         f"{total['message_bytes'] / 1e3:>12.1f}")
+        return '\n'.join(lines)
@@ -13,6 +13,8 @@ class SDPPFactor(Factor):
     This means that it only needs to be given quality_function and diversity
     so that you don't have to specify a complex weight function yourself.
     """  # TODO: Write prettier/better docs
+    __slots__ = ('get_quality', 'get_diversity', 'get_diversity_matrix')
+
     def __init__(self, get_quality, get_diversity, get_diversity_matrix=None, parent=None, children=None, name=None):
         """
         Creates a SDPPFactor
@@ -23,10 +23,14 @@ class SDPPFactorTree(FactorTree):
         self.C = None
         self._C_eigendecomp = None
 
-    def add_parent_edges(self, parent, *children):
+    def check_children(self, parent, children):
         if any(isinstance(child, Factor) and not isinstance(child, SDPPFactor) for child in children):
             raise ValueError('Cannot add normal factors to an SDPPFactorTree, they must be SDPPFactors')
-        super(SDPPFactorTree, self).add_parent_edges(parent, *children)
+        super(SDPPFactorTree, self).check_children(parent, children)
+
+    def mark_changed(self, *nodes):
+        super(SDPPFactorTree, self).mark_changed(*nodes)
+        self._C_eigendecomp = None  # It's of the old C
 
     def calculate_C(self, run_uid=None):
         run = CRun(run_uid)
@@ -189,7 +193,7 @@ class SDPPFactorTree(FactorTree):
                     for item, belief in var.calculate_all_beliefs(run).items()
                 }
                 strength_total = sum(item_strengths.values())
-                logger.debug(f'Strength total {strength_total}')
+                logger.debug('Strength total %s', strength_total)
                 for val, strength in item_strengths.items():
                     item_select_cuml_prob += strength/strength_total
                     if item_select_thresh_prob < item_select_cuml_prob:
@@ -199,7 +203,7 @@ class SDPPFactorTree(FactorTree):
                     raise RuntimeError(f'The SDPP tried to select an item in variable {var} level {self.item_directory[var]}. '
                                        f'The probability of selecting one item should be one. '
                                        f'However the calculated cumulative probability was {item_select_cuml_prob}.')
-                logger.debug(f'Selected {selected_item} for {var} (p={item_select_cuml_prob})')
+                logger.debug('Selected %s for %s (p=%s)', selected_item, var, item_select_cuml_prob)
 
                 run.fixed_vars[var] = selected_item
                 var.create_all_messages_when_set(selected_item, run, exclude=var.parent)
@@ -207,4 +211,4 @@ class SDPPFactorTree(FactorTree):
                 child_factor: SDPPFactor
                 for child_factor in var.children:
                     for grandchild_var in child_factor.children:
-                        child_factor.create_all_messages_to(grandchild_var, run)
+                        self.create_messages(child_factor, grandchild_var, run)
@@ -3,6 +3,7 @@ from functools import reduce
 from .node import Node
 from .run_types import QualityOnlySamplingRun, MaxProductRun
 from structured_dpp.semiring import MaxProductValue
+from structured_dpp.instrumentation import count
 
 
 class Variable(Node):
@@ -11,6 +12,8 @@ class Variable(Node):
     It can take a discrete number of fixed values.
     All connected nodes must be factors.
     """
+    __slots__ = ('allowed_values',)
+
     def __init__(self, allowed_values, parent=None, children=None, name=None):
         super(Variable, self).__init__(parent, children, name=name if name else 'Variable')
         self.allowed_values = allowed_values
@@ -48,6 +51,7 @@ class Variable(Node):
             val: self.create_message(to, val, run=run) for val in self.allowed_values
         }
         self.outgoing_messages[run][to] = new_messages
+        count('assignments', len(new_messages))
         return new_messages
 
     def create_all_messages_when_set(self, set_value, run, exclude=None):
@@ -107,6 +111,20 @@ class Variable(Node):
     def get_belief(self, value, run=None):
         return self.outgoing_messages[run][None][value]
 
+    def calculate_max_marginals(self, run):
+        """
+        The max-marginal of each value, the largest weight of any assignment with this variable set to the value.
+        Needs the max product messages to this variable from every direction, see FactorTree.run_max_marginals.
+        :return: A dictionary of value => max-marginal
+        """
+        max_marginals = {}
+        for value in self.allowed_values:
+            max_marginal = 1
+            for message in self.get_incoming_messages_for_value(value, run=run):
+                max_marginal *= message.v if isinstance(message, MaxProductValue) else message
+            max_marginals[value] = max_marginal
+        return max_marginals
+
     def calculate_max_message_assignment(self, run):
         if self.outgoing_messages.get(run, None) is None or self.outgoing_messages[run].get(None, None) is None:
             self.calculate_all_beliefs(run)
@@ -0,0 +1,151 @@
+"""
+Lightweight timing spans and counters for finding where the time goes in a run.
+
+Code marks its stages with `with span('name'):` and counts its work with `count('name', n)`.
+Nothing is recorded unless a recording is active, and then both cost a single check,
+so they can be left in hot code.
+
+    with recording() as recorder:
+        ftree.run_max_quality_forward(var)
+    recorder.to_json('run.json')
+
+Spans inside other spans are recorded under the path of their names, e.g. 'neb/forces'.
+"""
+import json
+import time
+import functools
+from contextlib import contextmanager
+
+
+_recorder = None
+
+
+class Recorder:
+    """The spans and counters of a recording"""
+    def __init__(self):
+        self.spans = {}  # Path of span names => [number of calls, total time]
+        self.counters = {}
+        self._stack = []
+
+    def _start_span(self, name):
+        self._stack.append(name)
+        return time.perf_counter()
+
+    def _end_span(self, start_time):
+        elapsed = time.perf_counter() - start_time
+        path = '/'.join(self._stack)
+        self._stack.pop()
+        stats = self.spans.get(path)
+        if stats is None:
+            self.spans[path] = [1, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+
+    def to_dict(self):
+        """
+        :return:
+            Dictionary with keys spans, a dictionary of span path => {'calls', 'total_time'},
+            and counters, a dictionary of counter name => count
+        """
+        return {'spans': {path: {'calls': calls, 'total_time': total_time}
+                          for path, (calls, total_time) in self.spans.items()},
+                'counters': dict(self.counters)}
+
+    def to_json(self, path=None):
+        """
+        :param path:
+            (Optional) A file to write the json to
+        :return:
+            The json string
+        """
+        dumped = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(dumped)
+        return dumped
+
+
+class _NullSpan:
+    """The span when nothing is being recorded, which does nothing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('recorder', 'name', 'start_time')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start_time = self.recorder._start_span(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder._end_span(self.start_time)
+        return False
+
+
+def span(name):
+    """
+    A context manager timing the code inside it, if there is an active recording
+    """
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(_recorder, name)
+
+
+def timed(name):
+    """
+    Decorator making the whole of a function a span
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with _Span(_recorder, name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorator
+
+
+def count(name, n=1):
+    """
+    Add n to a counter, if there is an active recording
+    """
+    if _recorder is not None:
+        _recorder.counters[name] = _recorder.counters.get(name, 0) + n
+
+
+def is_recording():
+    return _recorder is not None
+
+
+def current_recorder():
+    """The Recorder of the active recording, or None"""
+    return _recorder
+
+
+@contextmanager
+def recording():
+    """
+    Record the spans and counters of the code inside it
+    :return:
+        The Recorder
+    """
+    global _recorder
+    previous = _recorder
+    _recorder = Recorder()
+    try:
+        yield _recorder
+    finally:
+        _recorder = previous
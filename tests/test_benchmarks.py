@@ -0,0 +1,55 @@
+from unittest import TestCase
+import os
+import json
+import tempfile
+import numpy as np
+from structured_dpp.benchmarks import *
+
+
+class TestBenchmarks(TestCase):
+    def test_build_chain_tree(self):
+        ftree = build_chain_tree(length=3, width=2, n_positions=4, n_dims=5)
+        variables = list(ftree.get_variables())
+        self.assertEqual(len(variables), 1 + 3*2)
+        self.assertEqual(len(list(ftree.get_factors())), 1 + 2*3*2)
+        self.assertEqual(len(ftree.levels), 2*3 + 2)
+        self.assertEqual(len(ftree.root.children), 1 + 2)
+
+        C = ftree.calculate_C()
+        self.assertEqual(C.shape, (5, 5))
+        self.assertTrue(np.allclose(C, C.T))
+        self.assertTrue(np.all(np.linalg.eigvalsh(C) > -1e-10))
+
+    def test_run_benchmarks(self):
+        cases = benchmark_cases(sweeps={'length': (2, 3)}, base_case={'length': 2, 'width': 1, 'n_positions': 3,
+                                                                      'n_dims': 3})
+        self.assertEqual(len(cases), 2*len(BENCHMARKS))
+        results = run_benchmarks(cases, repeats=2, min_time=0)
+        self.assertEqual(len(results), len(cases))
+        for name, result in results.items():
+            self.assertGreater(result['best'], 0)
+            self.assertLessEqual(result['best'], result['median'])
+            self.assertGreaterEqual(result['n_calls'], 2)
+
+        baseline = {name: dict(result, best=result['best'] / 2) for name, result in results.items()}
+        comparisons = compare_to_baseline(results, baseline, threshold=0.5)
+        self.assertEqual(len(comparisons), len(cases))
+        self.assertTrue(all(regressed for *_, regressed in comparisons))
+        comparisons = compare_to_baseline(results, baseline, threshold=1.5)
+        self.assertFalse(any(regressed for *_, regressed in comparisons))
+        # Cases not in the baseline are left out
+        self.assertEqual(compare_to_baseline(results, {}), [])
+
+    def test_baseline_from_another_machine(self):
+        self.assertEqual(machine_differences(machine_info(), machine_info()), {})
+        other_machine = dict(machine_info(), numpy='0.0.0')
+        self.assertEqual(machine_differences(machine_info(), other_machine), {'numpy': (np.__version__, '0.0.0')})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'baseline.json')
+            with open(path, 'w') as f:
+                json.dump({'machine': other_machine, 'results': {}}, f)
+            # Refuses to compare, before running anything
+            self.assertEqual(main(['--baseline', path]), 2)
+            self.assertEqual(main(['--baseline', path, '--ignore-machine', '--benchmarks', 'forward_pass',
+                                   '--repeats', '1', '--min-time', '0']), 0)
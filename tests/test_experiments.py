@@ -0,0 +1,89 @@
+from unittest import TestCase
+import os
+import json
+import tempfile
+import numpy as np
+from min_energy_path.experiments import *
+from min_energy_path.results_store import ResultsStore
+
+
+def _random_trial(seed, size, fail_above=None):
+    values = np.random.RandomState(seed).random_sample(size)
+    if fail_above is not None and values[0] > fail_above:
+        raise ValueError('Too big')
+    return {'values': values, 'total': np.sum(values)}
+
+
+class TestExperiments(TestCase):
+    def test_trial_seeds(self):
+        self.assertListEqual(trial_seeds(3, 5), trial_seeds(3, 5))
+        self.assertEqual(len(set(trial_seeds(3, 5))), 5)
+        self.assertListEqual(trial_seeds(3, 5)[:2], trial_seeds(3, 2))
+        self.assertNotEqual(trial_seeds(3, 5), trial_seeds(4, 5))
+
+    def test_run_experiment(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            serial = run_experiment(_random_trial, 6, os.path.join(output_dir, 'serial'), seed=1, n_workers=1,
+                                    size=3, fail_above=0.7)
+            parallel = run_experiment(_random_trial, 6, os.path.join(output_dir, 'parallel'), seed=1, n_workers=2,
+                                      size=3, fail_above=0.7)
+            # The same results whichever process runs each trial
+            self.assertListEqual([record['trial'] for record in parallel], list(range(6)))
+            for serial_record, parallel_record in zip(serial, parallel):
+                self.assertEqual(serial_record['status'], parallel_record['status'])
+                self.assertEqual(serial_record.get('result'), parallel_record.get('result'))
+
+            # A failing trial is recorded without stopping the others
+            statuses = [record['status'] for record in serial]
+            self.assertIn('error', statuses)
+            self.assertIn('ok', statuses)
+            failed = statuses.index('error')
+            self.assertIn('Too big', serial[failed]['error'])
+
+            # Running again only runs the trials without a record, or the failed ones if asked
+            serial_dir = os.path.join(output_dir, 'serial')
+            os.remove(os.path.join(serial_dir, 'trial-00000.json'))
+            failed_path = os.path.join(serial_dir, f'trial-{failed:05d}.json')
+            with open(failed_path) as f:
+                failed_record = json.load(f)
+            with open(failed_path, 'w') as f:
+                json.dump(dict(failed_record, error='Old error'), f)
+            rerun = run_experiment(_random_trial, 6, serial_dir, seed=1, n_workers=1, size=3, fail_above=0.7)
+            self.assertEqual(rerun[0].get('result'), serial[0].get('result'))
+            self.assertEqual(rerun[failed]['error'], 'Old error')
+            rerun = run_experiment(_random_trial, 6, serial_dir, seed=1, n_workers=1, size=3, fail_above=0.7,
+                                   rerun_errors=True)
+            self.assertIn('Too big', rerun[failed]['error'])
+            self.assertEqual(len(load_results(serial_dir)), 6)
+
+            # Records from an experiment with another seed or arguments aren't reused
+            with self.assertRaises(ValueError):
+                run_experiment(_random_trial, 6, serial_dir, seed=2, n_workers=1, size=3, fail_above=0.7)
+            with self.assertRaises(ValueError):
+                run_experiment(_random_trial, 6, serial_dir, seed=1, n_workers=1, size=3)
+
+            # Only the trials asked for are returned, even with records of more
+            self.assertListEqual([record['trial'] for record in
+                                  run_experiment(_random_trial, 2, serial_dir, seed=1, n_workers=1, size=3,
+                                                 fail_above=0.7)], [0, 1])
+
+    def test_store_records(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            records = run_experiment(_random_trial, 4, output_dir, seed=2, n_workers=1, size=5)
+            with ResultsStore(os.path.join(output_dir, 'store')) as store:
+                store_records(records, store)
+            self.assertEqual(len(store), 4)
+            self.assertListEqual(store.column('size').tolist(), [5] * 4)
+            self.assertTrue(np.allclose(store.column('total'), [record['result']['total'] for record in records]))
+            self.assertTrue(np.allclose(store.column('values')[1], records[1]['result']['values']))
+
+            # Once stored the profiles are only kept in the store, and storing again doesn't add the trials twice
+            with ResultsStore(os.path.join(output_dir, 'store')) as store:
+                store_records(records, store, output_dir)
+            self.assertEqual(len(store), 4)
+            trimmed = load_results(output_dir)
+            self.assertNotIn('values', trimmed[1]['result'])
+            self.assertEqual(trimmed[1]['result']['total'], records[1]['result']['total'])
+            self.assertEqual(trimmed[1]['result_store'], store.directory)
+            self.assertListEqual([record['trial'] for record in run_experiment(_random_trial, 4, output_dir, seed=2,
+                                                                               n_workers=1, size=5)], list(range(4)))
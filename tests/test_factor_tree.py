@@ -1,5 +1,7 @@
 from unittest import TestCase
 from structured_dpp.factor_tree import *
+from structured_dpp.instrumentation import recording
+from structured_dpp.semiring import MaxProductValue
 
 
 @assignment_to_var_arguments
@@ -285,3 +287,165 @@ class TestFactorTree(TestCase):
             FactorTree.create_from_connected_nodes([root, f1_1, v2_1, f3_1, v4_1, f1_2, v2_2, v2_3]).levels,
             [{root}, {f1_1, f1_2}, {v2_1, v2_2, v2_3}, {f3_1}, {v4_1}]
         )
+
+    def test_profiling(self):
+        root = Variable([0, 1, 2], name='Root')
+        leaf_factor = Factor(get_weight_3, parent=root, name='LeafFactor')
+        pair_factor = Factor(get_weight1, parent=root, name='PairFactor')
+        child = Variable([0, 1], parent=pair_factor, name='Child')
+        child_factor = Factor(get_weight_3, parent=child, name='ChildFactor')
+        ftree = FactorTree.create_from_connected_nodes([root, leaf_factor, pair_factor, child, child_factor])
+
+        # Nothing is profiled outside of profiling
+        ftree.run_forward_pass(run='unprofiled')
+        self.assertIsNone(ftree.profiler)
+
+        with ftree.profiling() as profiler:
+            ftree.run_forward_pass(run='profiled')
+            self.assertIs(ftree.profiler, profiler)
+        self.assertIsNone(ftree.profiler)
+
+        self.assertEqual(len(profiler.profiles), 4)  # Every node but the root
+        pair = profiler.profiles[(pair_factor, 'profiled')]
+        self.assertEqual(pair.n_calls, 1)
+        self.assertEqual(pair.n_messages, 3)
+        self.assertEqual(pair.assignments, 3*2)
+        self.assertEqual(pair.weight_evaluations, 3*2)
+        self.assertGreater(pair.message_bytes, 0)
+        self.assertGreater(pair.time, 0)
+        self.assertEqual(profiler.profiles[(leaf_factor, 'profiled')].weight_evaluations, 3)
+        self.assertEqual(profiler.profiles[(child, 'profiled')].weight_evaluations, 0)
+        self.assertEqual(profiler.profiles[(child, 'profiled')].assignments, 2)
+        # Profiling gives the same messages
+        self.assertEqual(pair_factor.outgoing_messages['profiled'], pair_factor.outgoing_messages['unprofiled'])
+
+        self.assertEqual(profiler.sorted_profiles('assignments')[0].node, pair_factor)
+        totals = profiler.totals_by_type()
+        self.assertEqual(totals['Factor']['weight_evaluations'], 6 + 3 + 2)
+        self.assertEqual(totals['Variable']['n_calls'], 1)
+        report = profiler.report(sort_by='assignments', limit=1)
+        self.assertIn('PairFactor', report)
+        self.assertNotIn('ChildFactor', report.split('total by type')[0])
+        with self.assertRaises(ValueError):
+            profiler.sorted_profiles('name')
+
+    def test_incremental_forward_pass(self):
+        scale = {'value': 1}
+
+        def scaled_weight(factor, assignments):
+            return scale['value'] * sum(assignments.values())
+
+        variables = [Variable([0, 1, 2], name=f'V{i}') for i in range(6)]
+        transition_factors = [Factor(get_weight1, name=f'F{i}-{i+1}') for i in range(5)]
+        transition_factors[3] = Factor(scaled_weight, name='F3-4')
+        ftree = FactorTree.chain(variables, transition_factors, [Factor(get_weight_3) for _ in variables])
+        ftree.incremental = True
+
+        ftree.run_forward_pass(run='sum')
+        ftree.get_max_quality(variables[-1], run_uid='max')
+        scale['value'] = 3
+        ftree.mark_changed(transition_factors[3])
+        with recording() as recorder:
+            ftree.run_forward_pass(run='sum')
+        # Only the messages from F3-4 up to the root are made again
+        self.assertEqual(recorder.counters['stale_nodes'], 7)
+        ftree.run_forward_pass(run='full')
+        self.assertEqual(variables[0].calculate_all_beliefs('sum'), variables[0].calculate_all_beliefs('full'))
+        with recording() as recorder:
+            ftree.run_forward_pass(run='sum')
+        self.assertEqual(recorder.counters['stale_nodes'], 0, 'Messages were made again without changes')
+
+        # Changing a domain makes the messages of its neighbours stale too
+        ftree.set_allowed_values(variables[1], [0, 2])
+        with recording() as recorder:
+            self.assertEqual(ftree.get_max_quality(variables[-1], run_uid='max'),
+                             ftree.get_max_quality(variables[-1], run_uid='full'))
+        # The factor of V1 and F0-1, which are below V1 from V5, and everything from V1 to V5
+        self.assertEqual(recorder.counters['stale_nodes'], 2 + 8)
+        self.assertIn(ftree.get_max_quality(variables[-1], run_uid='max')[variables[1]], (0, 2))
+
+        # Passes aren't reused after the tree changes or without incremental
+        ftree.add_parent_edges(variables[2], Factor(get_weight_3))
+        with recording() as recorder:
+            ftree.run_forward_pass(run='sum')
+        self.assertNotIn('stale_nodes', recorder.counters)
+        ftree.incremental = False
+        scale['value'] = 1
+        ftree.mark_changed(transition_factors[3])
+        with recording() as recorder:
+            ftree.run_forward_pass(run='sum')
+        self.assertNotIn('stale_nodes', recorder.counters)
+        with self.assertRaises(KeyError):
+            ftree.mark_changed(Factor(get_weight_3))
+
+    def test_run_max_marginals(self):
+        root = Variable([0, 1, 2], name='Root')
+        root_factor = Factor(get_weight_3, parent=root, name='RootFactor')
+        pair_factors = [Factor(get_weight1, parent=root, name=f'PairFactor{i}') for i in range(2)]
+        children = [Variable([0, 1, 2], parent=factor, name=f'Child{i}') for i, factor in enumerate(pair_factors)]
+        child_factor = Factor(get_weight_3, parent=children[1], name='ChildFactor')
+        ftree = FactorTree.create_from_connected_nodes([root, root_factor, *pair_factors, *children, child_factor])
+
+        max_marginals, run = ftree.run_max_marginals(run_uid='marginals')
+        self.assertSetEqual(set(max_marginals), {root, *children})
+        for variable in (root, *children):
+            # The same as the beliefs of a max product run to that variable
+            _, variable_run = ftree.run_max_quality_forward(variable, run_uid=variable.name)
+            beliefs = {value: belief.v if isinstance(belief, MaxProductValue) else belief
+                       for value, belief in variable.outgoing_messages[variable_run][None].items()}
+            self.assertDictEqual(max_marginals[variable], beliefs)
+
+            # The traced assignment through each value has that value's max-marginal
+            for value, max_marginal in max_marginals[variable].items():
+                assignment = ftree.get_max_assignment_through(variable, value, run)
+                self.assertEqual(assignment[variable], value)
+                weight = 1
+                for factor in ftree.get_factors():
+                    weight *= factor.get_weight({node: assignment[node] for node in factor.get_connected_nodes()})
+                self.assertEqual(weight, max_marginal)
+
+    def test_chain(self):
+        variables = [Variable([0, 1, 2], name=f'V{i}') for i in range(4)]
+        transition_factors = [Factor(get_weight1, name=f'F{i}-{i+1}') for i in range(3)]
+        own_factor = Factor(get_weight_3, parent=variables[2], name='F2')  # Parents can already be set
+        variable_factors = [Factor(get_weight_3, name='F0'), None, own_factor,
+                            [Factor(get_weight_3, name='F3a'), Factor(get_weight_3, name='F3b')]]
+        ftree = FactorTree.chain(variables, transition_factors, variable_factors)
+        self.assertListEqual(ftree.levels, [
+            {variables[0]}, {variable_factors[0], transition_factors[0]}, {variables[1]}, {transition_factors[1]},
+            {variables[2]}, {own_factor, transition_factors[2]}, {variables[3]}, {*variable_factors[3]}
+        ])
+        self.assertEqual(variables[1].parent, transition_factors[0])
+        self.assertEqual(transition_factors[2].children, {variables[3]})
+        self.assertListEqual(list(ftree.get_variables()), variables)
+
+        # The same as the tree from the connected nodes
+        self.assertEqual(len(FactorTree.chain([Variable([0])], []).levels), 1)
+        connected_ftree = FactorTree.create_from_connected_nodes(list(ftree.get_nodes()))
+        self.assertListEqual(connected_ftree.levels, ftree.levels)
+        self.assertEqual(ftree.get_max_quality(), connected_ftree.get_max_quality())
+
+        with self.assertRaises(ValueError, msg='A chain with the wrong number of transition factors was allowed'):
+            FactorTree.chain([Variable([0]), Variable([0])], [])
+        with self.assertRaises(ValueError, msg='A chain with variables for factors was allowed'):
+            FactorTree.chain([Variable([0]), Variable([0])], [Variable([0])])
+        with self.assertRaises(ValueError, msg='A chain with a node twice was allowed'):
+            repeated = Variable([0])
+            FactorTree.chain([repeated, repeated], [Factor(get_weight1)])
+        with self.assertRaises(ValueError, msg='A chain with the wrong parents was allowed'):
+            wrong_parent = Variable([0])
+            FactorTree.chain([Variable([0]), wrong_parent], [Factor(get_weight1, parent=wrong_parent)])
+        with self.assertRaises(ValueError, msg='An SDPPFactorTree chain with normal factors was allowed'):
+            SDPPFactorTree.chain([Variable([0]), Variable([0])], [Factor(get_weight1)])
+
+    def test_create_large_tree(self):
+        # Long chains were quadratic to create
+        n_variables = 20000
+        nodes = [Variable([0, 1], name='V0')]
+        for i in range(1, n_variables):
+            factor = Factor(get_weight1, parent=nodes[-1], name=f'F{i-1}-{i}')
+            nodes.extend((factor, Variable([0, 1], parent=factor, name=f'V{i}')))
+        ftree = FactorTree.create_from_connected_nodes(reversed(nodes))
+        self.assertEqual(len(ftree.levels), 2*n_variables - 1)
+        self.assertIs(ftree.root, nodes[0])
+        self.assertEqual(ftree.item_directory[nodes[-1]], 2*n_variables - 2)
@@ -0,0 +1,77 @@
+from unittest import TestCase
+import numpy as np
+from min_energy_path.gaussian_field import *
+from min_energy_path.gaussian_field import _near_field_strength, _near_gaussian_grad
+from min_energy_path import gaussian_params
+
+
+class TestGaussianField(TestCase):
+    def test_gaussian_field_derivatives(self):
+        mix_params = gaussian_params.starter()
+        rnd = np.random.RandomState(0)
+        coords = rnd.uniform(-1, 5, (2, 20))
+        directions = rnd.randn(2, 20)
+        directions /= np.linalg.norm(directions, axis=0, keepdims=True)
+
+        strength, grad, second_order = gaussian_field_derivatives(coords, directions, mix_params)
+        self.assertTrue(np.allclose(strength, gaussian_field(coords, mix_params)))
+        self.assertTrue(np.allclose(grad, gaussian_grad(coords, mix_params)))
+
+        # Compare against a central finite difference along each direction
+        step = 1e-4
+        finite_difference = (
+            gaussian_field(coords + step*directions, mix_params)
+            - 2*gaussian_field(coords, mix_params)
+            + gaussian_field(coords - step*directions, mix_params)
+        ) / step**2
+        self.assertTrue(np.allclose(second_order, finite_difference, atol=1e-5))
+
+    def test_gaussian_field_for_quality_batch(self):
+        mix_params = gaussian_params.starter()
+        coords0 = np.array([[0., 0.], [1., 0.5], [2., -1.], [3., 3.]]).T
+        coords1 = np.array([[0.2, 0.1], [1.1, 0.3], [2., -1.], [0., 0.]]).T
+
+        *gaussian_info, close_enough = gaussian_field_for_quality_batch(coords0, coords1, mix_params, 0.1, 3)
+        self.assertListEqual(close_enough.tolist(), [True, True, False, False])
+
+        for i, pair_info in enumerate(zip(*gaussian_info)):
+            single_info = gaussian_field_for_quality(
+                np.concatenate([coords0[:, [i]], coords1[:, [i]]], axis=1), mix_params, 0.1, 3
+            )
+            self.assertTrue(np.allclose(pair_info, single_info))
+            # The finite difference estimate should be close to the analytic second derivative
+            finite_info = gaussian_field_for_quality(
+                np.concatenate([coords0[:, [i]], coords1[:, [i]]], axis=1), mix_params, 0.1, 3, order_2_step=0.01
+            )
+            self.assertAlmostEqual(pair_info[3], finite_info[3], places=3)
+
+    def test_gaussian_neighbour_lists(self):
+        rnd = np.random.RandomState(0)
+        mix_params = {'magnitude': rnd.uniform(-1, 1, 300),
+                      'sigma': rnd.uniform(0.1, 0.3, 300),
+                      'centre': rnd.uniform(-10, 10, (2, 300))}
+        coords = rnd.uniform(-10, 10, (2, 50))
+        neighbour_lists = GaussianNeighbourLists(mix_params, 50, skin=0.5)
+        neighbours = neighbour_lists.update(coords)
+        self.assertEqual(neighbour_lists.n_rebuilds, 50)
+        # Far fewer gaussians than the whole mixture, giving the same field and gradient
+        self.assertLess(neighbours.shape[1], 30)
+        coords_transformed, field_strength, sigma = _near_field_strength(coords, mix_params, neighbours)
+        self.assertTrue(np.allclose(np.sum(field_strength, axis=1), gaussian_field(coords, mix_params), atol=1e-8))
+        self.assertTrue(np.allclose(_near_gaussian_grad(coords_transformed, field_strength, sigma),
+                                    gaussian_grad(coords, mix_params), atol=1e-7))
+
+        # Only the points that move further than the skin get new lists, and the lists are still right
+        moved_coords = coords.copy()
+        moved_coords[0, :10] += 0.8
+        moved_coords[0, 10:] += 0.3
+        neighbours = neighbour_lists.update(moved_coords)
+        self.assertEqual(neighbour_lists.n_rebuilds, 60)
+        _, field_strength, _ = _near_field_strength(moved_coords, mix_params, neighbours)
+        self.assertTrue(np.allclose(np.sum(field_strength, axis=1), gaussian_field(moved_coords, mix_params),
+                                    atol=1e-8))
+
+        # Updating some of the points
+        subset = neighbour_lists.update(moved_coords[:, [3, 7]], np.array([3, 7]))
+        self.assertTrue(np.array_equal(subset, neighbours[[3, 7]]))
+        self.assertEqual(neighbour_lists.n_rebuilds, 60)
@@ -0,0 +1,53 @@
+from unittest import TestCase
+import json
+import numpy as np
+from structured_dpp.instrumentation import *
+from min_energy_path import gaussian_params
+from min_energy_path.points_sphere import create_sphere_points
+from min_energy_path.path_helpers import generate_path_ftree_better
+
+
+@timed('work')
+def _work(n):
+    count('items', n)
+    with span('inner'):
+        return n * 2
+
+
+class TestInstrumentation(TestCase):
+    def test_recording(self):
+        # Nothing is recorded outside of a recording
+        self.assertEqual(_work(3), 6)
+        self.assertFalse(is_recording())
+
+        with recording() as recorder:
+            self.assertTrue(is_recording())
+            for n in range(4):
+                _work(n)
+            with span('outer'):
+                _work(10)
+        self.assertFalse(is_recording())
+
+        stats = recorder.to_dict()
+        self.assertEqual(stats['counters'], {'items': 16})
+        self.assertEqual(stats['spans']['work']['calls'], 4)
+        self.assertEqual(stats['spans']['work/inner']['calls'], 4)
+        self.assertEqual(stats['spans']['outer/work/inner']['calls'], 1)
+        self.assertGreaterEqual(stats['spans']['outer']['total_time'], stats['spans']['outer/work']['total_time'])
+        self.assertEqual(json.loads(recorder.to_json()), stats)
+
+    def test_mep_stages(self):
+        mix_params = gaussian_params.starter()
+        with recording() as recorder:
+            points_info = create_sphere_points(mix_params['minima_coords'], 8)
+            ftree = generate_path_ftree_better(points_info, mix_params, length_cutoff=3, tuning_dist=0.02,
+                                               tuning_strength=1, tuning_strength_diff=1.5, n_spanning_gap=8)
+            variables = list(ftree.get_variables())
+            ftree.run_max_quality_forward(variables[len(variables) // 2])
+
+        self.assertEqual(recorder.counters['sphere_points'], points_info['sphere'].shape[1])
+        self.assertGreater(recorder.counters['gaussian_evaluations'], 0)
+        self.assertGreater(recorder.counters['transitions'], 0)
+        self.assertGreater(recorder.counters['messages'], recorder.counters['mep_factor_messages'])
+        for stage in ['create_sphere_points', 'generate_transition_qualities', 'forward_pass']:
+            self.assertIn(stage, recorder.spans)
@@ -0,0 +1,50 @@
+from unittest import TestCase
+import os
+import tempfile
+from min_energy_path.benchmark import *
+
+
+class TestMEPBenchmark(TestCase):
+    def test_run_case(self):
+        params = {'dim': 2, 'n_spanning_gap': 5, 'length_cutoff': 3, 'n_centres': 3}
+        result = run_case(params, seed=1, repeats=2, n_neb_iterations=20)
+        self.assertEqual(result['name'], 'dim=2,n_spanning_gap=5,length_cutoff=3,n_centres=3,seed=1')
+        self.assertEqual(set(result['stage_times']), set(STAGES))
+        self.assertEqual(set(result['peak_memory']), set(STAGES))
+        self.assertAlmostEqual(result['total_time'], sum(result['stage_times'].values()))
+        self.assertGreater(result['peak_memory']['field_tables'], 0)
+        self.assertGreater(result['counters']['transitions'], 0)
+        self.assertEqual(result['counters']['neb_iterations'], 20)
+
+        # The same seed gives the same mixture and so the same work and path
+        again = run_case(params, seed=1, repeats=1, n_neb_iterations=20, measure_memory=False)
+        self.assertEqual(again['counters'], result['counters'])
+        self.assertEqual(again['path_max_energy'], result['path_max_energy'])
+        self.assertEqual(again['peak_memory'], {})
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'results.json')
+            save_results([result], path)
+            loaded = load_results(path)
+        self.assertEqual(loaded[0]['counters'], result['counters'])
+
+    def test_compare_results(self):
+        # Fixed times, as real runs are too noisy to compare in a test
+        stage_times = {stage: 0.1 for stage in STAGES}
+        previous = [{'name': 'case', 'stage_times': stage_times, 'total_time': 0.1 * len(STAGES),
+                     'counters': {'transitions': 10}}]
+        slower = [dict(previous[0], stage_times={stage: 0.2 for stage in STAGES}, total_time=0.2 * len(STAGES))]
+        comparisons = compare_results(slower, previous, threshold=0.5)
+        self.assertEqual(len(comparisons), len(STAGES) + 1)
+        self.assertTrue(all(regressed for *_, regressed in comparisons))
+        comparisons = compare_results(slower, previous, threshold=1.5)
+        self.assertFalse(any(regressed for *_, regressed in comparisons))
+        # Slower by less than min_difference isn't a regression
+        comparisons = compare_results(slower, previous, threshold=0.5, min_difference=1.)
+        self.assertFalse(any(regressed for *_, regressed in comparisons))
+
+    def test_benchmark_cases(self):
+        cases = benchmark_cases({'dim': (2, 3), 'n_centres': (4, 5)}, {'dim': 3, 'n_spanning_gap': 5,
+                                                                       'length_cutoff': 3, 'n_centres': 5})
+        self.assertEqual(len(cases), 3)
+        self.assertEqual(cases[0], {'dim': 3, 'n_spanning_gap': 5, 'length_cutoff': 3, 'n_centres': 5})
@@ -0,0 +1,68 @@
+from unittest import TestCase
+import numpy as np
+from min_energy_path.mep_ftree import *
+from min_energy_path.path_helpers import generate_path_ftree_better
+from min_energy_path.points_sphere import create_sphere_points
+from min_energy_path import gaussian_params
+
+
+class TestMEPFactor(TestCase):
+    def test_sparse_max_product(self):
+        # Rows 0: {1: 0.5, 2: 2}, 1: {}, 2: {0: 1, 1: 1}
+        indptr, indices, data = np.array([0, 2, 2, 4]), np.array([1, 2, 0, 1]), np.array([0.5, 2, 1, 1])
+        incoming = np.array([3., 3., 1.])
+        maxima, argmax = sparse_max_product(indptr, indices, data, np.array([2, 1, 0]), incoming,
+                                            np.array([True, True, True]))
+        self.assertListEqual(maxima.tolist(), [3, 0, 2])
+        self.assertListEqual(argmax.tolist(), [1, -1, 2])  # Ties go to the largest column
+
+        maxima, argmax = sparse_max_product(indptr, indices, data, np.array([0]), incoming,
+                                            np.array([True, True, False]))
+        self.assertListEqual(maxima.tolist(), [1.5])
+        self.assertListEqual(argmax.tolist(), [1])
+
+    def test_create_all_messages_special(self):
+        mix_params = gaussian_params.starter()
+        points_info = create_sphere_points(mix_params['minima_coords'], 8)
+        ftree = generate_path_ftree_better(points_info, mix_params, length_cutoff=3, tuning_dist=0.02,
+                                           tuning_strength=1, tuning_strength_diff=1.5, n_spanning_gap=8)
+        variables = list(ftree.get_variables())
+        middle_var = variables[len(variables) // 2]
+        traversal, run = ftree.run_max_quality_forward(middle_var)
+
+        # Every vectorised message should match the message made one value at a time
+        for node, node_above in traversal[1:]:
+            if not isinstance(node, MEPFactor) or not isinstance(node.parent, MEPVariable) \
+                    or not all(isinstance(child, MEPVariable) for child in node.children):
+                continue
+            for value, message in node.outgoing_messages[run][node_above].items():
+                expected = node.create_message_special(node_above, value, node.parent, run=run)
+                self.assertAlmostEqual(message.v, expected.v)
+                if expected.v > 0:
+                    self.assertDictEqual(message.assignment, expected.assignment)
+
+    def test_run_max_marginals(self):
+        mix_params = gaussian_params.starter()
+        points_info = create_sphere_points(mix_params['minima_coords'], 8)
+        ftree = generate_path_ftree_better(points_info, mix_params, length_cutoff=3, tuning_dist=0.02,
+                                           tuning_strength=1, tuning_strength_diff=1.5, n_spanning_gap=6)
+        variables = list(ftree.get_variables())
+        tail_var = variables[-1]
+        traversal, run = ftree.run_max_quality_forward(tail_var, run_uid='tail')
+        best_value, tail_value = tail_var.calculate_max_message_assignment(run)
+        best_assignment = ftree.get_max_from_start_assignment(tail_var, tail_value, traversal, run)
+
+        # The best path goes through the best value of every variable
+        max_marginals, run = ftree.run_max_marginals(run_uid='marginals')
+        for variable in variables:
+            self.assertAlmostEqual(max(max_marginals[variable].values()), best_value)
+            self.assertAlmostEqual(max_marginals[variable][best_assignment[variable]], best_value)
+
+        middle_var = variables[len(variables) // 2]
+        for value, max_marginal in list(max_marginals[middle_var].items())[::10]:
+            if max_marginal == 0:
+                continue
+            assignment = ftree.get_max_assignment_through(middle_var, value, run)
+            self.assertEqual(assignment[middle_var], value)
+            path_value = np.prod([factor.get_weight(assignment) for factor in ftree.get_factors()])
+            self.assertAlmostEqual(path_value, max_marginal)
@@ -0,0 +1,23 @@
+from unittest import TestCase
+import numpy as np
+from min_energy_path.multi_resolution import *
+from min_energy_path import gaussian_params
+
+
+class TestMultiResolution(TestCase):
+    def test_distance_to_paths(self):
+        points = np.array([[0., 1.], [2., 0.5], [-1., 0.], [3., 3.]]).T
+        paths = [np.array([[0., 0.], [2., 0.]]).T, np.array([[3., 2.], [3., 2.]]).T]
+        self.assertTrue(np.allclose(distance_to_paths(points, paths), [1, 0.5, 1, 1]))
+
+    def test_find_paths_coarse_to_fine(self):
+        mix_params = gaussian_params.starter()
+        levels = find_paths_coarse_to_fine(mix_params, (5, 9))
+        full = find_paths_coarse_to_fine(mix_params, (9,))
+        self.assertListEqual([level['n_spanning_gap'] for level in levels], [5, 9])
+        self.assertLess(len(levels[1]['points_info']['sphere_index']), len(full[0]['points_info']['sphere_index']))
+
+        # The tube around the coarse paths contains the best fine path
+        fine_best, full_best = levels[1]['paths'][0], full[0]['paths'][0]
+        self.assertAlmostEqual(fine_best['value'], full_best['value'])
+        self.assertTrue(np.allclose(fine_best['path'], full_best['path']))
@@ -0,0 +1,109 @@
+from unittest import TestCase
+import numpy as np
+from min_energy_path.neb import *
+from min_energy_path.neb import _pad_paths, _interior_mask
+from min_energy_path import gaussian_params
+import min_energy_path.gaussian_field as gf
+import scipy.linalg as scila
+
+
+class TestNEB(TestCase):
+    def setUp(self):
+        self.mix_params = gaussian_params.starter()
+        minima = self.mix_params['minima_coords']
+        self.path_guesses = []
+        for n_points, bump in [(7, 0.05), (11, -0.1), (5, 0.1)]:
+            path_guess = np.linspace(minima[:, 0], minima[:, 1], n_points, axis=-1)
+            path_guess[1, 1:-1] += bump
+            self.path_guesses.append(path_guess)
+
+    def test_neb_batch(self):
+        paths, force_histories = neb_batch(self.path_guesses, self.mix_params, force_cutoff=1e-3,
+                                           n_max_iterations=2000, return_force_history=True)
+        for path_guess, path, force_history in zip(self.path_guesses, paths, force_histories):
+            # Each path is the same as when it is done on its own, and stops at its own convergence
+            single_path, single_force_history = neb(path_guess, self.mix_params, force_cutoff=1e-3,
+                                                    n_max_iterations=2000, return_force_history=True)
+            self.assertEqual(path.shape, path_guess.shape)
+            self.assertTrue(np.allclose(path, single_path))
+            self.assertEqual(len(force_history), len(single_force_history))
+            self.assertTrue(np.array_equal(path[:, [0, -1]], path_guess[:, [0, -1]]))
+
+    def test_neb_force(self):
+        # The force on a path on its own is the same as in a batch of paths
+        paths, n_points = _pad_paths(self.path_guesses)
+        forces, _, collapsed = neb_forces(paths, self.mix_params, interior=_interior_mask(n_points, paths.shape[2]))
+        self.assertFalse(np.any(collapsed))
+        for path_guess, force in zip(self.path_guesses, forces):
+            single_force = neb_force(path_guess, self.mix_params)
+            self.assertEqual(single_force.shape, (path_guess.shape[0], path_guess.shape[1] - 2))
+            self.assertTrue(np.allclose(force[:, :single_force.shape[1]], single_force))
+            self.assertTrue(np.all(force[:, single_force.shape[1]:] == 0))
+
+    def test_optimizers(self):
+        path_guess = self.path_guesses[0]
+        quick_min_path, quick_min_history = neb(path_guess, self.mix_params, force_cutoff=1e-5,
+                                                return_force_history=True)
+        for optimizer in ['fire', 'lbfgs']:
+            path, force_history = neb(path_guess, self.mix_params, force_cutoff=1e-5, return_force_history=True,
+                                      optimizer=optimizer)
+            # Converges to the same path in far fewer iterations
+            self.assertLess(force_history[-1], 1e-5)
+            self.assertLess(len(force_history), len(quick_min_history) / 4)
+            self.assertTrue(np.allclose(path, quick_min_path, atol=1e-3))
+        with self.assertRaises(ValueError):
+            neb(path_guess, self.mix_params, optimizer='newton')
+
+    def test_climbing_image(self):
+        minima = self.mix_params['minima_coords']
+        dense_guess = np.linspace(minima[:, 0], minima[:, 1], 31, axis=-1)
+        dense_guess[1, 1:-1] += 0.05
+        dense_path = neb(dense_guess, self.mix_params, force_cutoff=1e-6, optimizer='fire', climbing_image=True)
+        barrier = np.max(gf.gaussian_field(dense_path, self.mix_params))
+
+        # Without climbing the few points miss the top of the barrier, with climbing one of them sits on it
+        path_guess = self.path_guesses[0]
+        path = neb(path_guess, self.mix_params, optimizer='fire')
+        self.assertLess(np.max(gf.gaussian_field(path, self.mix_params)), barrier - 1e-2)
+        path, force_history = neb(path_guess, self.mix_params, optimizer='fire', climbing_image=True,
+                                  return_force_history=True)
+        self.assertAlmostEqual(np.max(gf.gaussian_field(path, self.mix_params)), barrier, places=5)
+
+        # Stopping on the barrier is quicker and still finds it
+        path, barrier_force_history = neb(path_guess, self.mix_params, optimizer='fire', climbing_image=True,
+                                          barrier_cutoff=1e-6, return_force_history=True)
+        self.assertLess(len(barrier_force_history), len(force_history))
+        self.assertAlmostEqual(np.max(gf.gaussian_field(path, self.mix_params)), barrier, places=5)
+
+    def test_redistribute_images(self):
+        path = np.stack([np.linspace(0, 4, 9), np.zeros(9)])
+        path_energies = np.array([0, 0, 0, 0, 1, 0, 0, 0, 0.])
+        new_path = redistribute_images(path, path_energies, spacing=0.5, energy_weight=3.)
+        self.assertTrue(np.array_equal(new_path[:, [0, -1]], path[:, [0, -1]]))
+        self.assertTrue(np.all(new_path[1] == 0))
+        # Weighted length 4 + 3 * 0.5 * 2 so 11 spaces, with the images closer around the barrier
+        self.assertEqual(new_path.shape[1], 12)
+        gaps = np.diff(new_path[0])
+        self.assertLess(np.min(gaps[4:7]), np.min(gaps[[0, -1]]))
+        self.assertAlmostEqual(gaps[0], 0.5)
+
+        # A flat path is evenly spaced, with at least min_images
+        new_path = redistribute_images(path, np.zeros(9), spacing=1.)
+        self.assertTrue(np.allclose(new_path[0], [0, 1, 2, 3, 4]))
+        self.assertEqual(redistribute_images(path, np.zeros(9), spacing=10.).shape[1], 3)
+
+    def test_neb_adaptive(self):
+        path, force_history = neb_adaptive(self.path_guesses[2], self.mix_params, spacing=0.5, optimizer='fire',
+                                           n_rounds=2, return_force_history=True)
+        self.assertTrue(np.array_equal(path[:, [0, -1]], self.path_guesses[2][:, [0, -1]]))
+        self.assertGreater(path.shape[1], self.path_guesses[2].shape[1])
+        # The climbing image sits on the saddle point, where the gradient is 0
+        top = np.argmax(gf.gaussian_field(path, self.mix_params))
+        self.assertLess(scila.norm(gf.gaussian_grad(path[:, [top]], self.mix_params)), 1e-2)
+
+    def test_neighbour_skin(self):
+        paths = neb_batch(self.path_guesses, self.mix_params, force_cutoff=1e-3, n_max_iterations=2000)
+        near_paths = neb_batch(self.path_guesses, self.mix_params, force_cutoff=1e-3, n_max_iterations=2000,
+                               neighbour_skin=0.2)
+        for path, near_path in zip(paths, near_paths):
+            self.assertTrue(np.allclose(path, near_path, atol=1e-6))
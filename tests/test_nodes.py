@@ -84,6 +84,45 @@ class TestNode(TestCase):
             "Name of node with children wrong."
         )
 
+    def test_compact_nodes(self):
+        main_node = Node()
+        self.assertFalse(hasattr(main_node, '__dict__'), 'Node has an instance dictionary')
+        for node in (Variable([0]), Factor(lambda: None)):
+            self.assertFalse(hasattr(node, '__dict__'), f'{type(node).__name__} has an instance dictionary')
+        self.assertEqual(len(main_node.children), 0)
+
+        # The cached connected nodes are remade when the connections change
+        child_node_1, child_node_2, parent_node = Node(), Node(), Node()
+        main_node.add_child(child_node_1)
+        self.assertEqual(main_node.get_connected_nodes(), (child_node_1,))
+        main_node.parent = parent_node
+        self.assertEqual(main_node.get_connected_nodes(), (child_node_1, parent_node))
+        main_node.add_children([child_node_2])
+        self.assertEqual(set(main_node.get_connected_nodes()), {child_node_1, child_node_2, parent_node})
+        self.assertEqual(set(main_node.get_connected_nodes(exclude=parent_node)), {child_node_1, child_node_2})
+        self.assertEqual(set(main_node.get_connected_nodes(exclude=child_node_2)), {child_node_1, parent_node})
+        main_node.children = [child_node_2]
+        self.assertEqual(main_node.get_connected_nodes(exclude=parent_node), (child_node_2,))
+
+        # The children can't be changed without remaking the connected nodes
+        with self.assertRaises(AttributeError):
+            main_node.children.add(child_node_1)
+        with self.assertRaises(AttributeError):
+            Node().children.add(child_node_1)
+        self.assertEqual(main_node.get_connected_nodes(exclude=parent_node), (child_node_2,))
+
+        # The parent is kept alive by its children
+        child = Node(parent=Node(name='Temporary'))
+        self.assertEqual(child.parent.name, 'Temporary')
+
+        # A tree gives its nodes ids which index its nodes
+        root = Variable([0, 1])
+        factor = Factor(lambda: None, parent=root)
+        variable = Variable([0, 1], parent=factor)
+        ftree = FactorTree.create_from_connected_nodes([variable, factor, root])
+        self.assertListEqual([node.node_id for node in (root, factor, variable)], [0, 1, 2])
+        self.assertListEqual(ftree.nodes, [root, factor, variable])
+
 
 class TestFactor(TestCase):
     def test_get_consistent_assignments(self):
@@ -0,0 +1,81 @@
+from unittest import TestCase
+import numpy as np
+from min_energy_path.path_helpers import *
+from min_energy_path.points_sphere import create_sphere_points
+from min_energy_path import gaussian_params
+
+
+class TestPathHelpers(TestCase):
+    def setUp(self):
+        self.mix_params = gaussian_params.starter()
+        self.points_info = create_sphere_points(self.mix_params['minima_coords'], 6)
+
+    def test_standard_transition_quality_batch_function(self):
+        quality_args = (self.points_info, self.mix_params, 3, 0.02, 1, 1.5, 0.5, 0.3)
+        quality_function = get_standard_transition_quality_function(*quality_args)
+        batch_quality_function = get_standard_transition_quality_batch_function(*quality_args, batch_size=7)
+
+        parent, child = Variable([0]), Variable([0])
+        factor = Factor(quality_function, parent=parent, children=[child])
+
+        idx0, idx1 = np.meshgrid(self.points_info['sphere_index'], self.points_info['sphere_index'][:6])
+        qualities, breakdown = batch_quality_function(idx0, idx1, return_breakdown=True)
+        for i, (value0, value1) in enumerate(zip(idx0.ravel(), idx1.ravel())):
+            self.assertAlmostEqual(qualities[i], quality_function(factor, {child: value0, parent: value1}))
+            if qualities[i] > 0:
+                self.assertTrue(np.allclose(
+                    breakdown[:, i], quality_function(factor, {child: value0, parent: value1}, return_breakdown=True)
+                ))
+
+    def test_generate_path_ftree_tables(self):
+        quality_args = (self.points_info, self.mix_params, 3, 0.02, 1, 1.5, 0.5, 0.3)
+        quality_function = get_standard_transition_quality_function(*quality_args)
+        batch_quality_function = get_standard_transition_quality_batch_function(*quality_args)
+
+        ftree = generate_path_ftree(quality_function, self.points_info, 6, 1, 2)
+        table_ftree = generate_path_ftree(quality_function, self.points_info, 6, 1, 2,
+                                          batch_quality_function=batch_quality_function)
+        assignment = ftree.get_max_quality()
+        table_assignment = table_ftree.get_max_quality()
+        self.assertListEqual(
+            [assignment[var] for var in ftree.get_variables()],
+            [table_assignment[var] for var in table_ftree.get_variables()]
+        )
+
+    def test_prune_points(self):
+        points_info = create_sphere_points(self.mix_params['minima_coords'], 8)
+        pruned = prune_points(points_info, self.mix_params, 3, strength_margin=-0.6)
+        self.assertLess(len(pruned['sphere_index']), len(points_info['sphere_index']))
+        self.assertEqual(pruned['original_index'][pruned['root_index']], points_info['root_index'])
+        self.assertEqual(pruned['original_index'][pruned['tail_index']], points_info['tail_index'])
+        self.assertTrue(np.array_equal(pruned['sphere'], points_info['sphere'][:, pruned['original_index']]))
+
+        # Only high points were removed, so the best path is the same
+        paths = []
+        for p_info in [points_info, pruned]:
+            ftree = generate_path_ftree_better(p_info, self.mix_params, length_cutoff=3, tuning_dist=0.02,
+                                               tuning_strength=1, tuning_strength_diff=1.5, n_spanning_gap=8)
+            assignment = ftree.get_max_quality()
+            paths.append(p_info.get('original_index', p_info['sphere_index'])[
+                [assignment[var] for var in ftree.get_variables()]
+            ].tolist())
+        self.assertListEqual(paths[0], paths[1])
+
+    def test_retune_path_ftree(self):
+        points_info = create_sphere_points(self.mix_params['minima_coords'], 8)
+        transition_components = generate_transition_components(points_info, self.mix_params, 3, 1, 2)
+        transition_qualities = transition_components.qualities(0.02, 1, 1.5)
+        ftree = generate_path_ftree_better(points_info, self.mix_params, 3, 0.02, 1, 1.5, n_spanning_gap=8,
+                                           transition_qualities=transition_qualities)
+
+        for tuning in [(0.02, 1, 1.5), (0.5, 0.5, 3)]:
+            expected = generate_transition_qualities(points_info, self.mix_params, 3, *tuning, 1, 2)
+            retuned = retune_path_ftree(ftree, transition_components, *tuning)
+            self.assertTrue(np.array_equal(retuned.indices, expected.indices))
+            self.assertTrue(np.allclose(retuned.data, expected.data))
+
+            # The retuned tree finds the same path as a tree built with the tuning
+            expected_ftree = generate_path_ftree_better(points_info, self.mix_params, 3, *tuning, n_spanning_gap=8)
+            assignment, expected_assignment = ftree.get_max_quality(), expected_ftree.get_max_quality()
+            self.assertListEqual([assignment[var] for var in ftree.get_variables()],
+                                 [expected_assignment[var] for var in expected_ftree.get_variables()])
@@ -0,0 +1,78 @@
+from unittest import TestCase
+import tempfile
+import numpy as np
+from min_energy_path.pipeline import *
+from min_energy_path import gaussian_params
+
+
+class TestPipeline(TestCase):
+    def setUp(self):
+        self.temporary_dir = tempfile.TemporaryDirectory()
+        self.pipeline = MEPPipeline(self.temporary_dir.name)
+
+    def tearDown(self):
+        self.temporary_dir.cleanup()
+
+    def test_hash_inputs(self):
+        self.assertEqual(hash_inputs({'a': np.arange(3), 'b': (1, 2.)}), hash_inputs({'b': (1, 2.), 'a': np.arange(3)}))
+        self.assertNotEqual(hash_inputs(np.arange(3)), hash_inputs(np.arange(3.)))
+        self.assertNotEqual(hash_inputs([1, 2]), hash_inputs((1, 2)))
+
+    def test_stages_are_reused(self):
+        neb_kwargs = {'n_spanning_point_gap': 2, 'n_max_iterations': 50}
+        first = self.pipeline.run(gaussian_params.starter, (), 8, neb_kwargs=neb_kwargs)
+        self.assertEqual(sum(self.pipeline.cache.hits.values()), 0)
+
+        # Running again loads everything
+        second = self.pipeline.run(gaussian_params.starter, (), 8, neb_kwargs=neb_kwargs)
+        self.assertEqual(self.pipeline.cache.hits, {stage: 1 for stage in self.pipeline.cache.misses})
+        self.assertListEqual(first['path_info']['path_indexes'], second['path_info']['path_indexes'])
+        self.assertAlmostEqual(first['path_info']['value'], second['path_info']['value'])
+        self.assertTrue(np.array_equal(first['neb_path'], second['neb_path']))
+
+        # Only NEB is run again for new NEB parameters
+        self.pipeline.run(gaussian_params.starter, (), 8, neb_kwargs=dict(neb_kwargs, n_max_iterations=60))
+        self.assertEqual(self.pipeline.cache.hits['path'], 2)
+        self.assertEqual(self.pipeline.cache.misses['neb'], 2)
+
+        # The field tables are reused for different slicing
+        self.pipeline.run(gaussian_params.starter, (), 8, n_slices_ahead=1)
+        self.assertEqual(self.pipeline.cache.hits['field_tables'], 3)
+        self.assertEqual(self.pipeline.cache.misses['transitions'], 2)
+
+    def test_seeded_mixture(self):
+        np.random.seed(0)
+        expected_global_state = np.random.rand()
+        np.random.seed(0)
+        mix_params, key = self.pipeline.mixture(gaussian_params.randomly_generated, 2, 3, seed=5)
+        # The seed goes to the params function and the global random state is left alone
+        self.assertEqual(np.random.rand(), expected_global_state)
+        self.assertTrue(np.array_equal(mix_params['minima_coords'],
+                                       gaussian_params.randomly_generated(2, 3, seed=5)['minima_coords']))
+        self.assertNotEqual(key, self.pipeline.mixture(gaussian_params.randomly_generated, 2, 3, seed=6)[1])
+        with self.assertRaises(ValueError):
+            self.pipeline.mixture(gaussian_params.starter, seed=5)
+
+    def test_stage_key_has_code_version(self):
+        key = self.pipeline.stage_key('points', 'mixture key', 8)
+        self.assertEqual(key, self.pipeline.stage_key('points', 'mixture key', 8))
+        # A new version or different code gives a new key
+        self.pipeline.STAGE_VERSIONS = dict(MEPPipeline.STAGE_VERSIONS, points=2)
+        self.assertNotEqual(key, self.pipeline.stage_key('points', 'mixture key', 8))
+        self.pipeline.STAGE_VERSIONS = MEPPipeline.STAGE_VERSIONS
+        self.assertNotEqual(key, self.pipeline.stage_key('points', 'mixture key', 8,
+                                                         function=gaussian_params.starter))
+        self.assertNotEqual(source_hash(gaussian_params.starter), source_hash(gaussian_params.basic3d))
+
+    def test_ftree(self):
+        mix_params, key = self.pipeline.mixture(gaussian_params.starter)
+        points_info, key = self.pipeline.points(mix_params, key, 8)
+        field_tables, key = self.pipeline.field_tables(points_info, mix_params, key, 3)
+        transition_components, key = self.pipeline.transitions(points_info, mix_params, field_tables, key, 3, 1, 2)
+        path_info, _ = self.pipeline.path(points_info, mix_params, transition_components, key, 3, 0.02, 1, 1.5, 8, 1, 2)
+
+        # The tree of the path stage, for finding more than the best path
+        ftree = self.pipeline.ftree(points_info, mix_params, transition_components, 3, 0.02, 1, 1.5, 8, 1, 2)
+        tail_var = next(iter(ftree.levels[-1]))
+        _, run = ftree.run_max_quality_forward(tail_var)
+        self.assertAlmostEqual(tail_var.calculate_max_message_assignment(run)[0], path_info['value'])
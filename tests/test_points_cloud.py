@@ -0,0 +1,47 @@
+from unittest import TestCase
+import numpy as np
+from min_energy_path.points_cloud import *
+from min_energy_path.points_sphere import get_neighbour_window
+from min_energy_path.path_helpers import generate_path_ftree_better
+from min_energy_path import gaussian_params
+
+
+class TestPointsCloud(TestCase):
+    def setUp(self):
+        self.mix_params = gaussian_params.starter()
+        self.points_info = create_cloud_points(self.mix_params['minima_coords'], 6, 80, n_neighbours=10, seed=0)
+
+    def test_create_cloud_points(self):
+        points_info = self.points_info
+        self.assertEqual(points_info['sphere'].shape, (2, 82))
+        self.assertTrue(np.allclose(points_info['sphere'][:, points_info['root_index']],
+                                    self.mix_params['minima_coords'][:, 0]))
+        self.assertTrue(np.allclose(points_info['sphere'][:, points_info['tail_index']],
+                                    self.mix_params['minima_coords'][:, 1]))
+        self.assertEqual(points_info['tail_dir_index'] - points_info['root_dir_index'], 5)
+        self.assertTrue(np.all(np.diff(points_info['dir_index']) >= 0))
+
+        # The neighbours are symmetric and every window only has neighbours in its slices
+        neighbours = points_info['neighbours']
+        edges = {(i, j) for i in points_info['sphere_index']
+                 for j in neighbours['indices'][neighbours['indptr'][i]:neighbours['indptr'][i+1]]}
+        self.assertTrue(all((j, i) in edges for i, j in edges))
+        for i in points_info['sphere_index']:
+            window = get_neighbour_window(i, points_info, 2, 4)
+            self.assertTrue(np.all((2 <= points_info['dir_index'][window]) & (points_info['dir_index'][window] < 4)))
+
+    def test_path_through_cloud(self):
+        ftree = generate_path_ftree_better(self.points_info, self.mix_params, length_cutoff=3, tuning_dist=0.02,
+                                           tuning_strength=1, tuning_strength_diff=1.5, n_spanning_gap=6)
+        tail_var = next(iter(ftree.levels[-1]))
+        traversal, run = ftree.run_max_quality_forward(tail_var)
+        max_quality, max_assignment = tail_var.calculate_max_message_assignment(run)
+        self.assertGreater(max_quality, 0)
+        assignment = ftree.get_max_from_start_assignment(tail_var, max_assignment, traversal, run)
+        path = [assignment[var] for var in ftree.get_variables()]
+        self.assertEqual(path[0], self.points_info['root_index'])
+        self.assertEqual(path[-1], self.points_info['tail_index'])
+        # Every step of the path is along an edge of the nearest neighbour graph
+        neighbours = self.points_info['neighbours']
+        for fromm, to in zip(path[:-1], path[1:]):
+            self.assertIn(to, neighbours['indices'][neighbours['indptr'][fromm]:neighbours['indptr'][fromm+1]])
@@ -22,3 +22,38 @@ class TestPointsSphere(TestCase):
             indexes_near_2,
             [54, 55, 62, 63, 64]
         )
+
+    def test_grid_to_sphere_index(self):
+        minima = np.array([
+            [0, 0, 0, 0],
+            [1, 0.5, 0, 0.25]
+        ]).T
+        points_info = create_sphere_points(minima, 5, shrink_in_direction=0.5)
+        self.assertListEqual(
+            grid_to_sphere_index(points_info['grid_index'], points_info).tolist(),
+            points_info['sphere_index'].tolist()
+        )
+        # Points outside the sphere, and outside the grid, aren't found
+        corners = np.array([[0] * 4, [c - 1 for c in points_info['grid_shape']], [-1] * 4]).T
+        self.assertListEqual(grid_to_sphere_index(corners, points_info).tolist(), [-1, -1, -1])
+
+    def test_neighbour_adjacency(self):
+        minima = np.array([
+            [0, 0, 0],
+            [1, 0.5, 0]
+        ]).T
+        points_info = create_sphere_points(minima, 6, shrink_in_direction=0.8)
+        get_neighbour_adjacency(points_info, 2)
+        for center_index in points_info['sphere_index']:
+            for min_dir_index, max_dir_index in [(0, None), (2, 4), (3, 4), (5, 1)]:
+                # Compare to the points found by scanning the grid, filtered to those within the cutoff
+                indexes_near = np.array(get_nearby_sphere_indexes(
+                    center_index, 2, points_info, min_dir_index=min_dir_index, max_dir_index=max_dir_index
+                ), dtype=int)
+                distances = np.linalg.norm(
+                    points_info['sphere'][:, indexes_near] - points_info['sphere'][:, [center_index]], axis=0
+                ) / points_info['point_distance']
+                self.assertListEqual(
+                    get_neighbour_window(center_index, points_info, min_dir_index, max_dir_index).tolist(),
+                    np.sort(indexes_near[distances <= 2 + 1e-9]).tolist()
+                )
@@ -0,0 +1,49 @@
+from unittest import TestCase
+import tempfile
+import numpy as np
+from min_energy_path.results_store import *
+
+
+class TestResultsStore(TestCase):
+    def test_results_store(self):
+        rnd = np.random.RandomState(0)
+        records = [{'trial': i, 'method': 'neb' if i % 2 else 'mrf', 'energy_max': rnd.random_sample(),
+                    'energy_profile': rnd.random_sample(rnd.randint(1, 10))} for i in range(11)]
+        with tempfile.TemporaryDirectory() as directory:
+            with ResultsStore(directory, chunk_size=4) as store:
+                store.extend(records[:6])
+                self.assertEqual(len(store.index['chunks']), 1)
+                self.assertEqual(len(store), 6)
+            self.assertDictEqual(store.columns, {'trial': 'scalar', 'method': 'scalar', 'energy_max': 'scalar',
+                                                 'energy_profile': 'ragged'})
+
+            # Opening it again appends to it, and records can be missing columns
+            with ResultsStore(directory, chunk_size=4) as store:
+                store.extend(records[6:])
+                store.append({'trial': 11, 'note': 'extra'})
+            store = ResultsStore(directory)
+            self.assertEqual(len(store), 12)
+            self.assertEqual([chunk['n_records'] for chunk in store.index['chunks']], [4, 2, 4, 2])
+
+            self.assertListEqual(store.column('trial').tolist(), list(range(12)))
+            self.assertListEqual(store.column('method').tolist()[:4], ['mrf', 'neb', 'mrf', 'neb'])
+            profiles = store.column('energy_profile')
+            for record, profile in zip(records, profiles):
+                self.assertTrue(np.array_equal(record['energy_profile'], profile))
+            self.assertEqual(profiles[11].size, 0)
+            self.assertTrue(np.isnan(store.column('energy_max')[11]))
+            # Missing strings are '' whether the whole chunk or just the record is missing them
+            self.assertListEqual(store.column('note').tolist(), [''] * 11 + ['extra'])
+
+            # Streaming only the columns needed
+            for chunk in store.iter_chunks(['energy_max']):
+                self.assertListEqual(list(chunk), ['energy_max'])
+            n_high = store.reduce(lambda total, chunk: total + np.sum(chunk['energy_max'] > 0.5), ['energy_max'])
+            self.assertEqual(n_high, sum(record['energy_max'] > 0.5 for record in records))
+
+            record = list(store.iter_records(['trial', 'energy_profile']))[3]
+            self.assertEqual(record['trial'], 3)
+            self.assertTrue(np.array_equal(record['energy_profile'], records[3]['energy_profile']))
+
+            with self.assertRaises(ValueError):
+                store.append({'energy_max': np.ones(3)})
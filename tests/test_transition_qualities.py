@@ -0,0 +1,38 @@
+from unittest import TestCase
+import numpy as np
+from min_energy_path.transition_qualities import *
+
+
+class TestTransitionQualities(TestCase):
+    def setUp(self):
+        self.as_dict = {0: {3: 0.5, 1: 0.25}, 2: {0: 1.}, 3: {2: 0.75, 3: 0.125, 0: 2.}}
+        self.transition_qualities = TransitionQualities.from_dict(self.as_dict, 5)
+
+    def test_dict_reading(self):
+        self.assertDictEqual(self.transition_qualities.to_dict(), self.as_dict)
+        self.assertListEqual(list(self.transition_qualities), [0, 2, 3])
+        self.assertEqual(len(self.transition_qualities), 3)
+        self.assertIn(3, self.transition_qualities)
+        self.assertNotIn(1, self.transition_qualities)
+        self.assertEqual(self.transition_qualities[3][0], 2.)
+        self.assertEqual(self.transition_qualities[3].get(1, 0), 0)
+        self.assertEqual(len(self.transition_qualities[4]), 0)
+        self.assertIsNone(self.transition_qualities.get(5))
+        with self.assertRaises(KeyError):
+            self.transition_qualities[0][2]
+
+    def test_transposed(self):
+        indptr_t, indices_t, data_t = self.transition_qualities.transposed()
+        for to in range(5):
+            row = dict(zip(indices_t[indptr_t[to]:indptr_t[to+1]], data_t[indptr_t[to]:indptr_t[to+1]]))
+            expected = {fromm: tos[to] for fromm, tos in self.as_dict.items() if to in tos}
+            self.assertDictEqual(row, expected)
+
+        # Changing the data keeps the transitions
+        doubled = self.transition_qualities.with_data(2 * self.transition_qualities.data)
+        self.assertTrue(np.array_equal(doubled.transposed()[2], 2 * data_t))
+
+    def test_float32(self):
+        transition_qualities = TransitionQualities.from_dict(self.as_dict, 5, dtype=np.float32)
+        self.assertLess(transition_qualities.nbytes, self.transition_qualities.nbytes)
+        self.assertDictEqual(transition_qualities.to_dict(), self.as_dict)